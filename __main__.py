@@ -10,11 +10,17 @@ import logging
 import sys
 import json
 import argparse
+import asyncio
 from ivory import Ivory
-from constants import DEFAULT_CONFIG_PATH, COMMAND_WATCH, COMMAND_ONESHOT
+from constants import DEFAULT_CONFIG_PATH, COMMAND_WATCH, COMMAND_ONESHOT, COMMAND_SERVE, COMMAND_FETCH, COMMAND_WORK, COMMAND_INDEX
 
 if __name__ == "__main__":
     logger = logging.getLogger(__name__)
+    if sys.argv[1:2] == [COMMAND_INDEX]:
+        # index management has its own subcommands, and doesn't need a config
+        from blocklist_index import main
+        main(sys.argv[2:])
+        exit(0)
     argparser = argparse.ArgumentParser(
         description="A Mastodon automoderator.")
     argparser.add_argument("--config",
@@ -22,10 +28,14 @@ if __name__ == "__main__":
                            help="Path to the configuration file (default is config.json)",
                            default=DEFAULT_CONFIG_PATH)
     argparser.add_argument('command',
-                           help="Command to run (oneshot to run once, watch to run on a loop). Runs in watch mode by default.",
+                           help="Command to run (oneshot to run once, watch to run on a loop, serve to take webhooks, fetch and work to split fetching from judging across processes; see 'index build --help' for compiling blocklists). Runs in watch mode by default.",
                            default=COMMAND_WATCH,
                            nargs='?',
-                           choices=[COMMAND_WATCH, COMMAND_ONESHOT])
+                           choices=[COMMAND_WATCH, COMMAND_ONESHOT, COMMAND_SERVE, COMMAND_FETCH, COMMAND_WORK])
+    argparser.add_argument("--async",
+                           dest="use_async",
+                           help="Run Ivory on an asyncio event loop, handling both queues concurrently",
+                           action="store_true")
     args = argparser.parse_args()
     try:
         # set up logging
@@ -33,11 +43,32 @@ if __name__ == "__main__":
         with open(args.configpath) as config_file:
             config = json.load(config_file)
         logging.getLogger().setLevel(config.get('logLevel', logging.INFO))
+        if "instances" in config:
+            # several instances in one process
+            from multi_ivory import MultiIvory
+            if args.use_async or args.command not in (COMMAND_WATCH, COMMAND_ONESHOT):
+                argparser.error("only watch and oneshot support several instances yet")
+            if args.command == COMMAND_WATCH:
+                MultiIvory(config).watch()
+            elif args.command == COMMAND_ONESHOT:
+                MultiIvory(config).run()
+        elif args.command == COMMAND_FETCH:
+            Ivory(config, args.configpath).fetch()
+        elif args.command == COMMAND_WORK:
+            Ivory(config, args.configpath).work()
+        elif args.command == COMMAND_SERVE:
+            Ivory(config, args.configpath).serve()
+        elif args.use_async:
+            from async_ivory import AsyncIvory
+            if args.command == COMMAND_WATCH:
+                asyncio.run(AsyncIvory(config, args.configpath).watch_async())
+            elif args.command == COMMAND_ONESHOT:
+                asyncio.run(AsyncIvory(config, args.configpath).run_async())
         # start up ivory in watch mode
-        if args.command == COMMAND_WATCH:
-            Ivory(config).watch()
+        elif args.command == COMMAND_WATCH:
+            Ivory(config, args.configpath).watch()
         elif args.command == COMMAND_ONESHOT:
-            Ivory(config).run()
+            Ivory(config, args.configpath).run()
     except OSError as err:
         logger.exception("failed to load config file")
         exit(1)
@@ -0,0 +1,344 @@
+"""
+Asyncio-based engine for Ivory.
+
+This runs alongside the synchronous Ivory.run/Ivory.watch: AsyncRules test
+items with coroutines, async judges gather those coroutines (a limited number
+at a time per rule), and AsyncIvory fetches, judges and punishes both queues
+concurrently. Plain synchronous rules and Mastodon.py calls still work; they're
+just run in the event loop's default thread pool.
+"""
+import asyncio
+import functools
+import signal
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import List
+
+from mastodon import MastodonError
+
+import constants
+from context import ReportContext, PendingAccountContext
+from ivory import Ivory
+from judge import Rule, ReportJudge, PendingAccountJudge
+from scheduler import PassBudget
+
+
+class AsyncRule(Rule):
+    """
+    A Rule whose test methods are coroutines.
+
+    Async judges test up to concurrency items against the rule at once; this
+    can be set per rule with the "concurrency" config option. Synchronous
+    judges refuse to load them.
+    """
+    is_async = True
+
+    def __init__(self, **config):
+        Rule.__init__(self, **config)
+        self.concurrency = config.get('concurrency', constants.DEFAULT_RULE_CONCURRENCY)
+        self._limits = {}
+
+    def limit(self) -> asyncio.Semaphore:
+        """
+        Get the semaphore limiting how many of this rule's tests run at once
+        in the current event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if loop not in self._limits:
+            # semaphores belong to one event loop, and each asyncio.run()
+            # makes a new one
+            self._limits = {loop: asyncio.Semaphore(self.concurrency)}
+        return self._limits[loop]
+
+    async def test_report(self, report: dict, context: ReportContext = None):
+        raise NotImplementedError()
+
+    async def test_pending_account(self, account: dict, context: PendingAccountContext = None):
+        raise NotImplementedError()
+
+    async def _limited(self, test, item: dict, context):
+        async with self.limit():
+            return await test(item, context)
+
+    async def test_reports(self, reports: List[dict], contexts: List[ReportContext] = None) -> List[bool]:
+        if contexts is None:
+            contexts = [ReportContext(report) for report in reports]
+        return list(await asyncio.gather(*(self._limited(self.test_report, report, context)
+                                           for report, context in zip(reports, contexts))))
+
+    async def test_pending_accounts(self, accounts: List[dict],
+                                    contexts: List[PendingAccountContext] = None) -> List[bool]:
+        if contexts is None:
+            contexts = [PendingAccountContext(account) for account in accounts]
+        return list(await asyncio.gather(*(self._limited(self.test_pending_account, account, context)
+                                           for account, context in zip(accounts, contexts))))
+
+
+class AsyncJudge:
+    """
+    Mixin giving a Judge coroutine versions of its judging methods.
+
+    Judgements work exactly like their synchronous counterparts, except that
+    AsyncRules are awaited and synchronous rules run in the event loop's
+    default executor. (Not the judge's own executor - synchronous I/O-bound
+    rules already use that internally, and waiting on a pool from one of its
+    own threads can deadlock.)
+    """
+    runs_async_rules = True
+
+    async def _run_rule_async(self, rule: Rule, items: List[dict], contexts: list) -> List[bool]:
+        starttime = time.perf_counter()
+        results = self._match_rule(rule, contexts)
+        if results is None:
+            if isinstance(rule, AsyncRule):
+                results = await self.test_rules(rule, items, contexts)
+            else:
+                loop = asyncio.get_running_loop()
+                results = await loop.run_in_executor(None, self.test_rules, rule, items, contexts)
+        self._record(rule, starttime, results)
+        return results
+
+    async def make_judgements_async(self, items: List[dict], exhaustive: bool = None) -> List[tuple]:
+        """
+        Judge a batch of data. See Judge.make_judgements.
+        """
+        judgement = self._judge(items, exhaustive)
+        try:
+            step = next(judgement)
+            while True:
+                step = judgement.send(await self._run_rule_async(*step))
+        except StopIteration as done:
+            return done.value
+
+    async def make_judgement_async(self, data: dict, exhaustive: bool = None) -> tuple:
+        """
+        Judge some data. See Judge.make_judgement.
+        """
+        return (await self.make_judgements_async([data], exhaustive))[0]
+
+
+class AsyncReportJudge(AsyncJudge, ReportJudge):
+    pass
+
+
+class AsyncPendingAccountJudge(AsyncJudge, PendingAccountJudge):
+    pass
+
+
+class AsyncIvory(Ivory):
+    """
+    Ivory, running its moderation passes on an asyncio event loop.
+
+    Mastodon.py is synchronous, so API calls (fetching queues and punishing)
+    run in the event loop's default thread pool.
+    """
+    report_judge_class = AsyncReportJudge
+    pending_account_judge_class = AsyncPendingAccountJudge
+
+    def __init__(self, *args, **kwargs):
+        # each event loop's locks on each queue's judge
+        self._async_locks = {}
+        Ivory.__init__(self, *args, **kwargs)
+
+    @asynccontextmanager
+    async def judging_async(self, *queues):
+        """
+        Hold the given queues' judges for the length of the block. See
+        Ivory.judging, whose thread locks don't keep out other coroutines on
+        the same thread.
+        """
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_locks:
+            # like semaphores, locks belong to one event loop
+            self._async_locks = {loop: {queue: asyncio.Lock() for queue in
+                                        (constants.QUEUE_REPORTS, constants.QUEUE_PENDING_ACCOUNTS)}}
+        locks = self._async_locks[loop]
+        async with AsyncExitStack() as stack:
+            for queue in (constants.QUEUE_REPORTS, constants.QUEUE_PENDING_ACCOUNTS):
+                if queue in queues:
+                    await stack.enter_async_context(locks[queue])
+            yield
+
+    async def reload_config_async(self) -> bool:
+        """
+        Reload the config (see Ivory.reload_config), waiting for any passes
+        in progress to finish before swapping their judges' rules out.
+        """
+        if not self.config_changed():
+            return False
+        async with self.judging_async(constants.QUEUE_REPORTS, constants.QUEUE_PENDING_ACCOUNTS):
+            return self.reload_config()
+
+    async def _call(self, func, *args, **kwargs):
+        """
+        Run a blocking function without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    async def pages_async(self, fetch, *args, **kwargs):
+        """
+        Walk every page of a paginated API call. See Ivory.pages.
+        """
+        page = await self._call(fetch, *args, **kwargs)
+        while page:
+            next_page = asyncio.ensure_future(self._call(self._api.fetch_next, page))
+            try:
+                yield page
+            except GeneratorExit:
+                next_page.cancel()
+                raise
+            page = await next_page
+
+    async def queue_pages_async(self, queue: str, budget: PassBudget, fetch, *args, outcomes: list = None,
+                                **kwargs):
+        """
+        Walk the pages of a queue, yielding only items that need handling this
+        pass, until the budget runs out. See Ivory.queue_pages.
+        """
+        outcomes = [] if outcomes is None else outcomes
+        (cursor, full, newest) = self.start_queue(queue, kwargs)
+        async for page in self.pages_async(fetch, *args, **kwargs):
+            budget.spend()
+            new = self.new_items(cursor, full, page)
+            newest = self.newest_id(newest, new)
+            if new:
+                yield new
+            if len(new) < len(page):
+                break
+            if budget.exhausted():
+                await self.settle_outcomes(outcomes)
+                self.pause_queue(queue, page, self.newest_settled(newest, outcomes), full)
+                return
+        await self.settle_outcomes(outcomes)
+        self.finish_queue(queue, self.newest_settled(newest, outcomes), full)
+
+    async def settle_outcomes(self, outcomes: list):
+        """
+        Wait for a pass's (items, Future) punishment pairs to be done.
+        """
+        await asyncio.gather(*(asyncio.wrap_future(outcome) for (_, outcome) in outcomes))
+
+    async def judge_items_async(self, judge: AsyncJudge, items: list) -> list:
+        """
+        Judge a batch of items, in the process pool if there is one.
+        """
+        if self.process_pool is not None and items:
+            return await self._call(self.process_pool.make_judgements, judge, items)
+        return await judge.make_judgements_async(items)
+
+    async def handle_unresolved_reports_async(self, budget: PassBudget = None) -> int:
+        """
+        Handles all unresolved reports, a page at a time. See
+        Ivory.handle_unresolved_reports.
+        """
+        if budget is None:
+            budget = self.new_budget()
+        depth = 0
+        outcomes = []
+        async for page in self.queue_pages_async(constants.QUEUE_REPORTS, budget, self._api.admin_reports,
+                                                 outcomes=outcomes):
+            reports = self.unjudged(constants.QUEUE_REPORTS, self.report_judge, page)
+            groups = self.prioritize_reports(self.group_reports(reports), budget)
+            judgements = await self.judge_items_async(self.report_judge, [report for (report, _) in groups])
+            handled = await asyncio.gather(*(self._call(self.handle_report, report, judgement, group)
+                                             for (report, group), judgement in zip(groups, judgements)))
+            punished = [(group, outcome) for ((_, group), outcome) in zip(groups, handled)
+                        if outcome is not None]
+            budget.spend(len(punished))
+            outcomes.extend(punished)
+            depth += len(reports)
+        return depth
+
+    async def handle_pending_accounts_async(self, budget: PassBudget = None) -> int:
+        """
+        Handle all accounts in the pending account queue, a page at a time.
+        See Ivory.handle_unresolved_reports.
+        """
+        if budget is None:
+            budget = self.new_budget()
+        depth = 0
+        outcomes = []
+        async for page in self.queue_pages_async(constants.QUEUE_PENDING_ACCOUNTS, budget,
+                                                 self._api.admin_accounts, status="pending", outcomes=outcomes):
+            accounts = self.unjudged(constants.QUEUE_PENDING_ACCOUNTS, self.pending_account_judge, page)
+            judgements = await self.judge_items_async(self.pending_account_judge, accounts)
+            handled = await asyncio.gather(*(self._call(self.handle_pending_account, account, judgement)
+                                             for account, judgement in zip(accounts, judgements)))
+            punished = [([account], outcome) for (account, outcome) in zip(accounts, handled)
+                        if outcome is not None]
+            budget.spend(len(punished))
+            outcomes.extend(punished)
+            depth += len(accounts)
+        return depth
+
+    async def handle_queue_async(self, queue: str, budget: PassBudget = None) -> int:
+        """
+        Run one pass over a queue. See Ivory.handle_queue.
+        """
+        if queue == constants.QUEUE_REPORTS:
+            return await self.handle_unresolved_reports_async(budget)
+        return await self.handle_pending_accounts_async(budget)
+
+    async def run_async(self):
+        """
+        Run one moderation pass, handling both queues at once.
+        """
+        await self.reload_config_async()
+        self.prune()
+        self._logger.info("starting moderation pass")
+        # the queues run at once, sharing the pass's budget
+        budget = self.new_budget()
+        async with self.judging_async(constants.QUEUE_REPORTS, constants.QUEUE_PENDING_ACCOUNTS):
+            queues = []
+            if self.report_judge:
+                queues.append(self.handle_unresolved_reports_async(budget))
+            if self.pending_account_judge:
+                queues.append(self.handle_pending_accounts_async(budget))
+            try:
+                await asyncio.gather(*queues)
+                self._logger.info("moderation pass complete")
+                self.update_rule_order()
+            except MastodonError:
+                self._logger.exception(
+                    "enountered an API error. waiting %d seconds to try again", self.wait_time)
+
+    async def run_queue_async(self, queue: str) -> float:
+        """
+        Run one pass over a queue, adapting its schedule to how it went. See
+        Ivory.run_queue.
+        """
+        await self.reload_config_async()
+        self.prune()
+        loop = asyncio.get_running_loop()
+        async with self.judging_async(queue):
+            judge = self.judge_for(queue)
+            if judge is None:
+                return self.schedules[queue].interval
+            self._logger.info("starting %s pass", queue)
+            starttime = loop.time()
+            depth = 0
+            try:
+                depth = await self.handle_queue_async(queue)
+                self._logger.info("%s pass complete", queue)
+                self.update_rule_order([judge])
+            except MastodonError:
+                self._logger.exception("enountered an API error in %s. trying again next pass", queue)
+        return self.schedule_next(queue, depth, loop.time() - starttime)
+
+    async def watch_queue_async(self, queue: str):
+        """
+        Run passes over a queue on its own schedule, forever.
+        """
+        while True:
+            await asyncio.sleep(await self.run_queue_async(queue))
+
+    async def watch_async(self):
+        """
+        Runs each queue on a loop, on its own schedule. See Ivory.watch.
+        """
+        loop = asyncio.get_running_loop()
+        if self.config_path is not None and hasattr(signal, "SIGHUP"):
+            loop.add_signal_handler(signal.SIGHUP, self.request_reload)
+        await asyncio.gather(self.watch_queue_async(constants.QUEUE_REPORTS),
+                             self.watch_queue_async(constants.QUEUE_PENDING_ACCOUNTS))
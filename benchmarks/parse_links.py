@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Benchmark util.parse_links against the BeautifulSoup implementation it
+replaced, on a corpus of status HTML shaped like Mastodon's.
+
+Run from the repository root:
+
+    python benchmarks/parse_links.py [--statuses N] [--repeat N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import util  # noqa: E402
+
+STATUSES = [
+    '<p>just had the best coffee of my life, no links here</p>',
+    '<p><span class="h-card"><a href="https://example.com/@alice" class="u-url mention">'
+    '@<span>alice</span></a></span> agreed! <a href="https://example.com/tags/coffee" '
+    'class="mention hashtag" rel="tag">#<span>coffee</span></a></p>',
+    '<p>BUY NOW <a href="https://evil.example/deal?utm_source=spam&amp;id=12" rel="nofollow noopener" '
+    'target="_blank"><span class="invisible">https://</span><span class="ellipsis">evil.example/deal'
+    '</span><span class="invisible">?utm_source=spam&amp;id=12</span></a></p><p>limited time</p>',
+    '<p>' + 'lorem ipsum dolor sit amet ' * 20 + '<a href="https://example.org/long">read more</a></p>',
+    '<p>line one<br />line two<br /><a href="https://a.example">a</a> <a href="https://b.example">b</a> '
+    '<a href="https://c.example">c</a></p>',
+]
+
+
+def bs4_parse_links(text: str):
+    from bs4 import BeautifulSoup
+    return [a.get('href') for a in BeautifulSoup(text, "html.parser").find_all('a')]
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument("--statuses", type=int, default=1000, help="statuses per run (default 1000)")
+    argparser.add_argument("--repeat", type=int, default=5, help="runs to take the best of (default 5)")
+    args = argparser.parse_args()
+    corpus = [STATUSES[index % len(STATUSES)] for index in range(args.statuses)]
+
+    implementations = [("util.parse_links", util.parse_links)]
+    try:
+        import bs4  # noqa: F401
+    except ImportError:
+        print("BeautifulSoup isn't installed; only timing util.parse_links")
+    else:
+        for text in STATUSES:
+            assert util.parse_links(text) == bs4_parse_links(text), text
+        implementations.append(("BeautifulSoup", bs4_parse_links))
+
+    results = {}
+    for (name, parse) in implementations:
+        best = min(timeit.repeat(lambda: [parse(text) for text in corpus], number=1, repeat=args.repeat))
+        results[name] = best
+        print("{:<20} {:8.2f} ms  ({:.1f} us/status)".format(name, best * 1000, best / len(corpus) * 1e6))
+    if "BeautifulSoup" in results:
+        print("speedup: {:.1f}x".format(results["BeautifulSoup"] / results["util.parse_links"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Domain blocklists, for rules that check hostnames against lists too big to
+write as regexes.
+
+A DomainSet holds blocked domains in a hashed set, so checking a hostname
+means looking up it and each of its parent domains - one lookup per label, no
+matter how long the list is. Blocking a domain blocks its subdomains too.
+
+Blocklist files are loaded through load_domain_file, which keeps one copy of
+each file for the whole process (reloading it if it changes), so every rule
+using a list shares it - a reports rule checking links and a pending accounts
+rule checking email domains included.
+"""
+import logging
+import os
+import threading
+from typing import Iterable
+
+import util
+
+_logger = logging.getLogger(__name__)
+
+# Loaded blocklist files, by path, as ((mtime, size), DomainSet) pairs
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def parse_domain(line: str):
+    """
+    Get the domain out of a line of a blocklist file, or None if there isn't
+    one.
+
+    Besides one domain per line, this understands hosts files ("0.0.0.0
+    evil.example"), wildcards ("*.evil.example") and Adblock-style domain
+    rules ("||evil.example^"). Anything after a # is a comment.
+    """
+    line = line.split("#", 1)[0].strip()
+    if not line:
+        return None
+    # hosts files put the address first
+    domain = line.split()[-1]
+    if domain.startswith("||"):
+        domain = domain[2:].rstrip("^")
+    domain = util.normalize_hostname(domain.lstrip("*").lstrip("."))
+    if not domain or domain == "localhost":
+        return None
+    return domain
+
+
+class DomainSet:
+    """
+    A set of blocked domains, matching the domains and all their subdomains.
+    """
+
+    def __init__(self, domains: Iterable[str] = ()):
+        self._domains = set()
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain: str):
+        domain = util.normalize_hostname(domain)
+        if domain:
+            self._domains.add(domain)
+
+    def match(self, hostname: str):
+        """
+        Get the blocked domain a hostname is or is under, or None if it isn't
+        blocked.
+        """
+        if not hostname:
+            return None
+        hostname = util.normalize_hostname(hostname)
+        start = 0
+        while True:
+            if hostname[start:] in self._domains:
+                return hostname[start:]
+            start = hostname.find(".", start) + 1
+            if not start:
+                return None
+
+    def __contains__(self, hostname: str):
+        return self.match(hostname) is not None
+
+    def __len__(self):
+        return len(self._domains)
+
+    @classmethod
+    def from_file(cls, path: str):
+        """
+        Load a blocklist file (see parse_domain for the formats it takes).
+        """
+        domains = cls()
+        with open(path, encoding="utf-8", errors="replace") as blocklist:
+            for line in blocklist:
+                domain = parse_domain(line)
+                if domain is not None:
+                    domains._domains.add(domain)
+        return domains
+
+
+def load_domain_file(path: str) -> DomainSet:
+    """
+    Get the DomainSet for a blocklist file, loading it if this process hasn't
+    yet or it's changed since.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime, stat.st_size)
+    with _loaded_lock:
+        loaded = _loaded.get(path)
+        if loaded is not None and loaded[0] == stamp:
+            return loaded[1]
+        domains = DomainSet.from_file(path)
+        _loaded[path] = (stamp, domains)
+    _logger.info("loaded %d blocked domains from %s", len(domains), path)
+    return domains
@@ -0,0 +1,271 @@
+"""
+Prebuilt blocklist index files.
+
+Parsing a big blocklist takes a while, and every process that does it ends up
+with its own copy. `python . index build` compiles domain, email and IP lists
+into one binary index file instead, which rules open with mmap: nothing is
+parsed on startup, and every process reading the file shares the same pages of
+the OS's page cache.
+
+Each list is stored as a section holding a sorted array of 64-bit key hashes,
+searched with a binary search, in front of which sits a small Bloom filter so
+most lookups for keys that aren't there never touch the array. (Keys are only
+stored as hashes, so a key has a roughly 1 in 2^64 chance of matching by
+accident.)
+
+Builds write to a temporary file and rename it into place, so readers never see
+a half-written index; open_index notices the new file and switches to it, while
+anything still using the old one keeps working until it's done.
+"""
+import argparse
+import hashlib
+import ipaddress
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from typing import List
+
+import util
+from blocklist import parse_domain
+
+# Index sections, one per kind of list
+SECTION_DOMAINS = "domains"
+SECTION_EMAILS = "emails"
+SECTION_IPS = "ips"
+SECTIONS = (SECTION_DOMAINS, SECTION_EMAILS, SECTION_IPS)
+
+MAGIC = b"IVBI"
+FORMAT_VERSION = 1
+# magic, format version, section count
+HEADER = struct.Struct("<4sII")
+# name, key count, keys offset, Bloom filter offset, Bloom filter bits, hashes
+SECTION = struct.Struct("<16sQQQQQ")
+KEY = struct.Struct("<Q")
+# Bloom filter bits per key, and how many bits each key sets
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASHES = 7
+
+_logger = logging.getLogger(__name__)
+
+# Open indexes, by path, as ((inode, mtime, size), BlocklistIndex) pairs
+_opened = {}
+_opened_lock = threading.Lock()
+
+
+def normalize_email(line: str):
+    line = line.split("#", 1)[0].strip().lower()
+    return line if "@" in line else None
+
+
+def normalize_ip(line: str):
+    line = line.split("#", 1)[0].strip()
+    try:
+        return str(ipaddress.ip_address(line))
+    except ValueError:
+        return None
+
+
+# How each section's keys are read out of list files and looked up
+NORMALIZERS = {
+    SECTION_DOMAINS: parse_domain,
+    SECTION_EMAILS: normalize_email,
+    SECTION_IPS: normalize_ip,
+}
+
+
+def key_hash(key: str) -> tuple:
+    """
+    Hash a key into the 64-bit value stored in the index and the two 64-bit
+    values its Bloom filter bits are derived from.
+    """
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=24).digest()
+    return struct.unpack("<QQQ", digest)
+
+
+def bloom_positions(h1: int, h2: int, bits: int, hashes: int):
+    return ((h1 + i * h2) % bits for i in range(hashes))
+
+
+def build_index(path: str, lists: dict):
+    """
+    Write an index of the given lists ({section: iterable of keys}, with keys
+    already normalized) to path, replacing whatever was there atomically.
+    """
+    sections = []
+    for name in SECTIONS:
+        hashes = {}
+        for key in lists.get(name, ()):
+            (stored, h1, h2) = key_hash(key)
+            hashes[stored] = (h1, h2)
+        sections.append((name, hashes))
+    # lay out the header, then the section table, then each section's keys and
+    # Bloom filter
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for (name, hashes) in sections:
+        keys_offset = offset
+        offset += KEY.size * len(hashes)
+        bloom_bits = max(64, BLOOM_BITS_PER_KEY * len(hashes))
+        bloom_bits += -bloom_bits % 8
+        table.append((name, len(hashes), keys_offset, offset, bloom_bits))
+        offset += bloom_bits // 8
+    directory = os.path.dirname(os.path.abspath(path))
+    (handle, temp_path) = tempfile.mkstemp(prefix=".index-", dir=directory)
+    try:
+        with os.fdopen(handle, "wb") as index:
+            index.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(sections)))
+            for (name, count, keys_offset, bloom_offset, bloom_bits) in table:
+                index.write(SECTION.pack(name.encode("ascii"), count, keys_offset, bloom_offset,
+                                         bloom_bits, BLOOM_HASHES))
+            for ((_, hashes), (_, _, _, _, bloom_bits)) in zip(sections, table):
+                index.write(b"".join(KEY.pack(stored) for stored in sorted(hashes)))
+                bloom = bytearray(bloom_bits // 8)
+                for (h1, h2) in hashes.values():
+                    for position in bloom_positions(h1, h2, bloom_bits, BLOOM_HASHES):
+                        bloom[position >> 3] |= 1 << (position & 7)
+                index.write(bloom)
+            index.flush()
+            os.fsync(index.fileno())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def read_list(path: str, section: str) -> List[str]:
+    """
+    Read the keys out of a list file for a section (see NORMALIZERS).
+    """
+    normalize = NORMALIZERS[section]
+    keys = []
+    with open(path, encoding="utf-8", errors="replace") as blocklist:
+        for line in blocklist:
+            key = normalize(line)
+            if key is not None:
+                keys.append(key)
+    return keys
+
+
+class BlocklistIndex:
+    """
+    A read-only, memory-mapped blocklist index.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as index:
+            self._map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, count) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("{} isn't a blocklist index Ivory can read".format(path))
+        self._sections = {}
+        for position in range(count):
+            (name, *layout) = SECTION.unpack_from(self._map, HEADER.size + SECTION.size * position)
+            self._sections[name.rstrip(b"\0").decode("ascii")] = layout
+
+    def __len__(self):
+        return sum(layout[0] for layout in self._sections.values())
+
+    def count(self, section: str) -> int:
+        return self._sections[section][0] if section in self._sections else 0
+
+    def contains(self, section: str, key: str) -> bool:
+        """
+        Check whether a (normalized) key is in one of the index's lists.
+        """
+        layout = self._sections.get(section)
+        if layout is None or not layout[0]:
+            return False
+        (count, keys_offset, bloom_offset, bloom_bits, hashes) = layout
+        (stored, h1, h2) = key_hash(key)
+        index = self._map
+        for position in bloom_positions(h1, h2, bloom_bits, hashes):
+            if not index[bloom_offset + (position >> 3)] & (1 << (position & 7)):
+                return False
+        (low, high) = (0, count)
+        while low < high:
+            middle = (low + high) // 2
+            (candidate,) = KEY.unpack_from(index, keys_offset + KEY.size * middle)
+            if candidate == stored:
+                return True
+            if candidate < stored:
+                low = middle + 1
+            else:
+                high = middle
+        return False
+
+    def match_domain(self, hostname: str):
+        """
+        Get the blocked domain a hostname is or is under, or None if it isn't
+        blocked. See DomainSet.match.
+        """
+        if not hostname:
+            return None
+        hostname = util.normalize_hostname(hostname)
+        start = 0
+        while True:
+            if self.contains(SECTION_DOMAINS, hostname[start:]):
+                return hostname[start:]
+            start = hostname.find(".", start) + 1
+            if not start:
+                return None
+
+    def __contains__(self, hostname: str):
+        # lets an index stand in for a DomainSet
+        return self.match_domain(hostname) is not None
+
+    def has_email(self, email: str) -> bool:
+        return bool(email) and self.contains(SECTION_EMAILS, email.strip().lower())
+
+    def has_ip(self, ip: str) -> bool:
+        key = normalize_ip(ip or "")
+        return key is not None and self.contains(SECTION_IPS, key)
+
+
+def open_index(path: str) -> BlocklistIndex:
+    """
+    Get the open index for a path, opening it if this process hasn't yet or a
+    new one has been built there since.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = (stat.st_ino, stat.st_mtime, stat.st_size)
+    with _opened_lock:
+        opened = _opened.get(path)
+        if opened is not None and opened[0] == stamp:
+            return opened[1]
+        index = BlocklistIndex(path)
+        _opened[path] = (stamp, index)
+    _logger.info("opened blocklist index %s (%d entries)", path, len(index))
+    return index
+
+
+def main(argv: List[str] = None):
+    """
+    The `python . index` command.
+    """
+    argparser = argparse.ArgumentParser(prog="ivory index", description="Manage blocklist index files.")
+    commands = argparser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Compile blocklists into an index file")
+    build.add_argument("output", help="Path to write the index to")
+    build.add_argument("--domains", nargs="+", default=[], metavar="FILE", help="Domain blocklist files")
+    build.add_argument("--emails", nargs="+", default=[], metavar="FILE", help="Email address blocklist files")
+    build.add_argument("--ips", nargs="+", default=[], metavar="FILE", help="IP address blocklist files")
+    args = argparser.parse_args(argv)
+    lists = {}
+    for (section, paths) in ((SECTION_DOMAINS, args.domains), (SECTION_EMAILS, args.emails),
+                             (SECTION_IPS, args.ips)):
+        lists[section] = [key for path in paths for key in read_list(path, section)]
+    build_index(args.output, lists)
+    index = BlocklistIndex(args.output)
+    print("wrote {}: {}".format(args.output, ", ".join(
+        "{} {}".format(index.count(section), section) for section in SECTIONS)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -8,9 +8,108 @@ VERSION = "v1.1.0"
 # Default amount of seconds to wait between report passes
 DEFAULT_WAIT_TIME = 300
 
+# Default number of threads I/O-bound rules get to share
+DEFAULT_WORKERS = 1
+
+# Default number of passes that run at once when moderating several instances
+DEFAULT_PASS_WORKERS = 2
+
+# Default number of processes judging runs in (1 judges in Ivory's own)
+DEFAULT_PROCESSES = 1
+
+# How many items are sent to a judging process at once
+PROCESS_CHUNK_SIZE = 20
+
+# Default number of items an async rule tests at once
+DEFAULT_RULE_CONCURRENCY = 10
+
 # Default configuration path to use when no path is manually specified
 DEFAULT_CONFIG_PATH = "config.json"
 
+# Queue names, as used in the config and the ledger
+QUEUE_REPORTS = "reports"
+QUEUE_PENDING_ACCOUNTS = "pendingAccounts"
+
+# How long the ledger remembers judged items, in seconds
+LEDGER_MAX_AGE = 30 * 24 * 60 * 60
+# How often long-running Ivory processes forget entries older than that
+LEDGER_PRUNE_INTERVAL = 24 * 60 * 60
+
+# Default seconds between full sweeps of the queues when polling incrementally
+DEFAULT_FULL_SWEEP_INTERVAL = 60 * 60
+
+# Default number of threads carrying out punishments
+DEFAULT_DISPATCH_WORKERS = 1
+
+# Default number of times to try a punishment before leaving it for next pass
+DEFAULT_DISPATCH_MAX_TRIES = 3
+
+# Seconds the first retry of a failed punishment waits (at most), doubling
+# with every retry after that
+DISPATCH_BACKOFF = 1.0
+
+# How many punishments can be waiting to be carried out before judging waits
+DISPATCH_QUEUE_SIZE = 100
+
+# Once fewer API calls than this are left in the current rate limit window,
+# the dispatcher spreads the rest evenly over the window
+DISPATCH_RATELIMIT_RESERVE = 30
+
+# Defaults for serve mode: where to listen for webhooks, and how often to poll
+# the queues for anything they missed
+DEFAULT_WEBHOOK_HOST = "127.0.0.1"
+DEFAULT_WEBHOOK_PORT = 8000
+DEFAULT_RECONCILE_INTERVAL = 60 * 60
+# The biggest webhook delivery serve mode accepts, in bytes
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+# Webhook events Ivory handles
+EVENT_REPORT_CREATED = "report.created"
+EVENT_ACCOUNT_CREATED = "account.created"
+
+# Defaults for the work queue shared by fetch and work mode: how long a worker
+# holds the items it leases, how many it leases at once, and how long an idle
+# worker waits before checking for more
+DEFAULT_WORK_LEASE_TIME = 5 * 60
+DEFAULT_WORK_BATCH_SIZE = 20
+WORK_POLL_INTERVAL = 5
+
+# How long the work queue keeps another worker from repeating a punishment
+WORK_ACTION_MEMORY = 24 * 60 * 60
+
+# Kinds of links in a status, as told apart by Mastodon's markup
+LINK_MENTION = "mention"
+LINK_HASHTAG = "hashtag"
+LINK_EXTERNAL = "external"
+
+# Query parameters that only track where a click came from, dropped from links
+# before rules check them. Parameters starting with TRACKING_PARAM_PREFIXES
+# are dropped too.
+TRACKING_PARAMS = frozenset((
+    "fbclid", "gclid", "dclid", "msclkid", "yclid", "igshid", "mc_cid", "mc_eid",
+    "_hsenc", "_hsmi", "mkt_tok", "ref_src", "ref_url", "si", "spm",
+))
+TRACKING_PARAM_PREFIXES = ("utm_",)
+
+# How many resolved links link_resolver rules remember, and for how long
+LINK_CACHE_SIZE = 10000
+LINK_CACHE_TTL = 60 * 60
+
+# Defaults for following links in link_resolver rules: seconds to wait for a
+# connection and for a response, how many links are followed at once (in total
+# and per host), and how many timeouts in a row make a host get skipped, and for
+# how many seconds
+DEFAULT_LINK_CONNECT_TIMEOUT = 5
+DEFAULT_LINK_READ_TIMEOUT = 10
+DEFAULT_LINK_CONCURRENCY = 8
+DEFAULT_LINK_HOST_CONCURRENCY = 2
+DEFAULT_LINK_BREAKER_THRESHOLD = 3
+DEFAULT_LINK_BREAKER_COOLDOWN = 5 * 60
+
+# Seconds to wait for a connection to StopForumSpam's API and for its response
+STOPFORUMSPAM_CONNECT_TIMEOUT = 5
+STOPFORUMSPAM_READ_TIMEOUT = 15
+
 # Punishment types
 PUNISH_WARN = "warn"
 PUNISH_REJECT = "reject"
@@ -21,3 +120,16 @@ PUNISH_SUSPEND = "suspend"
 # Command types
 COMMAND_WATCH = "watch"
 COMMAND_ONESHOT = "oneshot"
+COMMAND_SERVE = "serve"
+COMMAND_FETCH = "fetch"
+COMMAND_WORK = "work"
+COMMAND_INDEX = "index"
+
+# Estimated seconds it takes to run a rule, used to order rules within a
+# severity when judges short-circuit until they've timed the rule themselves
+RULE_COST_LOCAL = 0.001
+RULE_COST_NETWORK = 0.5
+
+# How many runs' worth of weight a rule's estimated cost has against its
+# measured run times
+RULE_COST_PRIOR_RUNS = 5
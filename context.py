@@ -0,0 +1,167 @@
+"""
+Per-item contexts the Judge hands to its rules.
+
+A context wraps a single report or pending account and lazily computes the
+features rules look at (links, plain text, hostnames, and so on). Every
+feature is computed at most once per item, and only if some rule asks for it,
+no matter how many rules use it.
+"""
+import unicodedata
+from functools import cached_property
+from urllib.parse import urlsplit
+
+import util
+
+
+def normalize_username(username: str):
+    """
+    Normalize a username for comparison, folding case and compatibility
+    characters (fullwidth letters, ligatures and so on).
+    """
+    return unicodedata.normalize("NFKC", username).casefold()
+
+
+class Context:
+    """
+    Base class for item contexts.
+
+    Subclasses map the names of the text fields RegexRules can search to the
+    names of the properties holding them in their FIELDS dict.
+    """
+    FIELDS = {}
+
+    def __init__(self, data: dict):
+        self.data = data
+        # Rules broken per field, filled in by Judges using combined matchers
+        self.matches = {}
+
+    def texts(self, field: str):
+        """
+        Get the list of texts in a searchable field.
+        """
+        return getattr(self, self.FIELDS[field])
+
+
+class ReportContext(Context):
+    """
+    Lazily computed features of a report.
+    """
+    FIELDS = {
+        "statuses": "status_contents",
+        "bio": "bio_texts",
+        "username": "usernames",
+        "links": "canonical_links",
+    }
+
+    @property
+    def report(self):
+        return self.data
+
+    @property
+    def account(self):
+        """
+        The reported account.
+        """
+        return self.data['target_account']['account']
+
+    @cached_property
+    def status_contents(self):
+        """
+        The raw HTML content of every status in the report.
+        """
+        return [status.get('content', '') for status in self.data.get('statuses', [])]
+
+    @cached_property
+    def status_texts(self):
+        """
+        The plain text of every status in the report.
+        """
+        return [util.html_to_text(content) for content in self.status_contents]
+
+    @cached_property
+    def bio_texts(self):
+        """
+        The reported account's bio text, followed by its profile field values.
+        """
+        return [self.account.get('note')] + [field.get('value') for field in self.account.get('fields', [])]
+
+    @cached_property
+    def username(self):
+        return self.account['username']
+
+    @cached_property
+    def usernames(self):
+        return [self.username]
+
+    @cached_property
+    def normalized_username(self):
+        return normalize_username(self.username)
+
+    @cached_property
+    def links(self):
+        """
+        Every link in the report's statuses.
+        """
+        return util.parse_links_from_statuses(self.data['statuses'])
+
+    @cached_property
+    def canonical_links(self):
+        """
+        The distinct links in the report's statuses, in canonical form (see
+        util.canonicalize_url).
+        """
+        return util.canonical_links(self.links)
+
+    @cached_property
+    def hostnames(self):
+        """
+        The distinct hostnames of the report's links, in the order they first
+        appear.
+        """
+        hostnames = (urlsplit(link).hostname for link in self.canonical_links)
+        return list(dict.fromkeys(hostname for hostname in hostnames if hostname))
+
+
+class PendingAccountContext(Context):
+    """
+    Lazily computed features of a pending account.
+    """
+    FIELDS = {
+        "invite_request": "invite_requests",
+        "username": "usernames",
+    }
+
+    @property
+    def account(self):
+        return self.data
+
+    @cached_property
+    def invite_requests(self):
+        """
+        The account's join reason, as a list. Empty if it doesn't have one.
+        """
+        if 'invite_request' not in self.data:
+            return []
+        return [str(self.data.get('invite_request'))]
+
+    @cached_property
+    def username(self):
+        return self.data['username']
+
+    @cached_property
+    def usernames(self):
+        return [self.username]
+
+    @cached_property
+    def normalized_username(self):
+        return normalize_username(self.username)
+
+    @cached_property
+    def email_domain(self):
+        """
+        The lower-cased domain part of the account's email address, or None.
+        """
+        email = self.data.get('email') or ""
+        if "@" not in email:
+            return None
+        return email.rsplit("@", 1)[1].lower()
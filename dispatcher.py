@@ -0,0 +1,144 @@
+"""
+The dispatcher, which carries out moderation actions in the background.
+
+Judging a queue shouldn't have to wait on a slow moderation endpoint, so Ivory
+hands each API call to a Dispatcher instead of making it inline. The
+dispatcher's worker threads make the calls (sharing the Mastodon API wrapper's
+keep-alive connection pool), slow down when the instance's rate limit is
+running low, and retry transient failures with exponential backoff and jitter.
+"""
+import logging
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from mastodon import MastodonNetworkError, MastodonRatelimitError, MastodonServerError
+
+import constants
+
+# Errors worth trying the call again for
+TRANSIENT_ERRORS = (MastodonNetworkError, MastodonRatelimitError, MastodonServerError)
+
+
+class Dispatcher:
+    """
+    Makes API calls on a pool of worker threads, fed by a bounded queue.
+
+    submit() only blocks if the queue is full, which keeps a fast judge from
+    getting arbitrarily far ahead of the API.
+    """
+
+    def __init__(self, api, workers: int = constants.DEFAULT_DISPATCH_WORKERS,
+                 max_tries: int = constants.DEFAULT_DISPATCH_MAX_TRIES,
+                 backoff: float = constants.DISPATCH_BACKOFF,
+                 queue_size: int = constants.DISPATCH_QUEUE_SIZE):
+        self._api = api
+        self.max_tries = max_tries
+        self.backoff = backoff
+        self._logger = logging.getLogger(__name__)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        for index in range(workers):
+            thread = threading.Thread(target=self._work, name="ivory-dispatch-{}".format(index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, description: str, func, *args, **kwargs) -> Future:
+        """
+        Queue up an API call.
+
+        Returns a Future that resolves to whether the call succeeded; calls
+        that still fail after max_tries tries are logged and resolve to False.
+        """
+        future = Future()
+        self._queue.put((future, description, func, args, kwargs))
+        return future
+
+    def submit_steps(self, description: str, steps: list) -> Future:
+        """
+        Queue up a series of (func, args, kwargs) API calls to make in order,
+        as one call. Retries pick up from the step that failed, so the steps
+        before it aren't repeated.
+        """
+        return self.submit(description, self._run_steps, list(steps))
+
+    @staticmethod
+    def _run_steps(steps: list):
+        while steps:
+            (func, args, kwargs) = steps[0]
+            func(*args, **kwargs)
+            steps.pop(0)
+
+    def pace(self) -> float:
+        """
+        Get how long to wait before the next call to stay within the
+        instance's rate limit.
+
+        Calls go out at full speed until fewer than DISPATCH_RATELIMIT_RESERVE
+        remain in the current window, then the rest are spread evenly over
+        what's left of it.
+        """
+        remaining = getattr(self._api, "ratelimit_remaining", None)
+        reset = getattr(self._api, "ratelimit_reset", None)
+        if remaining is None or reset is None or remaining >= constants.DISPATCH_RATELIMIT_RESERVE:
+            return 0
+        return max(0, reset - time.time()) / max(remaining, 1)
+
+    def retry_delay(self, tries: int) -> float:
+        """
+        Get how long to wait before retrying a call that has failed this many
+        times: exponential backoff with full jitter.
+        """
+        return random.uniform(0, self.backoff * 2 ** (tries - 1))
+
+    def _call(self, description: str, func, args, kwargs) -> bool:
+        tries = 0
+        while True:
+            delay = self.pace()
+            if delay > 0:
+                self._logger.debug("rate limit running low; waiting %.2f seconds", delay)
+                time.sleep(delay)
+            tries += 1
+            try:
+                func(*args, **kwargs)
+                return True
+            except TRANSIENT_ERRORS:
+                if tries >= self.max_tries:
+                    self._logger.exception("%s failed %d times; giving up until next pass", description, tries)
+                    return False
+                delay = self.retry_delay(tries)
+                self._logger.warning("%s failed; retrying in %.2f seconds", description, delay)
+                time.sleep(delay)
+            except Exception:
+                self._logger.exception("%s failed", description)
+                return False
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                (future, description, func, args, kwargs) = task
+                if future.set_running_or_notify_cancel():
+                    future.set_result(self._call(description, func, args, kwargs))
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """
+        Wait for every queued call to finish.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Finish the queued calls and stop the workers.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
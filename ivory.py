@@ -2,14 +2,26 @@
 Ivory core class file.
 Contains everything you need to run Ivory programmatically.
 """
+import json # for reloading the config
 import logging
+import os # for checking if the config changed
+import signal # for reloading the config on SIGHUP
+import socket # for naming workers
+import threading # for running each queue on its own schedule
 import time # for Ivory.watch()
+from contextlib import ExitStack, contextmanager # for locking judges
+from concurrent.futures import Future, ThreadPoolExecutor, wait # for running I/O-bound rules concurrently
 
-from mastodon import Mastodon, MastodonError, MastodonGatewayTimeoutError # API wrapper lib
+import requests # for the API's connection pool
+from mastodon import Mastodon, MastodonError # API wrapper lib
 
 import constants  # Ivory constants
-from judge import ReportJudge, PendingAccountJudge, Punishment  # Judge to integrate into Ivory
+from dispatcher import Dispatcher
+from judge import Judge, ReportJudge, PendingAccountJudge, Punishment  # Judge to integrate into Ivory
+from ledger import Ledger
+from scheduler import PassBudget, Schedule
 from schemas import IvoryConfig
+from workqueue import WorkQueue
 
 
 class Ivory():
@@ -17,10 +29,19 @@ class Ivory():
     The main Ivory class, which programmatically handles reports pulled from
     the Mastodon API.
     """
+    # Judge types to screen each queue with
+    report_judge_class = ReportJudge
+    pending_account_judge_class = PendingAccountJudge
 
-    def __init__(self, raw_config):
+    def __init__(self, raw_config, config_path: str = None, executor=None, registry=None):
         """
         Runs Ivory.
+
+        If the path the config was loaded from is given, Ivory reloads it
+        between passes whenever the file changes (or on SIGHUP in watch mode).
+
+        An executor for I/O-bound rules and a rule registry can be passed in
+        to share them with other Ivory instances in the same process.
         """
         # **Validate the configuration**
         config = IvoryConfig(raw_config)
@@ -30,24 +51,76 @@ class Ivory():
 
         self._logger.info("Ivory version %s starting", constants.VERSION)
 
-        # **Load Judge and Rules**
-        self._logger.info("parsing rules")
-        if 'reports' in config:
-            self.report_judge = ReportJudge(config['reports'].get("rules"))
+        # I/O-bound rules (link resolution, StopForumSpam lookups) share a
+        # pool of worker threads, if there's more than one worker
+        workers = config.get('workers', constants.DEFAULT_WORKERS)
+        if executor is not None:
+            self.executor = executor
+        elif workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ivory-rule")
+        else:
+            self.executor = None
+        self.registry = registry
+        # CPU-bound judging can be spread over several processes
+        processes = config.get('processes', constants.DEFAULT_PROCESSES)
+        if processes > 1:
+            from process_pool import ProcessJudgePool
+            self.process_pool = ProcessJudgePool(processes)
+        else:
+            self.process_pool = None
+        # Fetches the next page of each queue while the current one is judged
+        self._prefetcher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ivory-fetch")
+
+        # **Open the ledger of judged items, if there is one**
+        if 'ledgerPath' in config:
+            self.ledger = Ledger(config['ledgerPath'])
         else:
-            self._logger.debug("no report rules detected")
-            self.report_judge = None
-        if 'pendingAccounts' in config:
-            self.pending_account_judge = PendingAccountJudge(config['pendingAccounts'].get("rules"))
+            self.ledger = None
+        # **Open the work queue shared with other Ivory processes, if there is one**
+        work_queue_config = config.get('workQueue')
+        if work_queue_config is not None:
+            self.work_queue = WorkQueue(work_queue_config['path'])
+            self.worker_name = work_queue_config.get(
+                'workerName', "{}-{}".format(socket.gethostname(), os.getpid()))
         else:
-            self._logger.debug("no pending account rules detected")
-            self.pending_account_judge = None
+            self.work_queue = None
+            self.worker_name = None
+        # When the ledger and work queue were last pruned (see prune())
+        self._pruned_at = None
+        self._prune_lock = threading.Lock()
+        self.prune()
+        # Each queue's (cursor, last full sweep time), for incremental polling
+        self._cursors = {}
+        # Where each queue's last pass left off, if it ran out of budget
+        self._checkpoints = {}
 
+        # **Load Judge and Rules**
+        # Held while a queue's judge is in use, so a config reload can't swap
+        # its rules out mid-pass (each queue has its own thread in watch mode)
+        self._judge_locks = {queue: threading.RLock()
+                             for queue in (constants.QUEUE_REPORTS, constants.QUEUE_PENDING_ACCOUNTS)}
+        self.report_judge = None
+        self.pending_account_judge = None
+        self.schedules = {}
+        self.config = None
+        self.apply_config(config)
+        self.config_path = config_path
+        self._config_mtime = self._read_config_mtime()
+        self._reload_requested = False
+        self._reload_lock = threading.Lock()
 
         # **Initialize and verify API connectivity**
+        # punishments are carried out by the dispatcher's workers, which
+        # share a pool of keep-alive connections with everything else
+        dispatch_workers = config.get('dispatchWorkers', constants.DEFAULT_DISPATCH_WORKERS)
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=dispatch_workers + 1)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
         self._api = Mastodon(
             access_token=config['token'],
-            api_base_url=config['instanceURL']
+            api_base_url=config['instanceURL'],
+            session=session
         )
         self._logger.debug("mastodon API wrapper initialized")
         # 2.9.1 required for moderation API
@@ -63,124 +136,844 @@ class Ivory():
                           self.instance['uri'], self.user['username'])
         self._logger.debug("instance info: %s", self.instance)
         self._logger.debug("user info: %s", self.user)
+        self.dispatcher = Dispatcher(
+            self._api,
+            workers=dispatch_workers,
+            max_tries=config.get('maxTries', constants.DEFAULT_DISPATCH_MAX_TRIES)
+        )
+
+    def apply_config(self, config: dict):
+        """
+        Apply a validated config's settings and rules.
+
+        Judges that already exist keep any rules whose config hasn't changed;
+        the rest are rebuilt. Connection settings (token, instanceURL,
+        workers) only take effect on restart.
+        """
+        if self.config is not None:
+            for key in ('token', 'instanceURL', 'workers', 'processes', 'ledgerPath', 'dispatchWorkers', 'maxTries'):
+                if config.get(key) != self.config.get(key):
+                    self._logger.warning("%s changed; restart Ivory to apply this", key)
+            if config.get('workQueue', {}).get('path') != self.config.get('workQueue', {}).get('path'):
+                self._logger.warning("workQueue path changed; restart Ivory to apply this")
+        dry_run = config.get('dryRun', False)
+        # Judges only work out every rule an item breaks when auditing or in
+        # dry mode; otherwise they stop once the punishment is decided
+        audit = config.get('audit', False) or dry_run
+
+        self._logger.info("parsing rules")
+        # stage both judges' rules before swapping either in, so a bad rule
+        # leaves everything as it was
+        staged = []
+        for (key, attr, judge_class) in (
+                ('reports', 'report_judge', self.report_judge_class),
+                ('pendingAccounts', 'pending_account_judge', self.pending_account_judge_class)):
+            judge = getattr(self, attr)
+            if key not in config:
+                self._logger.debug("no %s rules detected", key)
+                staged.append((attr, None, None))
+            elif judge is None:
+                staged.append((attr, judge_class(config[key].get("rules"), executor=self.executor,
+                                                 registry=self.registry), None))
+            else:
+                staged.append((attr, judge, judge.stage_rules(config[key].get("rules"))))
+        # wait for any passes in progress to finish first
+        with self.judging(constants.QUEUE_REPORTS, constants.QUEUE_PENDING_ACCOUNTS):
+            self.dry_run = dry_run
+            self.audit = audit
+            for (attr, judge, rules) in staged:
+                if rules is not None:
+                    judge.swap_rules(rules)
+                if judge is not None:
+                    judge.exhaustive = self.audit
+                setattr(self, attr, judge)
 
         # **Set some variables from config**
         if 'waitTime' not in config:
             self._logger.info(
                 "no waittime specified, defaulting to %d seconds", constants.DEFAULT_WAIT_TIME)
         self.wait_time = config.get("waitTime", constants.DEFAULT_WAIT_TIME)
-        self.dry_run = config.get('dryRun', False)
+        # each queue can have its own schedule in watch mode, which adapts
+        # between minWaitTime and maxWaitTime
+        for queue in (constants.QUEUE_REPORTS, constants.QUEUE_PENDING_ACCOUNTS):
+            queue_config = config.get(queue, {})
+            bounds = (queue_config.get("waitTime", self.wait_time),
+                      queue_config.get("minWaitTime"),
+                      queue_config.get("maxWaitTime"))
+            if queue in self.schedules:
+                self.schedules[queue].configure(*bounds)
+            else:
+                self.schedules[queue] = Schedule(*bounds)
+        # Only fetch items newer than the last pass saw, with a full sweep
+        # every so often to catch changes to older ones
+        self.incremental = config.get("incremental", False)
+        self.full_sweep_interval = config.get("fullSweepInterval", constants.DEFAULT_FULL_SWEEP_INTERVAL)
+        # How long and how many API calls a pass gets before it stops and
+        # leaves the rest for the next one
+        self.pass_time_budget = config.get("passTimeBudget")
+        self.pass_call_budget = config.get("passCallBudget")
+        # How long a worker holds the items (and punishments) it takes from
+        # the work queue, and how many items it takes at once
+        work_queue_config = config.get("workQueue", {})
+        self.lease_time = work_queue_config.get("leaseTime", constants.DEFAULT_WORK_LEASE_TIME)
+        self.work_batch_size = work_queue_config.get("batchSize", constants.DEFAULT_WORK_BATCH_SIZE)
+        self.config = config
+
+    def _read_config_mtime(self):
+        if self.config_path is None:
+            return None
+        try:
+            return os.stat(self.config_path).st_mtime
+        except OSError:
+            return None
+
+    def request_reload(self, *args):
+        """
+        Ask Ivory to reload its config before the next pass. Usable as a
+        signal handler.
+        """
+        self._reload_requested = True
+
+    def config_changed(self) -> bool:
+        """
+        Check whether the next reload_config() would reload anything.
+        """
+        return self.config_path is not None and (
+            self._reload_requested or self._read_config_mtime() != self._config_mtime)
+
+    @contextmanager
+    def judging(self, *queues):
+        """
+        Hold the given queues' judges, so their rules and settings stay put
+        until the block is done. Locks are always taken in the same order.
+        """
+        with ExitStack() as stack:
+            for queue in (constants.QUEUE_REPORTS, constants.QUEUE_PENDING_ACCOUNTS):
+                if queue in queues:
+                    stack.enter_context(self._judge_locks[queue])
+            yield
+
+    def reload_config(self):
+        """
+        Reload the config from config_path if it's changed or a reload was
+        requested. A config that fails to load is logged and ignored.
+
+        Returns whether the new config was applied.
+        """
+        if self.config_path is None:
+            return False
+        # in watch mode, every queue checks for changes before its passes
+        with self._reload_lock:
+            mtime = self._read_config_mtime()
+            if not self._reload_requested and mtime == self._config_mtime:
+                return False
+            self._reload_requested = False
+            self._config_mtime = mtime
+            self._logger.info("reloading config from %s", self.config_path)
+            try:
+                with open(self.config_path) as config_file:
+                    config = IvoryConfig(json.load(config_file))
+                self.apply_config(config)
+            except Exception:
+                self._logger.exception("failed to reload config; keeping the old one")
+                return False
+            return True
+
+    def prune(self):
+        """
+        Forget ledger entries and finished work older than LEDGER_MAX_AGE.
+        Passes call this, but it only does anything once every
+        LEDGER_PRUNE_INTERVAL.
+        """
+        with self._prune_lock:
+            now = time.monotonic()
+            if self._pruned_at is not None and now - self._pruned_at < constants.LEDGER_PRUNE_INTERVAL:
+                return
+            self._pruned_at = now
+        if self.ledger is not None:
+            self.ledger.prune(constants.LEDGER_MAX_AGE)
+        if self.work_queue is not None:
+            self.work_queue.prune(constants.LEDGER_MAX_AGE)
 
+    def unjudged(self, queue: str, judge: Judge, items: list) -> list:
+        """
+        Filter out items the ledger says the judge's current rules have
+        already handled in their current form.
+        """
+        if self.ledger is None:
+            return items
+        unjudged = self.ledger.unjudged(queue, items, judge.version())
+        if len(unjudged) < len(items):
+            self._logger.debug("skipping %d already judged items", len(items) - len(unjudged))
+        return unjudged
+
+    def record(self, queue: str, judge: Judge, item: dict, punishment: Punishment, handled: bool):
+        """
+        Record a judged item in the ledger, unless its punishment wasn't
+        carried out (in which case it'll be retried next pass).
+        """
+        if self.ledger is not None and handled:
+            self.ledger.record(queue, item, judge.version(), punishment)
+
+    def pages(self, fetch, *args, **kwargs):
+        """
+        Walk every page of a paginated API call, yielding one page at a time.
+
+        The next page is fetched in the background while the caller works on
+        the current one, and no more than those two pages are held at once.
+        """
+        page = fetch(*args, **kwargs)
+        while page:
+            next_page = self._prefetcher.submit(self._api.fetch_next, page)
+            yield page
+            page = next_page.result()
+
+    def get_cursor(self, queue: str) -> tuple:
+        """
+        Get a queue's (cursor, last full sweep time), where the cursor is the
+        newest item id seen. Either may be None.
+        """
+        if queue not in self._cursors:
+            self._cursors[queue] = self.ledger.get_cursor(queue) if self.ledger is not None else (None, None)
+        return self._cursors[queue]
 
-    def handle_unresolved_reports(self):
+    def set_cursor(self, queue: str, cursor: int, swept_at: float):
         """
-        Handles all unresolved reports.
+        Save a queue's cursor and last full sweep time, to the ledger if there
+        is one.
         """
-        reports = self._api.admin_reports()
+        self._cursors[queue] = (cursor, swept_at)
+        if self.ledger is not None:
+            self.ledger.set_cursor(queue, cursor, swept_at)
+
+    def get_checkpoint(self, queue: str):
+        """
+        Get where the last pass over a queue left off, as (resume_id, newest,
+        full), or None if it finished.
+        """
+        if queue not in self._checkpoints:
+            self._checkpoints[queue] = self.ledger.get_checkpoint(queue) if self.ledger is not None else None
+        return self._checkpoints[queue]
+
+    def set_checkpoint(self, queue: str, checkpoint: tuple = None):
+        """
+        Save (or clear, if checkpoint is None) where a pass over a queue left
+        off, to the ledger if there is one.
+        """
+        self._checkpoints[queue] = checkpoint
+        if self.ledger is not None:
+            self.ledger.set_checkpoint(queue, checkpoint)
+
+    def new_budget(self) -> PassBudget:
+        """
+        Get a fresh budget for a pass.
+        """
+        return PassBudget(self.pass_time_budget, self.pass_call_budget)
+
+    def start_queue(self, queue: str, kwargs: dict) -> tuple:
+        """
+        Work out how much of a queue to fetch this pass, adding since_id to the
+        fetch's kwargs if only new items are needed and max_id if the last pass
+        ran out of budget partway through.
+
+        Returns (cursor, full, newest), where cursor is the id items must be
+        newer than to be new (or None to take everything), full is whether
+        this pass is a full sweep, and newest is the newest id seen so far.
+        """
+        (cursor, swept_at) = self.get_cursor(queue)
+        checkpoint = self.get_checkpoint(queue)
+        if checkpoint is not None:
+            (resume_id, newest, full) = checkpoint
+            self._logger.info("resuming %s from #%s", queue, resume_id)
+            kwargs['max_id'] = resume_id
+        else:
+            newest = cursor
+            full = (not self.incremental or cursor is None or swept_at is None
+                    or time.time() - swept_at >= self.full_sweep_interval)
+        if full:
+            self._logger.debug("sweeping all of %s", queue)
+        else:
+            self._logger.debug("fetching %s newer than #%s", queue, cursor)
+            kwargs['since_id'] = cursor
+        return (cursor, full, newest)
+
+    def new_items(self, cursor: int, full: bool, page: list) -> list:
+        """
+        Get the items in a page newer than the cursor (or all of them in a
+        full sweep).
+        """
+        if full or cursor is None:
+            return page
+        return [item for item in page if int(item['id']) > cursor]
+
+    def newest_id(self, cursor: int, items: list) -> int:
+        """
+        Get the newest of a cursor and some items' ids.
+        """
+        ids = [int(item['id']) for item in items]
+        if cursor is not None:
+            ids.append(cursor)
+        return max(ids, default=None)
+
+    def newest_settled(self, newest: int, outcomes: list) -> int:
+        """
+        Hold a pass's newest id back below any items whose punishments
+        failed, so the cursor doesn't move past them and the next pass picks
+        them up again. outcomes is a list of (items, Future from punish())
+        pairs, all of which must be done.
+        """
+        failed = [int(item['id']) for (items, outcome) in outcomes if not outcome.result() for item in items]
+        if failed and newest is not None:
+            newest = min(newest, min(failed) - 1)
+        return newest
+
+    def finish_queue(self, queue: str, newest: int, full: bool):
+        """
+        Move a queue's cursor up to the newest item seen in a complete pass.
+
+        Queues are fetched newest first, so the cursor only moves once a pass
+        is done - otherwise a pass that failed partway through would skip the
+        older new items it hadn't reached yet.
+        """
+        (_, swept_at) = self.get_cursor(queue)
+        self.set_cursor(queue, newest, time.time() if full else swept_at)
+        self.set_checkpoint(queue, None)
+
+    def pause_queue(self, queue: str, page: list, newest: int, full: bool):
+        """
+        Checkpoint a pass that ran out of budget after handling a page, so the
+        next pass picks up from the page after it.
+        """
+        resume_id = min(int(item['id']) for item in page)
+        self._logger.info("%s pass ran out of budget; resuming from #%s next pass", queue, resume_id)
+        self.set_checkpoint(queue, (resume_id, newest, full))
+
+    def queue_pages(self, queue: str, budget: PassBudget, fetch, *args, outcomes: list = None, **kwargs):
+        """
+        Walk the pages of a queue, yielding only items that need handling this
+        pass, until the budget runs out. See start_queue.
+
+        If the caller adds the (items, Future) pairs for the punishments it
+        hands out to outcomes, they're waited on before the queue's cursor
+        moves, which stops short of any that failed (see newest_settled).
+        """
+        outcomes = [] if outcomes is None else outcomes
+        (cursor, full, newest) = self.start_queue(queue, kwargs)
+        for page in self.pages(fetch, *args, **kwargs):
+            budget.spend()
+            new = self.new_items(cursor, full, page)
+            newest = self.newest_id(newest, new)
+            if new:
+                yield new
+            if len(new) < len(page):
+                # everything from here on has been seen before
+                break
+            if budget.exhausted():
+                wait([outcome for (_, outcome) in outcomes])
+                self.pause_queue(queue, page, self.newest_settled(newest, outcomes), full)
+                return
+        wait([outcome for (_, outcome) in outcomes])
+        self.finish_queue(queue, self.newest_settled(newest, outcomes), full)
+
+    def group_reports(self, reports: list) -> list:
+        """
+        Group reports by the account they report, so each account is judged
+        and punished once no matter how many times it was reported.
+
+        Returns a list of (report, group) pairs, where group is the reports
+        against one account and report is the first of them with the
+        (deduplicated) statuses from all of them.
+        """
+        groups = {}
         for report in reports:
-            self.handle_report(report)
+            groups.setdefault(report['target_account']['id'], []).append(report)
+        merged = []
+        for group in groups.values():
+            if len(group) == 1:
+                merged.append((group[0], group))
+                continue
+            statuses = {}
+            for report in group:
+                for status in report.get('statuses') or []:
+                    statuses.setdefault(status['id'], status)
+            merged.append((dict(group[0], statuses=list(statuses.values())), group))
+        return merged
+
+    def prioritize_reports(self, groups: list, budget: PassBudget) -> list:
+        """
+        If the pass has a budget, sort grouped reports so the accounts with
+        the most reported statuses are handled first.
+        """
+        if not budget.limited:
+            return groups
+        return sorted(groups, key=lambda pair: len(pair[0].get('statuses') or []), reverse=True)
+
+    def judge_items(self, judge: Judge, items: list) -> list:
+        """
+        Judge a batch of items, in the process pool if there is one.
+        """
+        if self.process_pool is not None and items:
+            return self.process_pool.make_judgements(judge, items)
+        return judge.make_judgements(items)
+
+    def queue_source(self, queue: str) -> tuple:
+        """
+        Get the API call that lists a queue's items, and the kwargs it needs.
+        """
+        if queue == constants.QUEUE_REPORTS:
+            return (self._api.admin_reports, {})
+        return (self._api.admin_accounts, {"status": "pending"})
+
+    def handle_batch(self, queue: str, items: list, budget: PassBudget = None) -> list:
+        """
+        Judge a batch of a queue's items and hand out their punishments.
+
+        Reports against the same account are handled together (see
+        group_reports). Returns a (group, outcome) pair for each set of items
+        handled together, where outcome is the Future from punish(), or None
+        if they weren't punished.
+        """
+        judge = self.judge_for(queue)
+        if queue == constants.QUEUE_REPORTS:
+            groups = self.prioritize_reports(self.group_reports(items), budget or self.new_budget())
+            judgements = self.judge_items(judge, [report for (report, _) in groups])
+            return [(group, self.handle_report(report, judgement, group))
+                    for (report, group), judgement in zip(groups, judgements)]
+        judgements = self.judge_items(judge, items)
+        return [([account], self.handle_pending_account(account, judgement))
+                for account, judgement in zip(items, judgements)]
+
+    def handle_pages(self, queue: str, budget: PassBudget = None) -> int:
+        """
+        Handle everything in a queue, a page at a time, waiting for the
+        punishments to be carried out.
+
+        Returns the number of items that needed judging.
+        """
+        if budget is None:
+            budget = self.new_budget()
+        judge = self.judge_for(queue)
+        (fetch, kwargs) = self.queue_source(queue)
+        depth = 0
+        # queue_pages waits for these before moving the queue's cursor
+        outcomes = []
+        for page in self.queue_pages(queue, budget, fetch, outcomes=outcomes, **kwargs):
+            items = self.unjudged(queue, judge, page)
+            punished = [(group, outcome) for (group, outcome) in self.handle_batch(queue, items, budget)
+                        if outcome is not None]
+            # each punishment is an API call too
+            budget.spend(len(punished))
+            outcomes.extend(punished)
+            depth += len(items)
+        return depth
+
+    def handle_unresolved_reports(self, budget: PassBudget = None) -> int:
+        """
+        Handles all unresolved reports. See handle_pages.
+        """
+        return self.handle_pages(constants.QUEUE_REPORTS, budget)
 
-    def handle_report(self, report: dict):
+    def handle_report(self, report: dict, judgement: tuple = None, group: list = None):
         """
         Handles a single report.
+
+        If the report has already been judged (e.g. as part of a batch), its
+        (punishment, rules_broken) judgement can be passed in. If it stands in
+        for a group of reports against the same account (see group_reports),
+        the group can be passed in too: the account is punished once, with the
+        rest of the group's reports resolved along with it.
+
+        Returns the Future from punish(), or None if the report wasn't
+        punished.
         """
-        self._logger.info("handling report #%d", report['id'])
-        (punishment, rules_broken) = self.report_judge.make_judgement(report)
+        if group is None:
+            group = [report]
+        others = [other['id'] for other in group if other['id'] != report['id']]
+        if others:
+            self._logger.info("handling report #%s (along with #%s)", report['id'], ", #".join(str(other) for other in others))
+        else:
+            self._logger.info("handling report #%s", report['id'])
+        judge = self.report_judge
+        if judgement is None:
+            judgement = judge.make_judgement(report)
+        (punishment, rules_broken) = judgement
         if rules_broken:
             self._logger.info("report breaks these rules: %s", rules_broken)
-        if punishment is not None:
-            self._logger.info("handling report with punishment %s", punishment)
-            self.punish(report['target_account']['id'], punishment, report['id'])
+        if punishment is None:
+            for member in group:
+                self.record(constants.QUEUE_REPORTS, judge, member, punishment, True)
+            return None
+        self._logger.info("handling report with punishment %s", punishment)
+        outcome = self.punish(report['target_account']['id'], punishment, report['id'], others)
+
+        def _record(done):
+            for member in group:
+                self.record(constants.QUEUE_REPORTS, judge, member, punishment, done.result())
+
+        outcome.add_done_callback(_record)
+        return outcome
 
-    def handle_pending_accounts(self):
+    def handle_pending_accounts(self, budget: PassBudget = None) -> int:
         """
-        Handle all accounts in the pending account queue.
+        Handle all accounts in the pending account queue. See handle_pages.
         """
-        accounts = self._api.admin_accounts(status="pending")
-        for account in accounts:
-            self.handle_pending_account(account)
+        return self.handle_pages(constants.QUEUE_PENDING_ACCOUNTS, budget)
 
-    def handle_pending_account(self, account: dict):
+    def handle_pending_account(self, account: dict, judgement: tuple = None):
         """
         Handle a single pending account.
+
+        See handle_report for the judgement argument.
         """
         self._logger.info("handling pending user %s", account['username'])
-        (punishment, rules_broken) = self.pending_account_judge.make_judgement(account)
+        judge = self.pending_account_judge
+        if judgement is None:
+            judgement = judge.make_judgement(account)
+        (punishment, rules_broken) = judgement
         if rules_broken:
             self._logger.info("pending account breaks these rules: %s", rules_broken)
-        if punishment is not None:
-            self._logger.info("handling report with punishment %s", punishment)
-            self._logger.debug("punishment cfg: %s", punishment.config)
-            self.punish(account['id'], punishment)
+        if punishment is None:
+            self.record(constants.QUEUE_PENDING_ACCOUNTS, judge, account, punishment, True)
+            return None
+        self._logger.info("handling report with punishment %s", punishment)
+        self._logger.debug("punishment cfg: %s", punishment.config)
+        outcome = self.punish(account['id'], punishment)
+        outcome.add_done_callback(
+            lambda done: self.record(constants.QUEUE_PENDING_ACCOUNTS, judge, account, punishment, done.result()))
+        return outcome
+
+    def punish(self, account_id, punishment: Punishment, report_id=None, other_report_ids: list = ()) -> Future:
+        """
+        Hand a punishment to the dispatcher to carry out.
 
-    def punish(self, account_id, punishment: Punishment, report_id=None):
+        The punishment is attached to report_id (which resolves it), and any
+        other reports against the account are resolved once it's done.
+
+        Returns a Future that resolves to whether the punishment was actually
+        carried out.
+
+        With a work queue, the punishment is claimed there first, so if a
+        worker is carrying out (or has carried out) the same punishment on the
+        account, it's skipped and the reports are just resolved.
+        """
         if self.dry_run:
             self._logger.info("ignoring punishment; in dry mode")
-            return
-        maxtries = 3
-        tries = 0
-        while True:
-            try:
-                if punishment.type == constants.PUNISH_REJECT:
-                    self._api.admin_account_reject(account_id)
-                elif punishment.type == constants.PUNISH_WARN:
-                    self._api.admin_account_moderate(
-                        account_id,
-                        None,
-                        report_id,
-                        text=punishment.config.get('message')
-                    )
-                elif punishment.type == constants.PUNISH_DISABLE:
-                    self._api.admin_account_moderate(
-                        account_id,
-                        "disable",
-                        report_id,
-                        text=punishment.config.get('message')
-                    )
-                elif punishment.type == constants.PUNISH_SILENCE:
-                    self._api.admin_account_moderate(
-                        account_id,
-                        "silence",
-                        report_id,
-                        text=punishment.config.get('message')
-                    )
-                elif punishment.type == constants.PUNISH_SUSPEND:
-                    self._api.admin_account_moderate(
-                        account_id,
-                        "suspend",
-                        report_id,
-                        text=punishment.config.get('message')
-                    )
-                else:
-                    # whoops
-                    raise NotImplementedError()
-                break
-            except MastodonGatewayTimeoutError as err:
-                self._logger.warn("gateway timed out. ignoring for now, if that didn't do it we'll get it next pass...")
-                break
+            skipped = Future()
+            skipped.set_result(False)
+            return skipped
+        description = "{} of account {}".format(punishment.type, account_id)
+        if punishment.type == constants.PUNISH_WARN:
+            action = None
+        elif punishment.type in (constants.PUNISH_REJECT, constants.PUNISH_DISABLE,
+                                 constants.PUNISH_SILENCE, constants.PUNISH_SUSPEND):
+            action = punishment.type
+        else:
+            # whoops
+            raise NotImplementedError()
+        if self.work_queue is not None and not self.work_queue.claim_action(
+                account_id, punishment.type, self.worker_name, self.lease_time):
+            self._logger.info("the %s has already been claimed; only resolving its reports", description)
+            reports = ([report_id] if report_id is not None else []) + list(other_report_ids)
+            if not reports:
+                handled = Future()
+                handled.set_result(True)
+                return handled
+            return self.dispatcher.submit_steps(
+                "resolution of reports against account {}".format(account_id),
+                [(self._api.admin_report_resolve, (report,), {}) for report in reports])
+        if punishment.type == constants.PUNISH_REJECT:
+            outcome = self.dispatcher.submit(description, self._api.admin_account_reject, account_id)
+        else:
+            steps = [(self._api.admin_account_moderate, (account_id, action, report_id),
+                      {"text": punishment.config.get('message')})]
+            steps.extend((self._api.admin_report_resolve, (other,), {}) for other in other_report_ids)
+            outcome = self.dispatcher.submit_steps(description, steps)
+        if self.work_queue is not None:
+            outcome.add_done_callback(lambda done: self.work_queue.finish_action(
+                account_id, punishment.type, self.worker_name, done.result(), constants.WORK_ACTION_MEMORY))
+        return outcome
+
+    def handle_event(self, event: str, obj: dict):
+        """
+        Handle a webhook event: a new report (report.created) or account
+        (account.created, which is only judged if it's awaiting approval).
+        Anything already in the ledger or in a queue without rules is ignored.
+
+        Returns the Future from punish(), or None if nothing was punished.
+        """
+        if event == constants.EVENT_REPORT_CREATED:
+            queue = constants.QUEUE_REPORTS
+            handle = self.handle_report
+        elif event == constants.EVENT_ACCOUNT_CREATED and not obj.get('approved', True):
+            queue = constants.QUEUE_PENDING_ACCOUNTS
+            handle = self.handle_pending_account
+        else:
+            self._logger.debug("ignoring %s event", event)
+            return None
+        # serve mode polls the queues too, with the same judges
+        with self.judging(queue):
+            judge = self.judge_for(queue)
+            if judge is None or not self.unjudged(queue, judge, [obj]):
+                return None
+            return handle(obj)
+
+    def judge_for(self, queue: str) -> Judge:
+        """
+        Get the judge for a queue, or None if it has no rules.
+        """
+        if queue == constants.QUEUE_REPORTS:
+            return self.report_judge
+        return self.pending_account_judge
+
+    def handle_queue(self, queue: str, budget: PassBudget = None) -> int:
+        """
+        Run one pass over a queue. Returns the number of items that needed
+        judging.
+        """
+        with self.judging(queue):
+            if queue == constants.QUEUE_REPORTS:
+                return self.handle_unresolved_reports(budget)
+            return self.handle_pending_accounts(budget)
+
+    def update_rule_order(self, judges: list = None):
+        """
+        Re-sort each judge's rules by their latest statistics, logging them.
+        """
+        for queue in (constants.QUEUE_REPORTS, constants.QUEUE_PENDING_ACCOUNTS):
+            with self.judging(queue):
+                judge = self.judge_for(queue)
+                if judge and (judges is None or judge in judges):
+                    judge.update_order()
+                    self._logger.debug("%s rule stats: %s", type(judge).__name__, judge.stats_summary())
+
     def run(self):
+        self.reload_config()
+        self.prune()
         self._logger.info("starting moderation pass")
+        budget = self.new_budget()
+        queues = [constants.QUEUE_REPORTS, constants.QUEUE_PENDING_ACCOUNTS]
+        if budget.limited:
+            # the queues share the pass's budget, and signups shouldn't wait
+            # on reports
+            queues.reverse()
         try:
-            if self.report_judge:
-                self.handle_unresolved_reports()
-            if self.pending_account_judge:
-                self.handle_pending_accounts()
+            for queue in queues:
+                if self.judge_for(queue):
+                    self.handle_queue(queue, budget)
             self._logger.info("moderation pass complete")
+            self.update_rule_order()
         except MastodonError:
             self._logger.exception(
                 "enountered an API error. waiting %d seconds to try again", self.wait_time)
 
-    def watch(self):
+    def run_queue(self, queue: str) -> float:
         """
-        Runs handle_unresolved_reports() on a loop, with a delay specified in
-        the "waittime" field of the config.
+        Run one pass over a queue, adapting its schedule to how it went.
+
+        Returns how long to wait before the queue's next pass.
+        """
+        self.reload_config()
+        self.prune()
+        judge = self.judge_for(queue)
+        if judge is None:
+            # the queue may get rules in a later reload
+            return self.schedules[queue].interval
+        self._logger.info("starting %s pass", queue)
+        starttime = time.monotonic()
+        depth = 0
+        try:
+            depth = self.handle_queue(queue)
+            self._logger.info("%s pass complete", queue)
+            self.update_rule_order([judge])
+        except MastodonError:
+            self._logger.exception("enountered an API error in %s. trying again next pass", queue)
+        return self.schedule_next(queue, depth, time.monotonic() - starttime)
+
+    def schedule_next(self, queue: str, depth: int, duration: float) -> float:
+        """
+        Adapt a queue's schedule to a pass that handled depth items and took
+        duration seconds, returning how long to wait before the next pass.
+        """
+        schedule = self.schedules[queue]
+        time_to_wait = schedule.update(depth, duration)
+        if duration > schedule.max_wait_time:
+            self._logger.warning("%s pass took longer than its longest wait time - this will cause significant drift. you may want to increase waitTime", queue)
+        self._logger.debug("waiting %.4f seconds for the next %s pass", time_to_wait, queue)
+        return time_to_wait
+
+    def watch_queue(self, queue: str):
+        """
+        Run passes over a queue on its own schedule, forever.
         """
         while True:
-            starttime = time.time()
-            self.run()
-            time_to_wait = self.wait_time - (time.time() - starttime)
-            if time_to_wait > 0:
-                self._logger.debug("waiting for %.4f seconds", time_to_wait)
-                time.sleep(time_to_wait)
-            else:
-                self._logger.warn("moderation pass took longer than waitTime - this will cause significant drift. you may want to increase waitTime")
+            time.sleep(self.run_queue(queue))
+
+    def serve(self):
+        """
+        Handle reports and signups as Mastodon pushes them to Ivory's webhook
+        server, polling the queues every "reconcileInterval" seconds in case
+        any deliveries were missed.
+        """
+        from webhook import WebhookServer
+        if self.config_path is not None and hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.request_reload)
+        webhook_config = self.config.get('webhook')
+        if webhook_config is None:
+            raise ValueError("serve mode needs a \"webhook\" section in the config")
+        server = WebhookServer(self, webhook_config['secret'], (
+            webhook_config.get('host', constants.DEFAULT_WEBHOOK_HOST),
+            webhook_config.get('port', constants.DEFAULT_WEBHOOK_PORT)
+        ))
+        threading.Thread(target=server.serve_forever, name="ivory-webhook-server", daemon=True).start()
+        self._logger.info("listening for webhooks on %s:%d", *server.server_address[:2])
+        interval = webhook_config.get('reconcileInterval', constants.DEFAULT_RECONCILE_INTERVAL)
+        try:
+            while True:
+                starttime = time.monotonic()
+                self.run()
+                time.sleep(max(0, interval - (time.monotonic() - starttime)))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def require_work_queue(self):
+        if self.work_queue is None:
+            raise ValueError("fetch and work mode need a \"workQueue\" section in the config")
+
+    def fetch_queue(self, queue: str, budget: PassBudget = None) -> int:
+        """
+        Run one pass over a queue, adding what needs judging to the work queue
+        for workers to handle instead of judging it here.
+
+        Returns the number of items queued.
+        """
+        if budget is None:
+            budget = self.new_budget()
+        judge = self.judge_for(queue)
+        (fetch, kwargs) = self.queue_source(queue)
+        queued = 0
+        for page in self.queue_pages(queue, budget, fetch, **kwargs):
+            queued += self.work_queue.enqueue(queue, self.unjudged(queue, judge, page), judge.version())
+        self._logger.debug("queued %d %s items", queued, queue)
+        return queued
+
+    def fetch_once(self) -> int:
+        """
+        Run one fetch pass over every queue with rules. Returns the number of
+        items queued.
+        """
+        self.require_work_queue()
+        self.reload_config()
+        self.prune()
+        queued = 0
+        budget = self.new_budget()
+        for queue in (constants.QUEUE_PENDING_ACCOUNTS, constants.QUEUE_REPORTS):
+            if self.judge_for(queue):
+                try:
+                    queued += self.fetch_queue(queue, budget)
+                except MastodonError:
+                    self._logger.exception("enountered an API error fetching %s. trying again next pass", queue)
+        return queued
+
+    def fetch(self):
+        """
+        Fetch mode: poll the queues every waitTime seconds, leaving the judging
+        and punishing to workers (see work).
+        """
+        if self.config_path is not None and hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.request_reload)
+        while True:
+            starttime = time.monotonic()
+            self.fetch_once()
+            time.sleep(max(0, self.wait_time - (time.monotonic() - starttime)))
+
+    def settle_work(self, queue: str, items: list, handled: bool):
+        """
+        Mark work items done once they've been handled. Items whose
+        punishment failed are left leased, so they're retried once the lease
+        runs out.
+        """
+        if handled or self.dry_run:
+            for item in items:
+                self.work_queue.complete(queue, item, self.worker_name)
+
+    def work_queue_items(self, queue: str) -> int:
+        """
+        Lease and handle a queue's items from the work queue, a batch at a
+        time, until there are none left.
+
+        Returns the number of items handled.
+        """
+        handled = 0
+        while True:
+            items = self.work_queue.lease(queue, self.worker_name, self.work_batch_size, self.lease_time)
+            if not items:
+                return handled
+            try:
+                results = self.handle_batch(queue, items)
+            except Exception:
+                for item in items:
+                    self.work_queue.release(queue, item, self.worker_name)
+                raise
+            outcomes = []
+            for (group, outcome) in results:
+                if outcome is None:
+                    self.settle_work(queue, group, True)
+                    continue
+                outcome.add_done_callback(
+                    lambda done, group=group: self.settle_work(queue, group, done.result()))
+                outcomes.append(outcome)
+            wait(outcomes)
+            handled += len(items)
+
+    def work_once(self) -> int:
+        """
+        Handle everything waiting in the work queue. Returns the number of
+        items handled.
+        """
+        self.require_work_queue()
+        self.reload_config()
+        self.prune()
+        handled = 0
+        for queue in (constants.QUEUE_PENDING_ACCOUNTS, constants.QUEUE_REPORTS):
+            if self.judge_for(queue):
+                handled += self.work_queue_items(queue)
+        if handled:
+            self._logger.info("handled %d queued items", handled)
+            self.update_rule_order()
+        return handled
+
+    def work(self):
+        """
+        Work mode: judge and punish what fetch mode queues up. Any number of
+        workers can share a work queue.
+        """
+        if self.config_path is not None and hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.request_reload)
+        while True:
+            if not self.work_once():
+                time.sleep(constants.WORK_POLL_INTERVAL)
+
+    def watch(self):
+        """
+        Runs each queue on a loop, on its own schedule (see Schedule), so a
+        slow pass over one queue never holds up the other.
+        """
+        if self.config_path is not None and hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.request_reload)
+        failed = threading.Event()
+        errors = []
+
+        def _watch_queue(queue):
+            try:
+                self.watch_queue(queue)
+            except BaseException as err:
+                errors.append(err)
+                failed.set()
+
+        for queue in (constants.QUEUE_REPORTS, constants.QUEUE_PENDING_ACCOUNTS):
+            threading.Thread(target=_watch_queue, args=(queue,), name="ivory-" + queue, daemon=True).start()
+        # an unexpected error in either queue brings Ivory down, as it would
+        # if the queues ran on the main thread
+        failed.wait()
+        raise errors[0]
@@ -2,9 +2,17 @@
 The Judge system, which tests the reports and pending accounts Ivory feeds into
 it.
 """
+import hashlib # for ruleset versions
+import json # for ruleset versions
 import logging # for logging in Judge
+import time # for timing rules
 from typing import List # type hinting for List
-from importlib import import_module # for dynamic rule imports
+
+import constants
+from registry import RuleRegistry, config_key, default_registry # for dynamic rule imports
+from context import Context, ReportContext, PendingAccountContext
+from matcher import PatternMatcher
+
 
 class Punishment:
     """
@@ -32,25 +40,79 @@ class Rule:
     Each one can be run against a data structure to determine if it passes or
     fails.
     In this case, it differs in that a Rule comes with a Punishment.
+
+    Rules that do something expensive (like making network requests) should
+    set cost to a higher value, so short-circuiting judges run them last.
+    Rules that spend their time waiting on I/O should also set io_bound, so
+    their work is spread over the judge's thread pool (see map()). These must
+    keep any state they share between calls thread-safe.
+
+    Rules whose test methods are coroutines set is_async; only async judges
+    can run them.
     """
+    cost = constants.RULE_COST_LOCAL
+    io_bound = False
+    is_async = False
 
     def __init__(self, **config):
         self.name = config['name']
         self.punishment = Punishment(config['severity'], **config['punishment'])
+        self.executor = None
         self._logger = logging.getLogger(__name__)
 
-    def test_report(self, report: dict):
+    def map(self, func, *iterables) -> list:
+        """
+        Map a function over some iterables, returning a list of results.
+
+        For io_bound rules given an executor by their judge, the calls run
+        concurrently on it; otherwise they run one after another.
+        """
+        if self.io_bound and self.executor is not None:
+            return list(self.executor.map(func, *iterables))
+        return list(map(func, *iterables))
+
+    def test_report(self, report: dict, context: ReportContext = None):
         """
         Test a report.
+
+        The Judge passes a ReportContext holding lazily computed features of
+        the report; rules should use it instead of re-deriving things like
+        links, and build one themselves when called without it.
         """
         raise NotImplementedError()
 
-    def test_pending_account(self, account: dict):
+    def test_pending_account(self, account: dict, context: PendingAccountContext = None):
         """
         Test a pending account.
+
+        See test_report for what the context is for.
         """
         raise NotImplementedError()
 
+    def test_reports(self, reports: List[dict], contexts: List[ReportContext] = None) -> List[bool]:
+        """
+        Test a batch of reports, returning a result for each.
+
+        By default this just runs test_report on each one (concurrently for
+        io_bound rules); rules that can share work between reports
+        (deduplicating lookups, batching network requests) should override it.
+        Overrides shouldn't call methods that use map() from inside map(), as
+        waiting on the pool from one of its own threads can deadlock.
+        """
+        if contexts is None:
+            contexts = [ReportContext(report) for report in reports]
+        return self.map(self.test_report, reports, contexts)
+
+    def test_pending_accounts(self, accounts: List[dict], contexts: List[PendingAccountContext] = None) -> List[bool]:
+        """
+        Test a batch of pending accounts, returning a result for each.
+
+        See test_reports.
+        """
+        if contexts is None:
+            contexts = [PendingAccountContext(account) for account in accounts]
+        return self.map(self.test_pending_account, accounts, contexts)
+
     def __str__(self):
         return self.name
 
@@ -58,6 +120,122 @@ class Rule:
         return "Rule '%s' (%s)" % (self.name, type(self).__name__)
 
 
+class RegexRule(Rule):
+    """
+    A Rule that searches one or more text fields for any of a list of blocked
+    regexes.
+
+    Subclasses list the fields they search in report_fields and
+    pending_account_fields (see ReportContext.FIELDS and
+    PendingAccountContext.FIELDS). Judges merge the patterns of every RegexRule
+    searching the same field into one PatternMatcher, so each field is only
+    scanned once per item no matter how many rules search it.
+    """
+    report_fields = ()
+    pending_account_fields = ()
+
+    def __init__(self, **config):
+        Rule.__init__(self, **config)
+        self.blocked = config['blocked']
+        self._matcher = None
+
+    @property
+    def matcher(self) -> PatternMatcher:
+        """
+        A PatternMatcher for just this rule's patterns, for testing it outside
+        a judge. Only built when first needed, since judges use their own.
+        """
+        if self._matcher is None:
+            matcher = PatternMatcher()
+            for pattern in self.blocked:
+                matcher.add(self, pattern)
+            self._matcher = matcher
+        return self._matcher
+
+    def _test_fields(self, fields, context: Context):
+        for field in fields:
+            if self.matcher.match(context.texts(field)):
+                return True
+        return False
+
+    def test_report(self, report: dict, context: ReportContext = None):
+        """
+        Test if any of the rule's report fields match a blocked regex.
+        """
+        if not self.report_fields:
+            raise NotImplementedError()
+        return self._test_fields(self.report_fields, context or ReportContext(report))
+
+    def test_pending_account(self, account: dict, context: PendingAccountContext = None):
+        """
+        Test if any of the rule's pending account fields match a blocked regex.
+        """
+        if not self.pending_account_fields:
+            raise NotImplementedError()
+        return self._test_fields(self.pending_account_fields, context or PendingAccountContext(account))
+
+
+class RuleStats:
+    """
+    Running wall time and hit rate statistics for a rule.
+
+    Judges use these to guess how long a rule will take to run and how likely
+    it is to be broken, blending in the rule's own cost estimate until it has
+    been run a few times.
+    """
+
+    def __init__(self, cost: float):
+        self.cost = cost
+        self.runs = 0
+        self.hits = 0
+        self.total_time = 0.0
+
+    def record(self, elapsed: float, broken: bool):
+        """
+        Record a single run of the rule.
+        """
+        self.runs += 1
+        self.total_time += elapsed
+        if broken:
+            self.hits += 1
+
+    @property
+    def mean_time(self) -> float:
+        """
+        Estimated seconds per run.
+        """
+        prior = constants.RULE_COST_PRIOR_RUNS
+        return (self.total_time + self.cost * prior) / (self.runs + prior)
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Estimated chance the rule is broken, smoothed so new rules start at a
+        coin flip and no rule ever hits 0 or 1.
+        """
+        return (self.hits + 1) / (self.runs + 2)
+
+    @property
+    def score(self) -> float:
+        """
+        Expected seconds spent running the rule per time it's broken; lower
+        scores run first.
+        """
+        return self.mean_time / self.hit_rate
+
+    def as_dict(self) -> dict:
+        return {
+            "runs": self.runs,
+            "hits": self.hits,
+            "total_time": self.total_time,
+            "mean_time": self.mean_time,
+            "hit_rate": self.hit_rate,
+        }
+
+    def __repr__(self):
+        return "RuleStats (%d runs, %d hits, %.4fs mean)" % (self.runs, self.hits, self.mean_time)
+
+
 class Judge:
     """
     Interface for judging data based on rules.
@@ -65,28 +243,66 @@ class Judge:
     The Judge class is a dead-simple class that holds Rule objects, and allows
     you to test each Rule on a single dict with the make_judgement
     method.
+
+    By default every rule is run, so the full list of broken rules is known.
+    A judge with exhaustive set to False instead runs rules from most to least
+    severe (cheapest first within a severity) and stops as soon as no
+    remaining rule could change the final Punishment. Within a severity,
+    rules are ordered by the RuleStats the judge keeps on them, so cheap rules
+    that are often broken run first; call update_order() to apply the latest
+    statistics.
+
+    If the judge is given an executor (such as a ThreadPoolExecutor), its
+    io_bound rules run their work on it.
+
+    Rule types are resolved through a RuleRegistry, the shared default one
+    unless another is given.
     """
+    # whether the judge can await async rules' tests
+    runs_async_rules = False
 
-    def __init__(self, rule_configs: List[dict] = None):
+    def __init__(self, rule_configs: List[dict] = None, exhaustive: bool = True, executor=None,
+                 registry: RuleRegistry = None):
         self.rules = []
+        self.registry = registry or default_registry
+        self.exhaustive = exhaustive
+        self.executor = executor
+        self._matchers = None
+        self._order = None
+        self.stats = {}
+        self._config_keys = {}
         if rule_configs is not None:
             self.load_rules(rule_configs)
 
-    def load_rules(self, rule_configs: List[dict]):
+    def _build_rules(self, rule_configs: List[dict], reusable: dict = None) -> List[tuple]:
         """
-        Load rules from a list of rule configuration dicts.
+        Build rules from a list of rule configuration dicts, returning a list
+        of (rule, config key) tuples.
+
+        reusable maps config keys to lists of existing rules; a rule whose
+        config matches one of these is reused instead of being rebuilt.
         """
+        reusable = reusable or {}
+        built = []
         rulecount = 1
         logger = logging.getLogger(__name__)
         for rule_config in rule_configs:
+            key = config_key(rule_config)
             try:
-                # programmatically load rule based on type in config
-                rule_type = rule_config['type']
-                logger.debug(
-                    "loading rule #%d of type %s", rulecount, rule_type)
-                Rule = import_module('rules.{}'.format(rule_type)).rule
-                new_rule = Rule(rule_config)
-                self.add_rule(new_rule)
+                if reusable.get(key):
+                    logger.debug("keeping unchanged rule #%d", rulecount)
+                    built.append((reusable[key].pop(0), key))
+                else:
+                    # programmatically load rule based on type in config
+                    rule_type = rule_config['type']
+                    logger.debug(
+                        "loading rule #%d of type %s", rulecount, rule_type)
+                    rule = self.registry.build(rule_config)
+                    self.check_rule(rule)
+                    if any(rule is other for (other, _) in built):
+                        # the same rule twice in one judge needs two Rules
+                        rule = self.registry.build(rule_config, share=False)
+                    built.append((rule, key))
                 rulecount += 1
             except ModuleNotFoundError as err:
                 logger.exception("rule #%d not found", rulecount)
@@ -97,7 +313,62 @@ class Judge:
                     "failed to initialize rule #%d", rulecount)
                 logger.critical("could not parse rules")
                 raise err
-            logger.info("%s judge loaded %d rules (%d total)", type(self).__name__, rulecount - 1, len(self.rules))
+        return built
+
+    def load_rules(self, rule_configs: List[dict]):
+        """
+        Load rules from a list of rule configuration dicts.
+        """
+        built = self._build_rules(rule_configs)
+        for rule, key in built:
+            self.add_rule(rule)
+            self._config_keys[rule] = key
+        logging.getLogger(__name__).info("%s judge loaded %d rules (%d total)", type(self).__name__, len(built), len(self.rules))
+
+    def stage_rules(self, rule_configs: List[dict]) -> List[tuple]:
+        """
+        Build the rules for a new list of rule configuration dicts, ready to
+        be swapped in with swap_rules(). Existing rules whose configuration
+        hasn't changed are reused (along with their caches and statistics)
+        instead of being rebuilt.
+
+        Raises if any rule fails to load, leaving the judge untouched.
+        """
+        reusable = {}
+        for rule in self.rules:
+            reusable.setdefault(self._config_keys.get(rule), []).append(rule)
+        return self._build_rules(rule_configs, reusable)
+
+    def swap_rules(self, staged: List[tuple]) -> int:
+        """
+        Replace the judge's rules with ones from stage_rules(). Returns the
+        number of rules that had to be built.
+        """
+        rules = [rule for rule, _ in staged]
+        for rule in rules:
+            rule.executor = self.executor
+        stats = {rule: self.stats.get(rule) or RuleStats(rule.cost) for rule in rules}
+        rebuilt = len([rule for rule in rules if rule not in self.stats])
+        # swap everything in at once
+        (self.rules, self.stats, self._config_keys, self._matchers, self._order) = \
+            (rules, stats, dict(staged), None, None)
+        logging.getLogger(__name__).info("%s judge reloaded %d rules (%d rebuilt)", type(self).__name__, len(rules), rebuilt)
+        return rebuilt
+
+    def update_rules(self, rule_configs: List[dict]) -> int:
+        """
+        Replace the judge's rules with ones loaded from a new list of rule
+        configuration dicts, keeping any existing rules whose configuration
+        hasn't changed. See stage_rules() and swap_rules().
+        """
+        return self.swap_rules(self.stage_rules(rule_configs))
+
+    def check_rule(self, rule):
+        """
+        Make sure the judge can run a rule, raising a ValueError if it can't.
+        """
+        if rule.is_async and not self.runs_async_rules:
+            raise ValueError("{!r} is an async rule, which only async judges (AsyncIvory) can run".format(rule))
 
     def add_rule(self, rule):
         """
@@ -105,47 +376,226 @@ class Judge:
 
         Future judgements will use this rule.
         """
+        self.check_rule(rule)
+        rule.executor = self.executor
         self.rules.append(rule)
+        self.stats.setdefault(rule, RuleStats(rule.cost))
+        self._matchers = None
+        self._order = None
 
     def clear_rules(self):
         """
         Clear this judge's rules list.
         """
         self.rules = []
+        self.stats = {}
+        self._config_keys = {}
+        self._matchers = None
+        self._order = None
+
+    def make_context(self, data: dict) -> Context:
+        """
+        Wrap some data in the context type this judge's rules expect.
+        """
+        raise NotImplementedError()
 
-    def test_rule(self, rule: Rule, data: dict):
+    def test_rules(self, rule: Rule, items: List[dict], contexts: List[Context]) -> List[bool]:
         raise NotImplementedError()
 
+    def rule_fields(self, rule: RegexRule):
+        """
+        Get the fields a RegexRule searches in this judge's data.
+        """
+        raise NotImplementedError()
+
+    def _build_matchers(self):
+        """
+        Merge the patterns of every RegexRule into one PatternMatcher per
+        field.
+        """
+        self._matchers = {}
+        for rule in self.rules:
+            if not isinstance(rule, RegexRule):
+                continue
+            for field in self.rule_fields(rule):
+                matcher = self._matchers.setdefault(field, PatternMatcher())
+                for pattern in rule.blocked:
+                    matcher.add(rule, pattern)
+
+    def _match_field(self, field: str, context: Context) -> set:
+        """
+        Get the RegexRules broken by a field of the data, scanning it only the
+        first time it's asked for.
+        """
+        if field not in context.matches:
+            context.matches[field] = self._matchers[field].match(context.texts(field))
+        return context.matches[field]
+
+    def evaluation_order(self) -> List[Rule]:
+        """
+        Get the order short-circuiting judgements run rules in: most severe
+        first, then by lowest RuleStats score, then in config order.
+
+        The order is worked out once and kept until update_order() is called.
+        """
+        if self._order is None:
+            self.update_order()
+        return self._order
+
+    def update_order(self):
+        """
+        Re-sort the evaluation order using the latest rule statistics.
+        """
+        self._order = sorted(self.rules, key=lambda rule: (-rule.punishment.severity, self.stats[rule].score))
 
-    def make_judgement(self, data: dict) -> (Punishment, List[Rule]):
+    def version(self) -> str:
+        """
+        Get a hash identifying this judge's ruleset, which changes whenever
+        its rules (or their order) do.
+        """
+        keys = [self._config_keys.get(rule, repr(rule)) for rule in self.rules]
+        return hashlib.sha256(json.dumps(keys).encode("utf-8")).hexdigest()
+
+    def rule_configs(self) -> List[dict]:
+        """
+        Get the config each of the judge's rules was built from, in order, or
+        None if any of them was added without one (see add_rule).
+        """
+        keys = [self._config_keys.get(rule) for rule in self.rules]
+        if None in keys:
+            return None
+        return [json.loads(key) for key in keys]
+
+    def stats_summary(self) -> List[dict]:
+        """
+        Get each rule's statistics as a list of dicts, in evaluation order.
+        """
+        return [dict(name=rule.name, **self.stats[rule].as_dict()) for rule in self.evaluation_order()]
+
+    def _match_rule(self, rule: RegexRule, contexts: List[Context]):
+        """
+        Test a RegexRule against a batch of items using the combined matchers,
+        or return None if the rule doesn't search any fields here.
+        """
+        fields = self.rule_fields(rule) if isinstance(rule, RegexRule) else ()
+        if not fields:
+            return None
+        return [any(rule in self._match_field(field, context) for field in fields)
+                for context in contexts]
+
+    def _record(self, rule: Rule, starttime: float, results: List[bool]):
+        """
+        Record a batch of a rule's results, and the time they took, in its
+        statistics.
+        """
+        elapsed = (time.perf_counter() - starttime) / len(results)
+        for broken in results:
+            self.stats[rule].record(elapsed, bool(broken))
+
+    def _run_rule(self, rule: Rule, items: List[dict], contexts: List[Context]) -> List[bool]:
+        """
+        Run a rule against a batch of items, recording its statistics.
+        """
+        logging.getLogger(__name__).debug("running rule %s on %d items", rule, len(items))
+        starttime = time.perf_counter()
+        results = self._match_rule(rule, contexts)
+        if results is None:
+            results = self.test_rules(rule, items, contexts)
+        self._record(rule, starttime, results)
+        return results
+
+    def _judge(self, items: List[dict], exhaustive: bool = None):
+        """
+        Generator that works through a batch judgement.
+
+        It yields a (rule, items, contexts) tuple for each batch of items a
+        rule needs to be run on, and expects to be sent back the results.
+        Once it's done, the judgements are the StopIteration's value. This
+        lets make_judgements and async judges share the same logic while
+        running rules however they like.
+        """
+        if exhaustive is None:
+            exhaustive = self.exhaustive
+        if self._matchers is None:
+            self._build_matchers()
+        contexts = [self.make_context(data) for data in items]
+        # ties in severity go to whichever rule comes first in the config
+        position = {rule: index for index, rule in enumerate(self.rules)}
+        most_severe_rules = [None] * len(items)
+        rules_broken = [set() for _ in items]
+
+        def could_change(rule, most_severe_rule):
+            return (most_severe_rule is None or
+                    most_severe_rule.punishment.severity < rule.punishment.severity or
+                    (most_severe_rule.punishment.severity == rule.punishment.severity and
+                     position[rule] < position[most_severe_rule]))
+
+        for rule in (self.rules if exhaustive else self.evaluation_order()):
+            if exhaustive:
+                indexes = list(range(len(items)))
+            else:
+                indexes = [index for index, most_severe_rule in enumerate(most_severe_rules)
+                           if could_change(rule, most_severe_rule)]
+            if not indexes:
+                continue
+            results = yield (rule,
+                             [items[index] for index in indexes],
+                             [contexts[index] for index in indexes])
+            for index, rule_was_broken in zip(indexes, results):
+                if rule_was_broken:
+                    rules_broken[index].add(rule)
+                    if could_change(rule, most_severe_rules[index]):
+                        most_severe_rules[index] = rule
+        return [(rule.punishment if rule is not None else None, broken)
+                for rule, broken in zip(most_severe_rules, rules_broken)]
+
+    def make_judgements(self, items: List[dict], exhaustive: bool = None) -> List[tuple]:
+        """
+        Judge a batch of data, such as a whole page of a moderation queue.
+
+        Each rule is run once over every item it could still change the
+        verdict of, so rules implementing the batch test methods can share
+        work between items.
+
+        exhaustive overrides the judge's own setting for this batch.
+
+        Returns a list with a (final_verdict, rules_broken) tuple for each
+        item, as described in make_judgement.
+        """
+        judgement = self._judge(items, exhaustive)
+        try:
+            step = next(judgement)
+            while True:
+                step = judgement.send(self._run_rule(*step))
+        except StopIteration as done:
+            return done.value
+
+    def make_judgement(self, data: dict, exhaustive: bool = None) -> (Punishment, List[Rule]):
         """
         Judge some data.
 
+        exhaustive overrides the judge's own setting for this judgement.
+
         Returns:
         final_verdict: Returns the Punishment object that should be used for
         this data, or None if there is none.
-        rules_broken: The list of rules the judge determined were broken.
+        rules_broken: The list of rules the judge determined were broken. When
+        not exhaustive, this is only the rules that had to be run to decide
+        the verdict.
         """
-        logger = logging.getLogger(__name__)
-        most_severe_rule = None
-        rules_broken = set()
-        for rule in self.rules:
-            logger.debug("running rule %s", rule)
-            rule_was_broken = self.test_rule(rule, data)
-            if rule_was_broken:
-                rules_broken.add(rule)
-                if (most_severe_rule is None or
-                        most_severe_rule.punishment.severity < rule.punishment.severity):
-                    most_severe_rule = rule
-        if most_severe_rule is not None:
-            final_verdict = most_severe_rule.punishment
-        else:
-            final_verdict = None
-        return (final_verdict, rules_broken)
+        return self.make_judgements([data], exhaustive)[0]
 
 class ReportJudge(Judge):
-    def test_rule(self, rule: Rule, data: dict):
-        return rule.test_report(data)
+    def make_context(self, data: dict) -> ReportContext:
+        return ReportContext(data)
+    def test_rules(self, rule: Rule, items: List[dict], contexts: List[ReportContext]):
+        return rule.test_reports(items, contexts)
+    def rule_fields(self, rule: RegexRule):
+        return rule.report_fields
 class PendingAccountJudge(Judge):
-    def test_rule(self, rule: Rule, data: dict):
-        return rule.test_pending_account(data)
+    def make_context(self, data: dict) -> PendingAccountContext:
+        return PendingAccountContext(data)
+    def test_rules(self, rule: Rule, items: List[dict], contexts: List[PendingAccountContext]):
+        return rule.test_pending_accounts(items, contexts)
+    def rule_fields(self, rule: RegexRule):
+        return rule.pending_account_fields
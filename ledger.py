@@ -0,0 +1,197 @@
+"""
+The ledger, Ivory's record of what it has already judged.
+
+Without it, every pass re-judges (and re-punishes) everything still sitting in
+the moderation queues. The ledger is a small SQLite database keyed by queue and
+item id, storing a fingerprint of the item's content and the version of the
+ruleset that judged it, so an item is only judged again if it changes or the
+rules do.
+
+It also keeps each queue's polling cursor (the newest item id seen) and when
+the queue was last swept in full, so incremental polling survives restarts, and
+where a pass that ran out of budget left off, so the next one can resume.
+"""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+# Fields that change all the time without the item really changing, which are
+# left out of fingerprints
+VOLATILE_FIELDS = frozenset([
+    "followers_count",
+    "following_count",
+    "statuses_count",
+    "last_status_at",
+    "replies_count",
+    "reblogs_count",
+    "favourites_count",
+])
+
+
+# ISO 8601 timestamps, as webhook payloads (and items round-tripped through
+# JSON) carry them; Mastodon.py hands out datetimes instead
+TIMESTAMP = re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})?$")
+
+
+def _timestamp(value: datetime) -> str:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat()
+
+
+def _canonical(value):
+    """
+    Strip volatile fields out of an item, and put ids and timestamps in one
+    form, so the same item fingerprints the same whether it came from
+    Mastodon.py (integer ids, datetimes) or a webhook (string ids, ISO 8601
+    strings).
+    """
+    if isinstance(value, dict):
+        return {key: _canonical(item) for key, item in value.items() if key not in VOLATILE_FIELDS}
+    if isinstance(value, list):
+        return [_canonical(item) for item in value]
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value)
+    if isinstance(value, datetime):
+        return _timestamp(value)
+    if isinstance(value, str) and TIMESTAMP.match(value):
+        try:
+            return _timestamp(datetime.fromisoformat(value.replace("Z", "+00:00")))
+        except ValueError:
+            return value
+    return value
+
+
+def fingerprint(item: dict) -> str:
+    """
+    Get a hash of an item's content, ignoring volatile fields like follower
+    counts. See _canonical.
+    """
+    canonical = json.dumps(_canonical(item), sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class Ledger:
+    """
+    A persistent record of judged items.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS judged (
+                    queue TEXT NOT NULL,
+                    item_id TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    ruleset TEXT NOT NULL,
+                    punishment TEXT,
+                    judged_at REAL NOT NULL,
+                    PRIMARY KEY (queue, item_id)
+                )
+            """)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS cursors (
+                    queue TEXT PRIMARY KEY,
+                    item_id INTEGER,
+                    swept_at REAL
+                )
+            """)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    queue TEXT PRIMARY KEY,
+                    resume_id INTEGER NOT NULL,
+                    newest INTEGER,
+                    full INTEGER NOT NULL
+                )
+            """)
+
+    def unjudged(self, queue: str, items: list, ruleset: str) -> list:
+        """
+        Filter a list of items down to the ones that haven't been judged by
+        this ruleset in their current form.
+        """
+        if not items:
+            return []
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT item_id, fingerprint, ruleset FROM judged WHERE queue = ? AND item_id IN ({})".format(
+                    ",".join("?" * len(items))),
+                [queue] + [str(item['id']) for item in items]
+            ).fetchall()
+        judged = {item_id: (fp, version) for (item_id, fp, version) in rows}
+        return [item for item in items
+                if judged.get(str(item['id'])) != (fingerprint(item), ruleset)]
+
+    def record(self, queue: str, item: dict, ruleset: str, punishment=None):
+        """
+        Record that an item was judged (and punished, if punishment is given)
+        by a ruleset.
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO judged VALUES (?, ?, ?, ?, ?, ?)",
+                (queue, str(item['id']), fingerprint(item), ruleset,
+                 punishment.type if punishment is not None else None, time.time())
+            )
+
+    def get_cursor(self, queue: str) -> tuple:
+        """
+        Get a queue's (cursor, last full sweep time), either of which may be
+        None.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT item_id, swept_at FROM cursors WHERE queue = ?", (queue,)).fetchone()
+        return row or (None, None)
+
+    def set_cursor(self, queue: str, item_id: int, swept_at: float = None):
+        """
+        Save a queue's cursor and last full sweep time.
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?, ?)", (queue, item_id, swept_at))
+
+    def get_checkpoint(self, queue: str):
+        """
+        Get where an unfinished pass over a queue left off, as (resume_id,
+        newest, full), or None if the last pass finished.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT resume_id, newest, full FROM checkpoints WHERE queue = ?",
+                                   (queue,)).fetchone()
+        if row is None:
+            return None
+        (resume_id, newest, full) = row
+        return (resume_id, newest, bool(full))
+
+    def set_checkpoint(self, queue: str, checkpoint: tuple = None):
+        """
+        Save where a pass over a queue left off, or clear it if checkpoint is
+        None.
+        """
+        with self._lock, self._db:
+            if checkpoint is None:
+                self._db.execute("DELETE FROM checkpoints WHERE queue = ?", (queue,))
+            else:
+                (resume_id, newest, full) = checkpoint
+                self._db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)",
+                                 (queue, resume_id, newest, int(full)))
+
+    def prune(self, max_age: float):
+        """
+        Forget items judged more than max_age seconds ago.
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM judged WHERE judged_at < ?", (time.time() - max_age,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,179 @@
+"""
+Multi-pattern regex matching for Ivory's regex-based rules.
+
+Searching a piece of text for hundreds of blocked regexes one re.search at a
+time gets slow fast, so the PatternMatcher here pulls a literal substring that
+every match is required to contain out of each pattern and finds all of those
+literals in a single Aho-Corasick pass over the text. Only the patterns whose
+literal actually shows up (plus the few we couldn't pull a literal out of) get
+a real regex search.
+"""
+import re
+from collections import deque
+from functools import lru_cache
+from typing import Iterable, Optional
+
+try:
+    import re._parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+
+@lru_cache(maxsize=None)
+def compile_pattern(pattern: str):
+    """
+    Compile a regex, once per process. Unlike re's own cache, this one never
+    evicts, so configs with hundreds of patterns (and rebuilt matchers after a
+    config reload) don't end up recompiling them.
+    """
+    return re.compile(pattern)
+
+
+@lru_cache(maxsize=None)
+def required_literal(pattern: str) -> Optional[str]:
+    """
+    Get the longest literal substring that any match of a regex must contain,
+    or None if there isn't one we can safely use.
+
+    This only looks at the top level of the pattern, so anything inside groups,
+    branches or repeats is ignored - it errs on the side of returning None.
+    """
+    try:
+        if compile_pattern(pattern).flags & re.IGNORECASE:
+            return None
+        parsed = sre_parse.parse(pattern)
+    except (re.error, TypeError):
+        return None
+    best = ""
+    run = []
+    for opcode, arg in parsed:
+        if opcode is sre_parse.LITERAL:
+            run.append(chr(arg))
+            continue
+        if len(run) > len(best):
+            best = "".join(run)
+        run = []
+    if len(run) > len(best):
+        best = "".join(run)
+    return best or None
+
+
+class AhoCorasick:
+    """
+    An Aho-Corasick automaton, for finding every occurrence of a set of
+    literal strings in one pass over a piece of text.
+    """
+
+    def __init__(self, words: Iterable[str]):
+        self.words = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for word in words:
+            self._add(word)
+        self._build()
+
+    def _add(self, word: str):
+        state = 0
+        for char in word:
+            if char not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[state][char] = len(self._goto) - 1
+            state = self._goto[state][char]
+        self._out[state].append(len(self.words))
+        self.words.append(word)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def search(self, text: str) -> set:
+        """
+        Get the indexes (into self.words) of every word found in the text.
+        """
+        found = set()
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class PatternMatcher:
+    """
+    Tests many regexes against some text at once.
+
+    Each pattern is added with a tag (Ivory uses the Rule the pattern belongs
+    to), and match() returns the set of tags with at least one pattern that
+    matched, so callers can still tell which rules were broken.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._automaton = None
+        self._literal_entries = []
+        self._unfiltered = []
+        self._tags = set()
+
+    def add(self, tag, pattern: str):
+        """
+        Add a pattern to the matcher.
+
+        Raises re.error if the pattern isn't a valid regex.
+        """
+        self._entries.append((tag, compile_pattern(pattern), required_literal(pattern)))
+        self._tags.add(tag)
+        self._automaton = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _build(self):
+        literals = {}
+        self._unfiltered = []
+        for index, (_, _, literal) in enumerate(self._entries):
+            if literal is None:
+                self._unfiltered.append(index)
+            else:
+                literals.setdefault(literal, []).append(index)
+        self._automaton = AhoCorasick(literals.keys())
+        self._literal_entries = [literals[word] for word in self._automaton.words]
+
+    def match(self, texts: Iterable[str]) -> set:
+        """
+        Get the tags of every pattern that matches any of the given texts.
+
+        None values in texts are skipped.
+        """
+        if self._automaton is None:
+            self._build()
+        matched = set()
+        for text in texts:
+            if text is None:
+                continue
+            candidates = list(self._unfiltered)
+            for word in self._automaton.search(text):
+                candidates.extend(self._literal_entries[word])
+            for index in sorted(candidates):
+                tag, regex, _ = self._entries[index]
+                if tag not in matched and regex.search(text):
+                    matched.add(tag)
+            if len(matched) == len(self._tags):
+                break
+        return matched
@@ -0,0 +1,86 @@
+"""
+Moderating several instances from one Ivory process.
+
+A config with an "instances" list runs one Ivory per entry, each entry being
+an ordinary Ivory config (settings outside the list apply to every instance
+unless the entry overrides them). The instances share one rule registry, so
+identical rules are only built once and rules share their lookup caches, and
+one pool of I/O worker threads. In watch mode, a shared pool of pass workers
+runs whichever instance's queue is due soonest, so every instance gets its
+turn no matter how busy the others are.
+"""
+import heapq
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import constants
+from ivory import Ivory
+from registry import RuleRegistry
+from schemas import MultiIvoryConfig
+
+
+class MultiIvory:
+    """
+    Runs Ivory for several instances at once.
+    """
+    ivory_class = Ivory
+
+    def __init__(self, raw_config):
+        config = MultiIvoryConfig(raw_config)
+        self._logger = logging.getLogger(__name__)
+        shared = {key: value for key, value in config.items() if key not in ('instances', 'passWorkers')}
+        instance_configs = [dict(shared, **instance) for instance in config['instances']]
+        ledger_paths = [instance['ledgerPath'] for instance in instance_configs if 'ledgerPath' in instance]
+        if len(set(ledger_paths)) < len(ledger_paths):
+            raise ValueError("each instance needs its own ledgerPath")
+
+        self.registry = RuleRegistry(share_rules=True)
+        workers = config.get('workers', constants.DEFAULT_WORKERS)
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ivory-rule")
+        else:
+            self.executor = None
+        self.pass_workers = config.get('passWorkers', constants.DEFAULT_PASS_WORKERS)
+        self.instances = [self.ivory_class(instance, executor=self.executor, registry=self.registry)
+                          for instance in instance_configs]
+        self._logger.info("moderating %d instances", len(self.instances))
+
+    def run(self):
+        """
+        Run one moderation pass on every instance.
+        """
+        for ivory in self.instances:
+            ivory.run()
+
+    def watch(self):
+        """
+        Run every instance's queues on their own schedules (see Ivory.watch),
+        sharing passWorkers threads.
+
+        Passes run earliest-due first, with ties going to whichever has been
+        waiting longest, and each queue only has one pass running at a time.
+        """
+        order = itertools.count()
+        due = [(0, next(order), ivory, queue)
+               for ivory in self.instances
+               for queue in (constants.QUEUE_REPORTS, constants.QUEUE_PENDING_ACCOUNTS)]
+        heapq.heapify(due)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.pass_workers, thread_name_prefix="ivory-pass") as pool:
+            while True:
+                now = time.monotonic()
+                while due and due[0][0] <= now and len(running) < self.pass_workers:
+                    (_, _, ivory, queue) = heapq.heappop(due)
+                    running[pool.submit(ivory.run_queue, queue)] = (ivory, queue)
+                timeout = max(0, due[0][0] - now) if due and len(running) < self.pass_workers else None
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                (done, _) = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (ivory, queue) = running.pop(future)
+                    # an unexpected error in a pass brings Ivory down, as it
+                    # would for a single instance
+                    heapq.heappush(due, (time.monotonic() + future.result(), next(order), ivory, queue))
@@ -0,0 +1,120 @@
+"""
+Judging across several processes.
+
+Building contexts (parsing HTML for links, mostly) and running big regex scans
+is CPU-bound and holds the GIL, so threads can't spread it over more than one
+core. A ProcessJudgePool ships items to worker processes in chunks instead.
+Each worker builds its own copy of a judge from the rule configs the first
+time it sees them, judges its chunks, and sends back which rules were broken by
+index; the parent maps those back to its own rules. Only the parent process
+ever talks to Mastodon.
+
+io_bound rules (link_resolver, stopforumspam) spend their time waiting rather
+than computing, so they stay in the parent: there they run on the judge's
+thread pool and keep their caches across config changes. The workers run every
+other rule, and the parent runs the io_bound ones on whatever items they could
+still change the verdict of.
+"""
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import constants
+from judge import Judge, Rule
+
+# The judges a worker process has built, by judge class, as
+# (rule configs, judge) pairs. Only the latest ruleset for each class is kept.
+_judges = {}
+
+
+def _worker_judge(judge_class, rule_configs: List[dict]) -> Judge:
+    cached = _judges.get(judge_class)
+    if cached is None or cached[0] != rule_configs:
+        cached = (rule_configs, judge_class(rule_configs))
+        _judges[judge_class] = cached
+    return cached[1]
+
+
+def _judge_chunk(judge_class, rule_configs: List[dict], exhaustive: bool, items: List[dict]) -> List[tuple]:
+    """
+    Judge a chunk of items in a worker process, returning a (punishing rule
+    index, broken rule indexes) tuple for each item.
+    """
+    judge = _worker_judge(judge_class, rule_configs)
+    index = {rule: position for position, rule in enumerate(judge.rules)}
+    by_punishment = {id(rule.punishment): position for position, rule in enumerate(judge.rules)}
+    return [(by_punishment[id(punishment)] if punishment is not None else None,
+             sorted(index[rule] for rule in rules_broken))
+            for (punishment, rules_broken) in judge.make_judgements(items, exhaustive)]
+
+
+class ProcessJudgePool:
+    """
+    A pool of worker processes judgements can be spread over.
+    """
+
+    def __init__(self, processes: int, chunk_size: int = constants.PROCESS_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._pool = ProcessPoolExecutor(max_workers=processes)
+        self._logger = logging.getLogger(__name__)
+
+    def make_judgements(self, judge: Judge, items: List[dict], exhaustive: bool = None) -> List[tuple]:
+        """
+        Judge a batch of items with a copy of a judge in the worker processes.
+        See Judge.make_judgements.
+
+        Judges with rules that weren't built from a config are run in this
+        process instead.
+        """
+        rule_configs = judge.rule_configs()
+        if rule_configs is None:
+            self._logger.debug("judge has rules without configs; judging in-process")
+            return judge.make_judgements(items, exhaustive)
+        if exhaustive is None:
+            exhaustive = judge.exhaustive
+        rules = list(judge.rules)
+        remote = [rule for rule in rules if not rule.io_bound]
+        if not remote:
+            return judge.make_judgements(items, exhaustive)
+        if len(remote) == len(rules):
+            return self._judge_remote(judge, rule_configs, rules, items, exhaustive)
+        # the parent needs to know every rule the workers' items break to
+        # work out which io_bound rules could still change their verdicts
+        remote_configs = [config for (rule, config) in zip(rules, rule_configs) if not rule.io_bound]
+        judgements = self._judge_remote(judge, remote_configs, remote, items, True)
+        return self._judge_local(judge, items, exhaustive, [broken for (_, broken) in judgements])
+
+    def _judge_remote(self, judge: Judge, rule_configs: List[dict], rules: List[Rule], items: List[dict],
+                      exhaustive: bool) -> List[tuple]:
+        """
+        Judge items with a judge built from rule_configs in the worker
+        processes, mapping the results back to the parent's rules.
+        """
+        chunks = [items[start:start + self.chunk_size] for start in range(0, len(items), self.chunk_size)]
+        futures = [self._pool.submit(_judge_chunk, type(judge), rule_configs, exhaustive, chunk)
+                   for chunk in chunks]
+        return [(rules[punisher].punishment if punisher is not None else None,
+                 {rules[position] for position in broken})
+                for future in futures for (punisher, broken) in future.result()]
+
+    def _judge_local(self, judge: Judge, items: List[dict], exhaustive: bool, remote_broken: List[set]) -> List[tuple]:
+        """
+        Finish judging items in this process, running the judge's io_bound
+        rules and taking every other rule's results from the workers'.
+        """
+        broken_by_item = {id(item): broken for (item, broken) in zip(items, remote_broken)}
+        judgement = judge._judge(items, exhaustive)
+        try:
+            step = next(judgement)
+            while True:
+                (rule, batch, contexts) = step
+                if rule.io_bound:
+                    results = judge._run_rule(rule, batch, contexts)
+                else:
+                    results = [rule in broken_by_item[id(item)] for item in batch]
+                step = judgement.send(results)
+        except StopIteration as done:
+            return done.value
+
+    def shutdown(self):
+        self._pool.shutdown()
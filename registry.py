@@ -0,0 +1,129 @@
+"""
+The rule registry, which maps the rule types used in configs to Rule classes.
+
+Rule modules (and whatever heavy dependencies they import) are only imported
+the first time a config actually uses their type, and each type is only
+resolved once. Types are looked up in this order:
+
+1. Rule classes registered with RuleRegistry.register()
+2. The built-in rules/ folder (rules/{type}.py, which exposes a `rule`)
+3. Third-party packages advertising rules under the "ivory.rules" entry point
+   group, e.g. in setup.cfg:
+
+       [options.entry_points]
+       ivory.rules =
+           my_rule = my_package.my_rule:MyRule
+
+A registry can also share rules between the judges that use it (as it does
+when one process moderates several instances): identical rule configs get the
+same Rule, and rules with a share_caches(caches) method are handed a dict of
+caches shared by every rule built by the registry.
+"""
+import json
+import logging
+import weakref
+from importlib import import_module, metadata
+
+# Entry point group third-party rules are discovered under
+ENTRY_POINT_GROUP = "ivory.rules"
+
+
+def _entry_points(group: str):
+    """
+    Get the installed entry points in a group.
+    """
+    eps = metadata.entry_points()
+    if hasattr(eps, "select"):
+        return eps.select(group=group)
+    # Python < 3.10
+    return eps.get(group, [])
+
+
+def config_key(rule_config: dict) -> str:
+    """
+    Get a string that's equal for two rule configs if and only if the configs
+    are.
+    """
+    return json.dumps(rule_config, sort_keys=True, default=str)
+
+
+class RuleRegistry:
+    """
+    Resolves rule types to Rule classes, lazily and at most once per type.
+
+    If share_rules is set, build() hands out one Rule per distinct config
+    (for as long as something is using it) and shares caches between rules.
+    """
+
+    def __init__(self, share_rules: bool = False):
+        self._types = {}
+        self._entry_points = None
+        self.share_rules = share_rules
+        self._rules = weakref.WeakValueDictionary()
+        self.caches = {}
+        self._logger = logging.getLogger(__name__)
+
+    def register(self, rule_type: str, rule_class):
+        """
+        Register a Rule class under a type name, taking priority over built-in
+        and entry point rules.
+        """
+        self._types[rule_type] = rule_class
+
+    def _discover(self) -> dict:
+        """
+        Find the rules installed packages provide, the first time it's needed.
+        """
+        if self._entry_points is None:
+            self._entry_points = {ep.name: ep for ep in _entry_points(ENTRY_POINT_GROUP)}
+            self._logger.debug("discovered %d rule entry points", len(self._entry_points))
+        return self._entry_points
+
+    def _resolve(self, rule_type: str):
+        module_name = "rules.{}".format(rule_type)
+        try:
+            return import_module(module_name).rule
+        except ModuleNotFoundError as err:
+            # only fall through if it's the rule module itself that's missing,
+            # not something it imports
+            if err.name not in (module_name, "rules"):
+                raise
+        entry_point = self._discover().get(rule_type)
+        if entry_point is None:
+            raise ModuleNotFoundError("no rule of type {}".format(rule_type), name=module_name)
+        loaded = entry_point.load()
+        # entry points can point at either a rule module or a Rule class
+        return getattr(loaded, "rule", loaded)
+
+    def get(self, rule_type: str):
+        """
+        Get the Rule class for a rule type.
+
+        Raises ModuleNotFoundError if there's no rule of that type.
+        """
+        if rule_type not in self._types:
+            self._logger.debug("resolving rule type %s", rule_type)
+            self._types[rule_type] = self._resolve(rule_type)
+        return self._types[rule_type]
+
+    def build(self, rule_config: dict, share: bool = True):
+        """
+        Create a rule from its configuration dict, or reuse an identical one
+        if the registry shares rules (and share isn't turned off).
+        """
+        if not (self.share_rules and share):
+            return self.get(rule_config['type'])(rule_config)
+        key = config_key(rule_config)
+        rule = self._rules.get(key)
+        if rule is None:
+            rule = self.get(rule_config['type'])(rule_config)
+            if hasattr(rule, "share_caches"):
+                rule.share_caches(self.caches)
+            self._rules[key] = rule
+        else:
+            self._logger.debug("sharing existing %s rule", rule_config['type'])
+        return rule
+
+
+# The registry judges use by default
+default_registry = RuleRegistry()
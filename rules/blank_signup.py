@@ -1,13 +1,12 @@
-import re
-
 from judge import Rule
+from context import PendingAccountContext
 from schemas import PendingAcctRule
 
 class BlankSignupRule(Rule):
     def __init__(self, raw_config):
         config = PendingAcctRule(raw_config)
         Rule.__init__(self, **config)
-    def test_pending_account(self, account: dict):
+    def test_pending_account(self, account: dict, context: PendingAccountContext = None):
         """
         Test if a pending account's join reason is blank.
         """
@@ -0,0 +1,74 @@
+from typing import List
+
+from judge import Rule
+from blocklist import DomainSet, load_domain_file
+from blocklist_index import open_index
+from context import ReportContext, PendingAccountContext
+import schemas
+
+class DomainBlocklistRule(Rule):
+    """
+    A rule which checks domains against blocklists: the hosts of a report's
+    links, or a pending account's email domain. Blocking a domain blocks its
+    subdomains too.
+
+    Built for lists too long to write as link_content regexes; each check
+    costs the same no matter how many domains are blocked. Lists can also come
+    from a prebuilt index file (see blocklist_index), which can block pending
+    accounts' email and IP addresses too.
+    """
+
+    def __init__(self, raw_config):
+        config = schemas.DomainBlocklistRule(raw_config)
+        Rule.__init__(self, **config)
+        self.files = config.get('files', [])
+        self.index = config.get('index')
+        self.blocked = DomainSet(config.get('domains', []))
+        # load the files now, so a missing one is a config error
+        self.blocklists()
+
+    def blocklists(self) -> list:
+        """
+        Get the sets to check against (DomainSets, and the index if there is
+        one), picking up changes to the files.
+        """
+        blocklists = [self.blocked] + [load_domain_file(path) for path in self.files]
+        if self.index is not None:
+            blocklists.append(open_index(self.index))
+        return blocklists
+
+    def is_blocked(self, domain: str, blocklists: List[DomainSet] = None) -> bool:
+        if not domain:
+            return False
+        return any(domain in blocklist for blocklist in blocklists or self.blocklists())
+
+    def test_report(self, report: dict, context: ReportContext = None, blocklists: List[DomainSet] = None):
+        context = context or ReportContext(report)
+        blocklists = blocklists or self.blocklists()
+        return any(self.is_blocked(hostname, blocklists) for hostname in context.hostnames)
+
+    def test_pending_account(self, account: dict, context: PendingAccountContext = None,
+                             blocklists: List[DomainSet] = None):
+        context = context or PendingAccountContext(account)
+        blocklists = blocklists or self.blocklists()
+        if self.is_blocked(context.email_domain, blocklists):
+            return True
+        if self.index is None:
+            return False
+        index = blocklists[-1]
+        return index.has_email(account.get('email')) or index.has_ip(account.get('ip'))
+
+    def test_reports(self, reports: List[dict], contexts: List[ReportContext] = None):
+        if contexts is None:
+            contexts = [ReportContext(report) for report in reports]
+        blocklists = self.blocklists()
+        return [self.test_report(report, context, blocklists) for report, context in zip(reports, contexts)]
+
+    def test_pending_accounts(self, accounts: List[dict], contexts: List[PendingAccountContext] = None):
+        if contexts is None:
+            contexts = [PendingAccountContext(account) for account in accounts]
+        blocklists = self.blocklists()
+        return [self.test_pending_account(account, context, blocklists)
+                for account, context in zip(accounts, contexts)]
+
+rule = DomainBlocklistRule
@@ -1,27 +1,14 @@
-import re
-from judge import Rule
-from util import parse_links_from_statuses
+from judge import RegexRule
 
 from schemas import RegexBlockingRule
 
-class LinkContentRule(Rule):
+class LinkContentRule(RegexRule):
     """
     A rule which checks for banned link content.
     """
+    report_fields = ("links",)
     def __init__(self, raw_config):
         config = RegexBlockingRule(raw_config)
-        Rule.__init__(self, **config)
-        self.blocked = []
-        for regex in config['blocked']:
-            self.blocked.append(re.compile(regex))
-    def test_report(self, report: dict):
-        """
-        Test if a post's links matches any of the given blocked regexes.
-        """
-        for link in parse_links_from_statuses(report['statuses']):
-            for regex in self.blocked:
-                if regex.search(link):
-                    return True
-        return False
+        RegexRule.__init__(self, **config)
 
 rule = LinkContentRule
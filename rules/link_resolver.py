@@ -1,10 +1,27 @@
-import re
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from urllib.parse import urlsplit
+
 import requests
+from voluptuous import All, Any, Range
+
+import constants
+import schemas
 from judge import Rule
-from constants import VERSION
-from util import parse_links_from_statuses
+from matcher import PatternMatcher
+from constants import VERSION, RULE_COST_NETWORK, LINK_CACHE_SIZE, LINK_CACHE_TTL
+from context import ReportContext
+from util import CircuitBreaker, ConcurrencyLimiter, TTLCache, canonicalize_url
 
-from schemas import RegexBlockingRule
+Config = schemas.RegexBlockingRule.extend({
+    "connectTimeout": All(Any(int, float), Range(min=0, min_included=False)),
+    "readTimeout": All(Any(int, float), Range(min=0, min_included=False)),
+    "maxConcurrency": All(int, Range(min=1)),
+    "perHostConcurrency": All(int, Range(min=1)),
+    "breakerThreshold": All(int, Range(min=1)),
+    "breakerCooldown": All(Any(int, float), Range(min=0)),
+})
 
 # HTTP headers for the LinkResolverRule.
 # Certain URL shorteners require us to set a valid non-generic user agent.
@@ -13,22 +30,110 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0 IvoryAutomod/" + VERSION
 }
 
+# Errors that mean a host isn't answering, as opposed to the link being bad
+HOST_ERRORS = (requests.Timeout, requests.ConnectionError)
+
 class LinkResolverRule(Rule):
     """
     A rule which checks for banned links, resolving links to prevent shorturl
     mitigation.
+
+    Links are followed over a pooled session with timeouts, several at once
+    (up to maxConcurrency in total and perHostConcurrency per host). A host
+    that times out breakerThreshold times in a row is skipped for
+    breakerCooldown seconds. Links that can't be followed are checked as they
+    are.
+
+    Links are followed on the judge's thread pool if it has one (so Ivory's
+    workers setting caps how many are in flight too), or on the rule's own
+    pool of maxConcurrency threads if it doesn't.
     """
+    cost = RULE_COST_NETWORK
+    io_bound = True
+
     def __init__(self, raw_config):
-        config = RegexBlockingRule(raw_config)
+        config = Config(raw_config)
         Rule.__init__(self, **config)
         self.blocked = config['blocked']
-    def test_report(self, report: dict):
-        for link in parse_links_from_statuses(report['statuses']):
-            response = requests.head(link, allow_redirects=True, headers=HEADERS)
-            resolved_url = response.url
-            for regex in self.blocked:
-                if re.search(regex, resolved_url):
-                    return True
-        return False
+        self.matcher = PatternMatcher()
+        for pattern in self.blocked:
+            self.matcher.add(self, pattern)
+        self.timeout = (config.get('connectTimeout', constants.DEFAULT_LINK_CONNECT_TIMEOUT),
+                        config.get('readTimeout', constants.DEFAULT_LINK_READ_TIMEOUT))
+        self.max_concurrency = config.get('maxConcurrency', constants.DEFAULT_LINK_CONCURRENCY)
+        per_host = config.get('perHostConcurrency', constants.DEFAULT_LINK_HOST_CONCURRENCY)
+        threshold = config.get('breakerThreshold', constants.DEFAULT_LINK_BREAKER_THRESHOLD)
+        cooldown = config.get('breakerCooldown', constants.DEFAULT_LINK_BREAKER_COOLDOWN)
+        # rules with the same connection settings share connections and limits
+        self.settings = (self.timeout, self.max_concurrency, per_host, threshold, cooldown)
+        # Where links we've followed recently ended up
+        self.resolved = TTLCache(LINK_CACHE_SIZE, LINK_CACHE_TTL)
+        # keep-alive connections, shared by every link followed
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.limiter = ConcurrencyLimiter(self.max_concurrency, per_host)
+        self.breaker = CircuitBreaker(threshold, cooldown)
+        # for following links when the judge has no pool; threads are only
+        # started once it's used
+        self.pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="ivory-links")
+        self._logger = logging.getLogger(__name__)
+    def share_caches(self, caches: dict):
+        """
+        Share resolved links with every other link_resolver rule using these
+        caches, and connections, concurrency limits and failing hosts with
+        the ones that have the same connection settings.
+        """
+        shared = caches.setdefault("link_resolver", {})
+        self.resolved = shared.setdefault("resolved", self.resolved)
+        (self.session, self.limiter, self.breaker, self.pool) = shared.setdefault(
+            self.settings, (self.session, self.limiter, self.breaker, self.pool))
+    def resolve(self, link: str):
+        """
+        Follow a (canonical) link's redirects, returning the canonical form of
+        the URL it ends up at, or the link itself if it couldn't be followed.
+        """
+        resolved = self.resolved.get(link)
+        if resolved is not None:
+            return resolved
+        host = urlsplit(link).hostname
+        if not self.breaker.allow(host):
+            self._logger.debug("%s keeps timing out; not following %s", host, link)
+            return link
+        try:
+            with self.limiter.limit(host):
+                url = self.session.head(link, allow_redirects=True, headers=HEADERS, timeout=self.timeout).url
+        except requests.RequestException as err:
+            if isinstance(err, HOST_ERRORS):
+                self.breaker.failed(host)
+            self._logger.warning("couldn't follow %s: %s", link, err)
+            return link
+        self.breaker.succeeded(host)
+        resolved = canonicalize_url(url) or url
+        self.resolved.set(link, resolved)
+        return resolved
+    def resolve_all(self, links: List[str]) -> List[str]:
+        """
+        Follow several links at once. See resolve.
+        """
+        if len(links) < 2:
+            return [self.resolve(link) for link in links]
+        if self.executor is not None:
+            return self.map(self.resolve, links)
+        return list(self.pool.map(self.resolve, links))
+    def test_report(self, report: dict, context: ReportContext = None):
+        context = context or ReportContext(report)
+        return bool(self.matcher.match(self.resolve_all(context.canonical_links)))
+    def test_reports(self, reports: List[dict], contexts: List[ReportContext] = None):
+        """
+        Test a batch of reports, resolving each distinct link only once.
+        """
+        if contexts is None:
+            contexts = [ReportContext(report) for report in reports]
+        links = list(dict.fromkeys(link for context in contexts for link in context.canonical_links))
+        resolved = dict(zip(links, self.resolve_all(links)))
+        return [bool(self.matcher.match(resolved[link] for link in context.canonical_links))
+                for context in contexts]
 
 rule = LinkResolverRule
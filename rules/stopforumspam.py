@@ -1,19 +1,30 @@
 from judge import Rule
+from context import PendingAccountContext
 import requests
 import logging
+import threading
+from typing import List
 
 import schemas
+from constants import RULE_COST_NETWORK, STOPFORUMSPAM_CONNECT_TIMEOUT, STOPFORUMSPAM_READ_TIMEOUT
 from voluptuous import Required, Range
 
 Config = schemas.Rule.extend({
     Required("threshold"): Range(min=0, max=100)
 })
 
+# StopForumSpam's API URL, and the most emails/IPs it takes in one query.
+API_URL = "https://api.stopforumspam.org/api"
+MAX_QUERY_SIZE = 15
+
 class StopForumSpamRule(Rule):
     """
     A rule which pings StopForumSpam's API to see if a user is a reported
     spammer.
     """
+    cost = RULE_COST_NETWORK
+    io_bound = True
+
     def __init__(self, raw_config):
         # Validate configuration
         config = Config(raw_config)
@@ -23,8 +34,25 @@ class StopForumSpamRule(Rule):
         self.tested_emails = set()
         self.ip_confidences = {}
         self.tested_ips = set()
+        # Emails and IPs being looked up right now, as ("email"/"ip", value)
+        # keys, each with an Event that's set once its lookup is done, so
+        # concurrent batches wait on each other's lookups instead of
+        # repeating them
+        self.in_flight = {}
+        # Guards the caches (but isn't held during lookups)
+        self._lock = threading.Lock()
         self.threshold = config['threshold']
 
+    def share_caches(self, caches: dict):
+        """
+        Share known emails and IPs with every other StopForumSpam rule using
+        these caches. (Confidences don't depend on the rule's threshold.)
+        """
+        (self.email_confidences, self.tested_emails, self.ip_confidences, self.tested_ips,
+         self.in_flight, self._lock) = caches.setdefault("stopforumspam", (
+             self.email_confidences, self.tested_emails, self.ip_confidences, self.tested_ips,
+             self.in_flight, self._lock))
+
     def calc_confidence(self, ip_confidence, email_confidence):
         if not email_confidence and not ip_confidence:
             return False
@@ -35,44 +63,104 @@ class StopForumSpamRule(Rule):
         else:
             return max([float(email_confidence), float(ip_confidence)]) >= self.threshold
 
-    def test_pending_account(self, account: dict):
+    @staticmethod
+    def _entries(results: dict, key: str, values: List[str]):
         """
-        Test if the reported user's email is listed in StopForumSpam's
-        database.
+        Pair up queried values with their results. Single-value queries get
+        a single result back, while multi-value queries get a list of results
+        that carry the value they're for.
+        """
+        entries = results.get(key)
+        if not entries:
+            return []
+        if isinstance(entries, dict):
+            return [(values[0], entries)]
+        return [(entry.get('value'), entry) for entry in entries]
+
+    def _query_chunk(self, emails: List[str], ips: List[str]) -> dict:
+        """
+        Make a single query to StopForumSpam's API.
 
         See https://www.stopforumspam.com/usage for how we're interfacing with
         the API here.
         """
-        email = account['email']
-        ip = account['ip']
-        if email in self.tested_emails and ip in self.tested_ips:
-            self._logger.debug("looks like we've already tested for this user and ip; recalculating to be sure")
-            judgement = self.calc_confidence(self.ip_confidences.get(ip), self.email_confidences.get(email))
-            return judgement
-
-        params = {
-            "email": email,
-            "ip": ip,
-            "json": ''
-        }
-        resp = requests.get("https://api.stopforumspam.org/api", params=params)
+        if len(emails) <= 1 and len(ips) <= 1:
+            params = {"email": emails, "ip": ips, "json": ''}
+        else:
+            params = {"email[]": emails, "ip[]": ips, "json": ''}
+        resp = requests.get(API_URL, params=params,
+                            timeout=(STOPFORUMSPAM_CONNECT_TIMEOUT, STOPFORUMSPAM_READ_TIMEOUT))
         results = resp.json()
-        print(results)
+        self._logger.debug("stopforumspam results: %s", results)
+        return results
 
-        ip_confidence = results.get('ip').get('confidence')
-        email_confidence = results.get('email').get('confidence')
-        if ip_confidence:
-            self.ip_confidences[ip] = ip_confidence
-        if email_confidence:
-            self.email_confidences[email] = email_confidence
-        self.tested_emails.add(email)
-        self.tested_ips.add(ip)
+    def query(self, emails: List[str], ips: List[str]):
+        """
+        Look up emails and IPs in StopForumSpam's database, caching their
+        confidences. Large lookups are split into several queries, which run
+        concurrently if the rule has an executor.
+        """
+        starts = range(0, max(len(emails), len(ips)), MAX_QUERY_SIZE)
+        email_chunks = [emails[start:start + MAX_QUERY_SIZE] for start in starts]
+        ip_chunks = [ips[start:start + MAX_QUERY_SIZE] for start in starts]
+        chunk_results = self.map(self._query_chunk, email_chunks, ip_chunks)
+        with self._lock:
+            for email_chunk, ip_chunk, results in zip(email_chunks, ip_chunks, chunk_results):
+                for email, result in self._entries(results, 'email', email_chunk):
+                    if result.get('confidence'):
+                        self.email_confidences[email] = result.get('confidence')
+                for ip, result in self._entries(results, 'ip', ip_chunk):
+                    if result.get('confidence'):
+                        self.ip_confidences[ip] = result.get('confidence')
+                self.tested_emails.update(email_chunk)
+                self.tested_ips.update(ip_chunk)
 
-        judgement = self.calc_confidence(ip_confidence, email_confidence)
-        self._logger.debug("ip confidence {}".format(ip_confidence))
-        self._logger.debug("email confidence {}".format(email_confidence))
-        self._logger.debug("judgement: {}".format(judgement))
+    def test_pending_account(self, account: dict, context: PendingAccountContext = None):
+        """
+        Test if the reported user's email is listed in StopForumSpam's
+        database.
+        """
+        return self.test_pending_accounts([account])[0]
 
-        return judgement
+    def test_pending_accounts(self, accounts: List[dict], contexts: List[PendingAccountContext] = None):
+        """
+        Test a batch of pending accounts, looking up every email and IP we
+        haven't seen before in as few queries as possible.
+        """
+        with self._lock:
+            # claim the emails and IPs nobody's looked up yet, and note which
+            # are already being looked up by other batches
+            keys = {("email", account['email']) for account in accounts
+                    if account['email'] not in self.tested_emails}
+            keys |= {("ip", account['ip']) for account in accounts if account['ip'] not in self.tested_ips}
+            waiting = {self.in_flight[key] for key in keys if key in self.in_flight}
+            claimed = sorted(key for key in keys if key not in self.in_flight)
+            done = threading.Event()
+            for key in claimed:
+                self.in_flight[key] = done
+        if claimed:
+            try:
+                self.query([value for (kind, value) in claimed if kind == "email"],
+                           [value for (kind, value) in claimed if kind == "ip"])
+            finally:
+                with self._lock:
+                    for key in claimed:
+                        del self.in_flight[key]
+                done.set()
+        elif not waiting:
+            self._logger.debug("looks like we've already tested for these users and ips; recalculating to be sure")
+        for event in waiting:
+            event.wait()
+        with self._lock:
+            confidences = [(self.ip_confidences.get(account['ip']), self.email_confidences.get(account['email']))
+                           for account in accounts]
+        judgements = []
+        for ip_confidence, email_confidence in confidences:
+            judgement = self.calc_confidence(ip_confidence, email_confidence)
+            self._logger.debug("ip confidence {}".format(ip_confidence))
+            self._logger.debug("email confidence {}".format(email_confidence))
+            self._logger.debug("judgement: {}".format(judgement))
+            judgements.append(judgement)
+        return judgements
 
 rule = StopForumSpamRule
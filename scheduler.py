@@ -0,0 +1,85 @@
+"""
+Pass scheduling for Ivory.
+
+Each queue gets its own Schedule in watch mode, which works out how long to
+wait before the queue's next pass. Busy queues (ones whose last pass had items
+to handle) are checked more often and quiet ones less, always within the
+queue's configured bounds, and never more often than passes actually take to
+run.
+
+Passes can also be given a PassBudget of time and API calls, so a huge queue
+can't make one pass run on indefinitely.
+"""
+import time
+
+# How much a busy pass shrinks the interval, and a quiet one grows it
+SCHEDULE_SHRINK = 0.5
+SCHEDULE_GROW = 1.5
+
+
+class Schedule:
+    """
+    The interval between passes of one queue.
+
+    With min_wait_time and max_wait_time both equal to wait_time (the
+    default), this is just a fixed interval.
+    """
+
+    def __init__(self, wait_time: float, min_wait_time: float = None, max_wait_time: float = None):
+        self.interval = wait_time
+        self.configure(wait_time, min_wait_time, max_wait_time)
+
+    def configure(self, wait_time: float, min_wait_time: float = None, max_wait_time: float = None):
+        """
+        Change the schedule's bounds, keeping the current interval if it's
+        still within them.
+        """
+        self.min_wait_time = wait_time if min_wait_time is None else min(min_wait_time, wait_time)
+        self.max_wait_time = wait_time if max_wait_time is None else max(max_wait_time, wait_time)
+        self.interval = self._clamp(self.interval)
+
+    def _clamp(self, interval: float) -> float:
+        return min(self.max_wait_time, max(self.min_wait_time, interval))
+
+    def update(self, depth: int, duration: float) -> float:
+        """
+        Adapt the interval to a pass that handled depth items and took
+        duration seconds.
+
+        Returns how long to wait before the next pass.
+        """
+        interval = self.interval * (SCHEDULE_SHRINK if depth else SCHEDULE_GROW)
+        self.interval = self._clamp(max(interval, duration))
+        return max(0, self.interval - duration)
+
+
+class PassBudget:
+    """
+    How much time and how many API calls a pass has left. Either limit can be
+    None, for no limit.
+    """
+
+    def __init__(self, seconds: float = None, calls: int = None):
+        self.deadline = time.monotonic() + seconds if seconds is not None else None
+        self.calls = calls
+
+    @property
+    def limited(self) -> bool:
+        """
+        Whether the pass has any budget at all.
+        """
+        return self.deadline is not None or self.calls is not None
+
+    def spend(self, calls: int = 1):
+        """
+        Count API calls against the budget.
+        """
+        if self.calls is not None:
+            self.calls -= calls
+
+    def exhausted(self) -> bool:
+        """
+        Whether the pass has run out of time or API calls.
+        """
+        return ((self.calls is not None and self.calls <= 0)
+                or (self.deadline is not None and time.monotonic() >= self.deadline))
@@ -1,7 +1,7 @@
 """
 Config schemas used in Ivory and its rules.
 """
-from voluptuous import Schema, Required, Any, Url, ALLOW_EXTRA
+from voluptuous import Schema, Required, Any, All, Length, Range, Url, ALLOW_EXTRA
 import constants
 
 ReportPunishment = Schema({
@@ -24,6 +24,8 @@ Rule = Schema({
     Required("name"): str,
     Required("type"): str,
     Required("severity"): int,
+    # only used by async rules
+    "concurrency": All(int, Range(min=1)),
 }, extra=ALLOW_EXTRA)
 
 ReportRule = Rule.extend({
@@ -34,12 +36,35 @@ PendingAcctRule = Rule.extend({
     Required("punishment"): PendingAcctPunishment
 })
 
+# Per-queue scheduling in watch mode
+QueueSchedule = {
+    "waitTime": All(int, Range(min=0)),
+    "minWaitTime": All(int, Range(min=0)),
+    "maxWaitTime": All(int, Range(min=0)),
+}
+
 Reports = Schema({
-    Required("rules"): [ReportRule]
+    Required("rules"): [ReportRule],
+    **QueueSchedule
 })
 
 PendingAccounts = Schema({
-    Required("rules"): [PendingAcctRule]
+    Required("rules"): [PendingAcctRule],
+    **QueueSchedule
+})
+
+Webhook = Schema({
+    Required("secret"): str,
+    "host": str,
+    "port": All(int, Range(min=0, max=65535)),
+    "reconcileInterval": All(int, Range(min=1)),
+})
+
+WorkQueue = Schema({
+    Required("path"): str,
+    "workerName": str,
+    "leaseTime": All(int, Range(min=1)),
+    "batchSize": All(int, Range(min=1)),
 })
 
 IvoryConfig = Schema({
@@ -48,14 +73,40 @@ IvoryConfig = Schema({
     Required("instanceURL"): str,
     "waitTime": int,
     "dryRun": bool,
+    "audit": bool,
+    "workers": All(int, Range(min=1)),
+    "processes": All(int, Range(min=1)),
+    "ledgerPath": str,
+    "dispatchWorkers": All(int, Range(min=1)),
+    "maxTries": All(int, Range(min=1)),
+    "incremental": bool,
+    "fullSweepInterval": All(int, Range(min=0)),
+    "passTimeBudget": All(int, Range(min=1)),
+    "passCallBudget": All(int, Range(min=1)),
+    "webhook": Webhook,
+    "workQueue": WorkQueue,
     "logLevel": Any("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"),
     "reports": Reports,
     "pendingAccounts": PendingAccounts
 })
 
+# Several instances' configs; each is checked against IvoryConfig, along with
+# the settings outside the list they inherit
+MultiIvoryConfig = Schema({
+    Required("instances"): All([dict], Length(min=1)),
+    "passWorkers": All(int, Range(min=1)),
+}, extra=ALLOW_EXTRA)
+
 # Schemas used by several rules
 
 RegexBlockingRule = Rule.extend({
     Required("blocked"): [str]
 })
 
+DomainBlocklistRule = Rule.extend({
+    Required(Any("files", "domains", "index"), msg="give a blocklist in files, domains and/or index"): object,
+    "files": [str],
+    "domains": [str],
+    "index": str,
+})
+
@@ -1,6 +1,11 @@
+from copy import deepcopy
+
 import pytest
 import requests
 
+import ivory
+
+
 @pytest.fixture(autouse=True)
 def disable_requests(monkeypatch):
     """
@@ -206,3 +211,137 @@ def status(account, status_tag):
             "poll": None
         }
     return _status
+
+IVORY_CONFIG = {
+  "token": "testtoken",
+  "instanceURL": "https://testinstance.local",
+  "waitTime": 300,
+  "logLevel": "DEBUG",
+  "reports": {
+    "rules": [
+      {
+        "name": "No bad usernames",
+        "type": "username_content",
+        "blocked": ["badword"],
+        "severity": 1,
+        "punishment": {
+          "type": "suspend",
+          "message": "Your account has been suspended for spamming."
+        }
+      },
+      {
+        "name": "No badwords",
+        "type": "message_content",
+        "blocked": ["badword"],
+        "severity": 1,
+        "punishment": {
+          "type": "disable",
+          "message": "Your account has been disabled for having a badword in a message."
+        }
+      }
+    ]
+  },
+  "pendingAccounts": {
+    "rules": [
+      {
+        "name": "No probbox spammers",
+        "type": "message_content",
+        "blocked": ["badword", "slur[^p]"],
+        "severity": 1,
+        "punishment": {
+          "type": "reject"
+        }
+      },
+      {
+        "name": "No mewkid spammers",
+        "type": "username_content",
+        "blocked": ["badword", "slur[^p]"],
+        "severity": 1,
+        "punishment": {
+          "type": "reject"
+        }
+      }
+    ]
+  }
+}
+
+@pytest.fixture
+def ivoryconfig():
+    """
+    A config for an Ivory instance with a few report and pending account
+    rules.
+    """
+    return deepcopy(IVORY_CONFIG)
+
+@pytest.fixture
+def generate_mockstodon(monkeypatch):
+    """
+    Replace Mastodon.py completely with a custom copy that replicates the functions Ivory uses.
+
+    I hate having to do this but I don't know if there's really a better way to
+    test without doing this...
+    """
+    def _generate_mockstodon(**kwargs):
+        class Mockstodon():
+            # Static values we check in the tests
+            # these are 4-tuples in the form of:
+            # (account id, action, report id, message)
+            moderation_actions = []
+            # kwargs of each call fetching a queue
+            fetches = []
+            # reports resolved without a moderation action of their own
+            resolved_reports = []
+            accounts = []
+            reports = []
+            def __init__(self, **kwargs):
+                # We don't actually use these values internally, we just want to make sure Mastodon.py is getting passed the right stuff
+                assert kwargs.get("access_token") == IVORY_CONFIG['token']
+                assert kwargs.get("api_base_url") == IVORY_CONFIG['instanceURL']
+            def verify_minimum_version(self, version):
+                return True
+            def instance(self):
+                return {
+                    "uri": IVORY_CONFIG['instanceURL'],
+                }
+            def account_verify_credentials(self):
+                return {
+                    "username": "testuser"
+                }
+            def first_page(self, pages, max_id=None, **kwargs):
+                if max_id is None:
+                    return pages[0]
+                for page in pages:
+                    if page and int(page[0]['id']) < max_id:
+                        return page
+                return []
+            def admin_reports(self, **kwargs):
+                self.fetches.append(kwargs)
+                return self.first_page(self.report_pages, **kwargs)
+            def admin_accounts(self, **kwargs):
+                self.fetches.append(kwargs)
+                if kwargs.get("status") == "pending":
+                    return self.first_page(self.account_pages, **kwargs)
+                else:
+                    assert kwargs.get("status") == "pending"
+            def fetch_next(self, page):
+                for pages in (self.report_pages, self.account_pages):
+                    for index, candidate in enumerate(pages[:-1]):
+                        if candidate is page:
+                            return pages[index + 1]
+                return None
+            def admin_account_reject(self, acct_id):
+                self.moderation_actions.append((acct_id, "reject", None, None))
+                return
+            def admin_account_moderate(self, acct_id, action, report_id, **kwargs):
+                self.moderation_actions.append((acct_id,action,report_id, kwargs.get("message")))
+                return
+            def admin_report_resolve(self, report_id):
+                self.resolved_reports.append(report_id)
+        # queues can be given either as a single page or a list of pages
+        Mockstodon.report_pages = kwargs.get("report_pages") or [kwargs.get("reports")]
+        Mockstodon.account_pages = kwargs.get("account_pages") or [kwargs.get("accounts")]
+        Mockstodon.reports = Mockstodon.report_pages[0]
+        Mockstodon.accounts = Mockstodon.account_pages[0]
+        monkeypatch.setattr(ivory, "Mastodon", Mockstodon)
+        return Mockstodon
+    return _generate_mockstodon
@@ -0,0 +1,113 @@
+import pytest
+import asyncio
+
+from async_ivory import AsyncIvory, AsyncRule, AsyncReportJudge
+from judge import Rule, ReportJudge
+from registry import RuleRegistry
+
+class SlowRule(AsyncRule):
+    """
+    An async rule that tracks how many of its tests are running at once.
+    """
+    def __init__(self, **config):
+        AsyncRule.__init__(self, **config)
+        self.running = 0
+        self.most_running = 0
+    async def test_report(self, report, context=None):
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        return report['id'] == "3"
+
+class SyncRule(Rule):
+    def test_report(self, report, context=None):
+        return report['id'] == "5"
+
+def test_async_judge(report):
+    judge = AsyncReportJudge()
+    slow = SlowRule(name="slow", severity=2, concurrency=3, punishment={"type": "suspend"})
+    judge.add_rule(slow)
+    judge.add_rule(SyncRule(name="sync", severity=1, punishment={"type": "silence"}))
+    reports = [report(report_id=str(i)) for i in range(10)]
+    judgements = asyncio.run(judge.make_judgements_async(reports))
+    assert [punishment.type if punishment else None for (punishment, _) in judgements] == \
+        [None, None, None, "suspend", None, "silence", None, None, None, None]
+    assert slow.most_running == 3
+    assert judge.stats[slow].runs == 10
+    # rules can be reused across event loops
+    assert asyncio.run(judge.make_judgement_async(report(report_id="3")))[0].type == "suspend"
+
+def test_sync_judges_refuse_async_rules():
+    slow = {"name": "slow", "type": "slow", "severity": 1, "punishment": {"type": "suspend"}}
+    with pytest.raises(ValueError):
+        ReportJudge().add_rule(SlowRule(**slow))
+    # including ones loaded from config
+    registry = RuleRegistry()
+    registry.register("slow", lambda config: SlowRule(**config))
+    with pytest.raises(ValueError):
+        ReportJudge([slow], registry=registry)
+    assert len(AsyncReportJudge([slow], registry=registry).rules) == 1
+
+def test_run_async(generate_mockstodon, report, pending_account, ivoryconfig):
+    Mockstodon = generate_mockstodon(reports=[
+        report(reported={"username": "badword", "account": {"username": "badword"}}),
+        report()
+    ], accounts=[
+        pending_account(),
+        pending_account(message="badword")
+    ])
+    i = AsyncIvory(ivoryconfig)
+    asyncio.run(i.run_async())
+    assert sorted(Mockstodon.moderation_actions) == [
+        ('1', 'reject', None, None),
+        ('1', 'suspend', '1', None)
+    ]
+
+class GateRule(AsyncRule):
+    """
+    An async rule that holds its tests up until the test lets them go.
+    """
+    # (started, resume) events, made in the test's event loop
+    gate = None
+    def __init__(self, config):
+        AsyncRule.__init__(self, **config)
+    async def test_report(self, report, context=None):
+        (started, resume) = GateRule.gate
+        started.set()
+        await resume.wait()
+        return False
+
+def test_watch_async_reload_waits_for_passes(generate_mockstodon, tmp_path, report, ivoryconfig):
+    import json
+    from copy import deepcopy
+    Mockstodon = generate_mockstodon(reports=[
+        report(statuses=[{"content": "badword"}])
+    ], accounts=[])
+    config = deepcopy(ivoryconfig)
+    # the gate runs first, and the other rules after it
+    config['reports']['rules'].append({"name": "Gate", "type": "gate", "severity": 2,
+                                       "punishment": {"type": "suspend"}})
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(config))
+    registry = RuleRegistry()
+    registry.register("gate", GateRule)
+    i = AsyncIvory(config, str(config_path), registry=registry)
+    new_config = deepcopy(ivoryconfig)
+    del new_config['reports']['rules'][0]
+    async def watch():
+        GateRule.gate = (asyncio.Event(), asyncio.Event())
+        reports = asyncio.ensure_future(i.run_queue_async("reports"))
+        await GateRule.gate[0].wait()
+        # reload while the reports pass is partway through judging
+        config_path.write_text(json.dumps(new_config))
+        i.request_reload()
+        pending = asyncio.ensure_future(i.run_queue_async("pendingAccounts"))
+        await asyncio.sleep(0.05)
+        assert not pending.done()
+        assert len(i.report_judge.rules) == 3
+        GateRule.gate[1].set()
+        await asyncio.gather(reports, pending)
+    asyncio.run(watch())
+    assert Mockstodon.moderation_actions == [('1', 'disable', '1', None)]
+    assert len(i.report_judge.rules) == 1
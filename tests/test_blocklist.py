@@ -0,0 +1,40 @@
+import os
+
+from blocklist import DomainSet, load_domain_file, parse_domain
+
+def test_parse_domain():
+    assert parse_domain("evil.example") == "evil.example"
+    assert parse_domain("  Evil.Example.  # spam") == "evil.example"
+    assert parse_domain("0.0.0.0 evil.example") == "evil.example"
+    assert parse_domain("*.evil.example") == "evil.example"
+    assert parse_domain("||evil.example^") == "evil.example"
+    assert parse_domain("xn--bcher-kva.example") == "bücher.example"
+    assert parse_domain("# just a comment") is None
+    assert parse_domain("127.0.0.1 localhost") is None
+    assert parse_domain("") is None
+
+def test_domain_set():
+    domains = DomainSet(["evil.example", "bad.co.uk"])
+    assert "evil.example" in domains
+    assert "cdn.EVIL.example." in domains
+    assert domains.match("a.b.evil.example") == "evil.example"
+    assert "notevil.example" not in domains
+    assert "co.uk" not in domains
+    assert "example" not in domains
+    assert "" not in domains
+    assert len(domains) == 2
+
+def test_load_domain_file(tmp_path):
+    path = tmp_path / "blocklist.txt"
+    path.write_text("# a blocklist\nevil.example\n0.0.0.0 spam.example\n")
+    domains = load_domain_file(str(path))
+    assert len(domains) == 2
+    assert "www.spam.example" in domains
+    # every user of a file shares one copy of it...
+    assert load_domain_file(str(path)) is domains
+    # ...until it changes
+    path.write_text("other.example\n")
+    os.utime(str(path), (0, 0))
+    reloaded = load_domain_file(str(path))
+    assert "other.example" in reloaded
+    assert "evil.example" not in reloaded
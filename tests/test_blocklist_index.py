@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+import blocklist_index
+from blocklist_index import BlocklistIndex, build_index, open_index
+
+@pytest.fixture
+def index_path(tmp_path):
+    path = str(tmp_path / "blocklist.idx")
+    build_index(path, {
+        "domains": ["evil.example", "bücher.example"],
+        "emails": ["spammer@mail.example"],
+        "ips": ["192.0.2.1", "2001:db8::1"],
+    })
+    return path
+
+def test_lookups(index_path):
+    index = BlocklistIndex(index_path)
+    assert len(index) == 5
+    assert index.count("domains") == 2
+    assert "cdn.Evil.Example" in index
+    assert index.match_domain("xn--bcher-kva.example") == "bücher.example"
+    assert "notevil.example" not in index
+    assert index.has_email("Spammer@Mail.Example")
+    assert not index.has_email("someone@mail.example")
+    assert index.has_ip("192.0.2.1")
+    assert index.has_ip("2001:0db8:0000::1")
+    assert not index.has_ip("192.0.2.2")
+    assert not index.has_ip("not an ip")
+
+def test_bloom_filter(index_path, monkeypatch):
+    index = BlocklistIndex(index_path)
+    searched = []
+    unpack_from = blocklist_index.KEY.unpack_from
+    class Key:
+        size = blocklist_index.KEY.size
+        @staticmethod
+        def unpack_from(*args):
+            searched.append(args)
+            return unpack_from(*args)
+    monkeypatch.setattr(blocklist_index, "KEY", Key)
+    # most misses never get as far as the key array
+    misses = ["host{}.example".format(n) for n in range(200)]
+    assert not any(index.contains("domains", miss) for miss in misses)
+    assert len(searched) < 40
+
+def test_empty_sections(tmp_path):
+    path = str(tmp_path / "empty.idx")
+    build_index(path, {"domains": ["evil.example"]})
+    index = BlocklistIndex(path)
+    assert not index.has_email("a@evil.example")
+    assert not index.has_ip("192.0.2.1")
+
+def test_not_an_index(tmp_path):
+    path = tmp_path / "blocklist.txt"
+    path.write_text("evil.example\n")
+    with pytest.raises(ValueError):
+        BlocklistIndex(str(path))
+
+def test_hot_swap(index_path):
+    index = open_index(index_path)
+    assert open_index(index_path) is index
+    build_index(index_path, {"domains": ["other.example"]})
+    swapped = open_index(index_path)
+    assert swapped is not index
+    assert "other.example" in swapped
+    assert "evil.example" not in swapped
+    # the old index still works for whoever was using it
+    assert "evil.example" in index
+    assert [name for name in os.listdir(os.path.dirname(index_path))] == ["blocklist.idx"]
+
+def test_build_command(tmp_path, capsys):
+    domains = tmp_path / "domains.txt"
+    domains.write_text("# list\n0.0.0.0 evil.example\n||spam.example^\n")
+    emails = tmp_path / "emails.txt"
+    emails.write_text("Spammer@Mail.Example\nnot an email\n")
+    ips = tmp_path / "ips.txt"
+    ips.write_text("192.0.2.1 # known bad\n")
+    output = str(tmp_path / "out.idx")
+    blocklist_index.main(["build", output, "--domains", str(domains), "--emails", str(emails),
+                          "--ips", str(ips)])
+    assert "2 domains, 1 emails, 1 ips" in capsys.readouterr().out
+    index = BlocklistIndex(output)
+    assert "www.spam.example" in index
+    assert index.has_email("spammer@mail.example")
+    assert index.has_ip("192.0.2.1")
@@ -0,0 +1,74 @@
+import pytest
+import util
+from context import ReportContext, PendingAccountContext, normalize_username
+from judge import ReportJudge
+
+@pytest.fixture
+def count_parses(monkeypatch):
+    """
+    Count how many times statuses get parsed for links.
+    """
+    calls = []
+    parse = util.parse_links_from_statuses
+    def _parse(statuses):
+        calls.append(statuses)
+        return parse(statuses)
+    monkeypatch.setattr(util, "parse_links_from_statuses", _parse)
+    return calls
+
+def test_report_features(report, count_parses):
+    ctx = ReportContext(report(
+        reported={
+            "username": "Ｅvil",
+            "account": {
+                "username": "Ｅvil",
+                "note": "my bio",
+                "fields": [{"name": "site", "value": "example.com"}]
+            }
+        },
+        statuses=[
+            {"content": '<p>see <a href="https://Evil.example/a">here</a></p>'},
+            {"content": '<p>and <a href="https://evil.example/b">here</a></p>'}
+        ]
+    ))
+    assert count_parses == []
+    assert ctx.links == ["https://Evil.example/a", "https://evil.example/b"]
+    assert ctx.hostnames == ["evil.example"]
+    assert len(count_parses) == 1
+    assert ctx.status_texts == ["see here", "and here"]
+    assert ctx.bio_texts == ["my bio", "example.com"]
+    assert ctx.normalized_username == "evil"
+    assert ctx.texts("username") == ["Ｅvil"]
+
+def test_pending_account_features(pending_account, pending_account_no_invite):
+    ctx = PendingAccountContext(pending_account(email="Someone@Example.COM", message="hi"))
+    assert ctx.email_domain == "example.com"
+    assert ctx.texts("invite_request") == ["hi"]
+    ctx = PendingAccountContext(pending_account_no_invite())
+    assert ctx.texts("invite_request") == ["None"]
+
+def test_normalize_username():
+    assert normalize_username("ＢａｄＵｓｅｒ") == "baduser"
+
+def test_links_parsed_once_per_report(report, count_parses, monkeypatch, MockResponse):
+    import requests
+    monkeypatch.setattr(requests.Session, "head", staticmethod(lambda url, **kwargs: MockResponse(url=url)))
+    judge = ReportJudge([
+        {
+            "name": "Link content",
+            "type": "link_content",
+            "blocked": ["nothing"],
+            "severity": 1,
+            "punishment": {"type": "suspend"}
+        },
+        {
+            "name": "Link resolver",
+            "type": "link_resolver",
+            "blocked": ["nothing"],
+            "severity": 1,
+            "punishment": {"type": "suspend"}
+        }
+    ])
+    rpt = report(statuses=[{"content": '<a href="https://example.com">link</a>'}])
+    judge.make_judgement(rpt)
+    assert len(count_parses) == 1
@@ -0,0 +1,85 @@
+import time
+
+from mastodon import MastodonAPIError, MastodonGatewayTimeoutError, MastodonNetworkError
+
+from dispatcher import Dispatcher
+
+
+class FlakyCall:
+    """
+    An API call that fails with the given errors before succeeding.
+    """
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    def __call__(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+class API:
+    ratelimit_remaining = None
+    ratelimit_reset = None
+
+
+def test_dispatch():
+    dispatcher = Dispatcher(API())
+    call = FlakyCall()
+    outcomes = [dispatcher.submit("test call", call, number, text="hi") for number in range(5)]
+    dispatcher.join()
+    assert [outcome.result() for outcome in outcomes] == [True] * 5
+    # a single worker keeps calls in order
+    assert call.calls == [((number,), {"text": "hi"}) for number in range(5)]
+    dispatcher.close()
+
+
+def test_retry_transient_errors():
+    dispatcher = Dispatcher(API(), max_tries=3, backoff=0)
+    call = FlakyCall(MastodonGatewayTimeoutError(), MastodonNetworkError())
+    assert dispatcher.submit("test call", call).result()
+    assert len(call.calls) == 3
+    # give up after max_tries
+    call = FlakyCall(*[MastodonNetworkError()] * 3)
+    assert not dispatcher.submit("test call", call).result()
+    assert len(call.calls) == 3
+    # other errors aren't retried
+    call = FlakyCall(MastodonAPIError())
+    assert not dispatcher.submit("test call", call).result()
+    assert len(call.calls) == 1
+    dispatcher.close()
+
+
+def test_dispatch_steps():
+    dispatcher = Dispatcher(API(), max_tries=3, backoff=0)
+    first = FlakyCall()
+    second = FlakyCall(MastodonGatewayTimeoutError())
+    assert dispatcher.submit_steps("test steps", [(first, (1,), {}), (second, (2,), {"text": "hi"})]).result()
+    # retries don't repeat the steps that already worked
+    assert first.calls == [((1,), {})]
+    assert second.calls == [((2,), {"text": "hi"})] * 2
+    dispatcher.close()
+
+
+def test_retry_delay():
+    dispatcher = Dispatcher(API(), workers=0, backoff=1.0)
+    for tries in range(1, 5):
+        assert 0 <= dispatcher.retry_delay(tries) <= 2 ** (tries - 1)
+
+
+def test_pace():
+    api = API()
+    dispatcher = Dispatcher(api, workers=0)
+    # no rate limit info yet
+    assert dispatcher.pace() == 0
+    # plenty of calls left
+    api.ratelimit_remaining = 200
+    api.ratelimit_reset = time.time() + 100
+    assert dispatcher.pace() == 0
+    # running low: spread the rest over the window
+    api.ratelimit_remaining = 10
+    assert 9 < dispatcher.pace() <= 10
+    # window's over
+    api.ratelimit_reset = time.time() - 1
+    assert dispatcher.pace() == 0
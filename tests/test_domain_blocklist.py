@@ -0,0 +1,94 @@
+import pytest
+import voluptuous
+from copy import deepcopy
+
+from judge import ReportJudge, PendingAccountJudge
+from rules.domain_blocklist import rule as Rule
+
+ruleconfig = {
+    "name": "Test rule",
+    "type": "domain_blocklist",
+    "domains": ["evilsi.te"],
+    "severity": 1,
+    "punishment": {
+        "type": "reject"
+    }
+}
+
+
+@pytest.fixture
+def blocklist_file(tmp_path):
+    path = tmp_path / "blocklist.txt"
+    path.write_text("# community list\nheresa.porn.domain\n0.0.0.0 spam.example\n")
+    return str(path)
+
+
+@pytest.fixture
+def rule(blocklist_file):
+    return Rule(dict(ruleconfig, files=[blocklist_file]))
+
+
+def test_requires_blocklist():
+    bad_config = deepcopy(ruleconfig)
+    bad_config.pop("domains")
+    with pytest.raises(voluptuous.error.MultipleInvalid):
+        Rule(bad_config)
+
+
+def test_missing_file():
+    with pytest.raises(OSError):
+        Rule(dict(ruleconfig, files=["/nonexistent/blocklist.txt"]))
+
+
+def test_report(rule, report):
+    evil = report(statuses=[
+        {"content": "<p>nothing to see here</p>"},
+        {"content": '<p>click <a href="https://WWW.Spam.Example/deal">here</a></p>'},
+    ])
+    bare = report(statuses=[{"content": "<p>https://cdn.evilsi.te/x</p>"}])
+    good = report(statuses=[{"content": '<p><a href="https://notspam.example/">fine</a></p>'}])
+    assert rule.test_report(evil)
+    assert rule.test_report(bare)
+    assert not rule.test_report(good)
+    assert rule.test_reports([evil, good, bare]) == [True, False, True]
+
+
+def test_pending_account(rule, pending_account):
+    assert rule.test_pending_account(pending_account(email="someone@mail.heresa.porn.domain"))
+    assert rule.test_pending_account(pending_account(email="someone@EVILSI.TE"))
+    assert not rule.test_pending_account(pending_account(email="someone@example.com"))
+    assert not rule.test_pending_account(pending_account(email=""))
+
+
+def test_judges(blocklist_file, report, pending_account):
+    config = dict(ruleconfig, files=[blocklist_file])
+    report_judge = ReportJudge([dict(config, punishment={"type": "suspend"})])
+    account_judge = PendingAccountJudge([config])
+    # both judges' rules share one copy of the file
+    assert report_judge.rules[0].blocklists()[1] is account_judge.rules[0].blocklists()[1]
+    (punishment, _) = report_judge.make_judgement(
+        report(statuses=[{"content": '<a href="https://heresa.porn.domain/">x</a>'}]))
+    assert punishment.type == "suspend"
+    (punishment, _) = account_judge.make_judgement(pending_account(email="a@spam.example"))
+    assert punishment.type == "reject"
+
+
+def test_index(tmp_path, report, pending_account):
+    from blocklist_index import build_index
+    path = str(tmp_path / "blocklist.idx")
+    build_index(path, {
+        "domains": ["indexed.example"],
+        "emails": ["spammer@example.com"],
+        "ips": ["192.0.2.1"],
+    })
+    rule = Rule(dict(ruleconfig, index=path))
+    assert rule.test_report(report(statuses=[{"content": '<a href="https://www.indexed.example/">x</a>'}]))
+    assert rule.test_report(report(statuses=[{"content": '<a href="https://evilsi.te/">x</a>'}]))
+    assert not rule.test_report(report(statuses=[{"content": '<a href="https://fine.example/">x</a>'}]))
+    assert rule.test_pending_account(pending_account(email="someone@indexed.example"))
+    assert rule.test_pending_account(pending_account(email="Spammer@example.com"))
+    assert rule.test_pending_account(pending_account(email="someone@example.com", ip="192.0.2.1"))
+    assert not rule.test_pending_account(pending_account(email="someone@example.com"))
+    # rebuilding the index swaps it in
+    build_index(path, {"domains": ["fine.example"]})
+    assert rule.test_report(report(statuses=[{"content": '<a href="https://fine.example/">x</a>'}]))
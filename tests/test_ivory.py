@@ -1,110 +1,7 @@
-import pytest
 import ivory
 import time
 
-ivoryconfig = {
-  "token": "testtoken",
-  "instanceURL": "https://testinstance.local",
-  "waitTime": 300,
-  "logLevel": "DEBUG",
-  "reports": {
-    "rules": [
-      {
-        "name": "No bad usernames",
-        "type": "username_content",
-        "blocked": ["badword"],
-        "severity": 1,
-        "punishment": {
-          "type": "suspend",
-          "message": "Your account has been suspended for spamming."
-        }
-      },
-      {
-        "name": "No badwords",
-        "type": "message_content",
-        "blocked": ["badword"],
-        "severity": 1,
-        "punishment": {
-          "type": "disable",
-          "message": "Your account has been disabled for having a badword in a message."
-        }
-      }
-    ]
-  },
-  "pendingAccounts": {
-    "rules": [
-      {
-        "name": "No probbox spammers",
-        "type": "message_content",
-        "blocked": ["badword", "slur[^p]"],
-        "severity": 1,
-        "punishment": {
-          "type": "reject"
-        }
-      },
-      {
-        "name": "No mewkid spammers",
-        "type": "username_content",
-        "blocked": ["badword", "slur[^p]"],
-        "severity": 1,
-        "punishment": {
-          "type": "reject"
-        }
-      }
-    ]
-  }
-}
-
-@pytest.fixture
-def generate_mockstodon(monkeypatch):
-    """
-    Replace Mastodon.py completely with a custom copy that replicates the functions Ivory uses.
-
-    I hate having to do this but I don't know if there's really a better way to
-    test without doing this...
-    """
-    def _generate_mockstodon(**kwargs):
-        class Mockstodon():
-            # Static values we check in the tests
-            # these are 4-tuples in the form of:
-            # (account id, action, report id, message)
-            moderation_actions = []
-            accounts = []
-            reports = []
-            def __init__(self, **kwargs):
-                # We don't actually use these values internally, we just want to make sure Mastodon.py is getting passed the right stuff
-                assert kwargs.get("access_token") == ivoryconfig['token']
-                assert kwargs.get("api_base_url") == ivoryconfig['instanceURL']
-            def verify_minimum_version(self, version):
-                return True
-            def instance(self):
-                return {
-                    "uri": ivoryconfig['instanceURL'],
-                }
-            def account_verify_credentials(self):
-                return {
-                    "username": "testuser"
-                }
-            def admin_reports(self):
-                return self.reports
-            def admin_accounts(self, **kwargs):
-                if kwargs.get("status") == "pending":
-                    return self.accounts
-                else:
-                    assert kwargs.get("status") == "pending"
-            def admin_account_reject(self, acct_id):
-                self.moderation_actions.append((acct_id, "reject", None, None))
-                return
-            def admin_account_moderate(self, acct_id, action, report_id, **kwargs):
-                self.moderation_actions.append((acct_id,action,report_id, kwargs.get("message")))
-                return
-        Mockstodon.accounts = kwargs.get("accounts")
-        Mockstodon.reports = kwargs.get("reports")
-        monkeypatch.setattr(ivory, "Mastodon", Mockstodon)
-        return Mockstodon
-    return _generate_mockstodon
-
-def test_oneshot(generate_mockstodon, report, pending_account):
+def test_oneshot(generate_mockstodon, report, pending_account, ivoryconfig):
     """
     Verify that Ivory runs.
     """
@@ -117,13 +14,13 @@ def test_oneshot(generate_mockstodon, report, pending_account):
             }
         }),
         # disable
-        report(statuses=[
+        report(report_id="2", reported={"account_id": "2"}, statuses=[
             {
                 "content": "badword"
             }
         ]),
         # clean
-        report()
+        report(report_id="3", reported={"account_id": "3"})
     ], accounts=[
         # clean
         pending_account(),
@@ -136,7 +33,321 @@ def test_oneshot(generate_mockstodon, report, pending_account):
     i.run()
     assert Mockstodon.moderation_actions == [
         ('1', 'suspend', '1', None),
-        ('1', 'disable', '1', None),
+        ('2', 'disable', '2', None),
         ('1', 'reject', None, None),
         ('1', 'reject', None, None)
     ]
+
+def test_reload_config(generate_mockstodon, tmp_path, report, ivoryconfig):
+    import json
+    from copy import deepcopy
+    Mockstodon = generate_mockstodon(reports=[
+        report(statuses=[{"content": "newword"}])
+    ], accounts=[])
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(ivoryconfig))
+    i = ivory.Ivory(ivoryconfig, str(config_path))
+    (username_rule, message_rule) = i.report_judge.rules
+    # nothing changed yet
+    assert not i.reload_config()
+    # change a rule and turn on dry mode
+    new_config = deepcopy(ivoryconfig)
+    new_config['reports']['rules'][1]['blocked'] = ["newword"]
+    new_config['dryRun'] = True
+    config_path.write_text(json.dumps(new_config))
+    i.request_reload()
+    assert i.reload_config()
+    assert i.dry_run
+    assert i.report_judge.exhaustive
+    assert i.report_judge.rules[0] is username_rule
+    assert i.report_judge.rules[1] is not message_rule
+    assert i.report_judge.make_judgement(report(statuses=[{"content": "newword"}]))[0].type == "disable"
+    # broken configs are ignored
+    config_path.write_text("{")
+    i.request_reload()
+    assert not i.reload_config()
+    assert i.report_judge.rules[0] is username_rule
+
+def test_ledger_skips_judged_items(generate_mockstodon, tmp_path, report, pending_account, ivoryconfig):
+    from copy import deepcopy
+    Mockstodon = generate_mockstodon(reports=[
+        report(report_id="1", statuses=[{"content": "badword"}]),
+        report(report_id="2", reported={"account_id": "2"})
+    ], accounts=[
+        pending_account(account_id="3", message="badword")
+    ])
+    config = deepcopy(ivoryconfig)
+    config['ledgerPath'] = str(tmp_path / "ledger.db")
+    i = ivory.Ivory(config)
+    judged = []
+    make_judgements = i.report_judge.make_judgements
+    def _make_judgements(items, *args, **kwargs):
+        judged.extend(item['id'] for item in items)
+        return make_judgements(items, *args, **kwargs)
+    i.report_judge.make_judgements = _make_judgements
+    i.run()
+    i.run()
+    assert judged == ["1", "2"]
+    assert Mockstodon.moderation_actions == [
+        ('1', 'disable', '1', None),
+        ('3', 'reject', None, None)
+    ]
+    # changed reports get judged again
+    Mockstodon.reports[1]['comment'] = "new info"
+    i.run()
+    assert judged == ["1", "2", "2"]
+
+def test_pagination(generate_mockstodon, report, pending_account, ivoryconfig):
+    Mockstodon = generate_mockstodon(report_pages=[
+        [report(report_id="1", statuses=[{"content": "badword"}]), report(report_id="2")],
+        [report(report_id="3")],
+        [report(report_id="4", reported={"account_id": "4", "account": {"username": "badword"}})]
+    ], account_pages=[
+        [pending_account(account_id="5")],
+        [pending_account(account_id="6", message="badword")]
+    ])
+    i = ivory.Ivory(ivoryconfig)
+    i.run()
+    assert Mockstodon.moderation_actions == [
+        ('1', 'disable', '1', None),
+        ('4', 'suspend', '4', None),
+        ('6', 'reject', None, None)
+    ]
+
+def test_incremental_polling(generate_mockstodon, tmp_path, report, ivoryconfig):
+    from copy import deepcopy
+    Mockstodon = generate_mockstodon(reports=[
+        report(report_id="3", statuses=[{"content": "badword"}]),
+        report(report_id="2", reported={"account_id": "2"}),
+    ], accounts=[])
+    config = deepcopy(ivoryconfig)
+    config['incremental'] = True
+    config['ledgerPath'] = str(tmp_path / "ledger.db")
+    i = ivory.Ivory(config)
+    judged = []
+    make_judgements = i.report_judge.make_judgements
+    def _make_judgements(items, *args, **kwargs):
+        judged.extend(item['id'] for item in items)
+        return make_judgements(items, *args, **kwargs)
+    i.report_judge.make_judgements = _make_judgements
+    # the first pass is a full sweep
+    i.run()
+    assert judged == ["3", "2"]
+    assert "since_id" not in Mockstodon.fetches[0]
+    assert i.get_cursor("reports")[0] == 3
+    # later passes only fetch and judge new reports
+    Mockstodon.reports.insert(0, report(report_id="4", reported={"account_id": "4"}))
+    i.run()
+    assert judged == ["3", "2", "4"]
+    assert Mockstodon.fetches[-2] == {"since_id": 3}
+    # cursors survive restarts
+    assert ivory.Ivory(config).get_cursor("reports")[0] == 4
+    # and full sweeps still happen every fullSweepInterval
+    i.full_sweep_interval = 0
+    Mockstodon.reports[2]['comment'] = "new info"
+    i.run()
+    assert "since_id" not in Mockstodon.fetches[-2]
+    assert judged == ["3", "2", "4", "2"]
+    assert Mockstodon.moderation_actions == [('1', 'disable', '3', None)]
+
+def test_incremental_polling_retries_failures(generate_mockstodon, report, ivoryconfig):
+    from copy import deepcopy
+    Mockstodon = generate_mockstodon(reports=[
+        report(report_id="3", statuses=[{"content": "badword"}]),
+        report(report_id="2", reported={"account_id": "2"}),
+    ], accounts=[])
+    config = deepcopy(ivoryconfig)
+    config['incremental'] = True
+    i = ivory.Ivory(config)
+    admin_account_moderate = Mockstodon.admin_account_moderate
+    def failing_admin_account_moderate(self, *args, **kwargs):
+        raise ValueError("the instance is down")
+    Mockstodon.admin_account_moderate = failing_admin_account_moderate
+    i.run()
+    assert Mockstodon.moderation_actions == []
+    # the cursor stops short of the report that wasn't handled
+    assert i.get_cursor("reports")[0] == 2
+    Mockstodon.admin_account_moderate = admin_account_moderate
+    i.run()
+    assert Mockstodon.fetches[-2] == {"since_id": 2}
+    assert Mockstodon.moderation_actions == [('1', 'disable', '3', None)]
+    assert i.get_cursor("reports")[0] == 3
+
+def test_queue_schedules(generate_mockstodon, report, ivoryconfig):
+    from copy import deepcopy
+    Mockstodon = generate_mockstodon(reports=[
+        report(statuses=[{"content": "badword"}])
+    ], accounts=[])
+    config = deepcopy(ivoryconfig)
+    config['pendingAccounts']['waitTime'] = 30
+    config['reports'].update({"minWaitTime": 60, "maxWaitTime": 900})
+    i = ivory.Ivory(config)
+    assert i.schedules["pendingAccounts"].interval == 30
+    assert i.schedules["reports"].interval == 300
+    # each queue runs on its own, and busy queues get checked sooner
+    assert i.run_queue("reports") <= 150
+    assert Mockstodon.moderation_actions == [('1', 'disable', '1', None)]
+    assert i.run_queue("pendingAccounts") > 29
+    assert i.schedules["pendingAccounts"].interval == 30
+
+def test_pass_budget(generate_mockstodon, tmp_path, report, pending_account, ivoryconfig):
+    from copy import deepcopy
+    Mockstodon = generate_mockstodon(report_pages=[
+        [report(report_id="5", reported={"account_id": "5"}), report(report_id="4", statuses=[{"content": "badword"}])],
+        [report(report_id="3", reported={"account_id": "3"})],
+        [report(report_id="2", reported={"account_id": "2", "account": {"username": "badword"}})]
+    ], accounts=[
+        pending_account(account_id="6", message="badword")
+    ])
+    config = deepcopy(ivoryconfig)
+    config['ledgerPath'] = str(tmp_path / "ledger.db")
+    config['passCallBudget'] = 3
+    i = ivory.Ivory(config)
+    # pending accounts go first, then the budget runs out after the first page
+    # of reports, whose reports with the most statuses are handled first
+    i.run()
+    assert Mockstodon.moderation_actions == [
+        ('6', 'reject', None, None),
+        ('1', 'disable', '4', None),
+    ]
+    assert i.get_checkpoint("reports") == (4, 5, True)
+    # the next pass picks up where the last one left off, even after a restart
+    i = ivory.Ivory(config)
+    assert i.get_checkpoint("reports") == (4, 5, True)
+    i.run()
+    assert Mockstodon.fetches[-1] == {"max_id": 4}
+    assert Mockstodon.moderation_actions[-1] == ('2', 'suspend', '2', None)
+    # and once a pass reaches the end, the next one starts from the top again
+    i.run()
+    assert i.get_checkpoint("reports") is None
+    assert i.get_cursor("reports")[0] == 5
+    i.run()
+    assert "max_id" not in Mockstodon.fetches[-1]
+
+def test_report_aggregation(generate_mockstodon, tmp_path, report, ivoryconfig):
+    from copy import deepcopy
+    Mockstodon = generate_mockstodon(reports=[
+        report(report_id="3", reported={"account_id": "7"}, statuses=[{"status_id": "10"}]),
+        report(report_id="2", reported={"account_id": "8"}),
+        report(report_id="1", reported={"account_id": "7"},
+               statuses=[{"status_id": "10"}, {"status_id": "11", "content": "badword"}]),
+    ], accounts=[])
+    config = deepcopy(ivoryconfig)
+    config['ledgerPath'] = str(tmp_path / "ledger.db")
+    i = ivory.Ivory(config)
+    judged = []
+    make_judgements = i.report_judge.make_judgements
+    def _make_judgements(items, *args, **kwargs):
+        judged.extend((item['id'], [status['id'] for status in item['statuses']]) for item in items)
+        return make_judgements(items, *args, **kwargs)
+    i.report_judge.make_judgements = _make_judgements
+    i.run()
+    # each account is judged once, over all its reported statuses...
+    assert judged == [("3", ["10", "11"]), ("2", [])]
+    # ...and punished once, with the rest of its reports resolved
+    assert Mockstodon.moderation_actions == [('7', 'disable', '3', None)]
+    assert Mockstodon.resolved_reports == ["1"]
+    # every report in the group is in the ledger
+    i.run()
+    assert len(judged) == 2
+
+def test_fetch_and_work(generate_mockstodon, tmp_path, report, pending_account, ivoryconfig):
+    from copy import deepcopy
+    Mockstodon = generate_mockstodon(reports=[
+        report(report_id="2", reported={"account_id": "7"}, statuses=[{"content": "badword"}]),
+        report(report_id="1", reported={"account_id": "8"}),
+    ], accounts=[
+        pending_account(account_id="3", message="badword")
+    ])
+    config = deepcopy(ivoryconfig)
+    config['workQueue'] = {"path": str(tmp_path / "work.db")}
+    fetcher = ivory.Ivory(deepcopy(config))
+    assert fetcher.fetch_once() == 3
+    # nothing's judged until a worker gets to it
+    assert Mockstodon.moderation_actions == []
+    assert fetcher.fetch_once() == 0
+    workers = []
+    for name in ("first", "second"):
+        config['workQueue']['workerName'] = name
+        workers.append(ivory.Ivory(deepcopy(config)))
+    assert workers[0].work_once() == 3
+    assert workers[1].work_once() == 0
+    assert Mockstodon.moderation_actions == [
+        ('3', 'reject', None, None),
+        ('7', 'disable', '2', None)
+    ]
+    # a new report against an account that's already been punished doesn't
+    # get it punished again, even by the worker that punished it
+    Mockstodon.reports.insert(0, report(report_id="4", reported={"account_id": "7"},
+                                        statuses=[{"content": "badword"}]))
+    assert fetcher.fetch_once() == 1
+    assert workers[0].work_once() == 1
+    assert len(Mockstodon.moderation_actions) == 2
+    # but the report is still resolved, so it doesn't sit in the queue
+    assert Mockstodon.resolved_reports == ["4"]
+    assert fetcher.work_queue.counts("reports") == {"done": 3}
+
+def test_report_aggregation_integer_ids(generate_mockstodon, report, ivoryconfig):
+    # Mastodon.py hands out integer ids
+    Mockstodon = generate_mockstodon(reports=[
+        report(report_id=3, reported={"account_id": 7}, statuses=[{"status_id": 10}]),
+        report(report_id=1, reported={"account_id": 7},
+               statuses=[{"status_id": 10}, {"status_id": 11, "content": "badword"}]),
+    ], accounts=[])
+    i = ivory.Ivory(ivoryconfig)
+    i.run()
+    assert Mockstodon.moderation_actions == [(7, 'disable', 3, None)]
+    assert Mockstodon.resolved_reports == [1]
+
+def test_reload_waits_for_passes(generate_mockstodon, report, ivoryconfig):
+    import threading
+    from copy import deepcopy
+    from schemas import IvoryConfig
+    Mockstodon = generate_mockstodon(reports=[
+        report(statuses=[{"content": "badword"}])
+    ], accounts=[])
+    i = ivory.Ivory(ivoryconfig)
+    # hold the reports pass up until the reload has been started
+    fetching = threading.Event()
+    resume = threading.Event()
+    admin_reports = Mockstodon.admin_reports
+    def slow_admin_reports(self, **kwargs):
+        fetching.set()
+        resume.wait(5)
+        return admin_reports(self, **kwargs)
+    Mockstodon.admin_reports = slow_admin_reports
+    new_config = deepcopy(ivoryconfig)
+    del new_config['reports']['rules'][1]
+    new_config['dryRun'] = True
+    passing = threading.Thread(target=i.handle_queue, args=("reports",))
+    passing.start()
+    assert fetching.wait(5)
+    reloading = threading.Thread(target=i.apply_config, args=(IvoryConfig(new_config),))
+    reloading.start()
+    reloading.join(0.2)
+    # the reload waits for the pass, which keeps the old rules and settings
+    assert reloading.is_alive()
+    assert len(i.report_judge.rules) == 2 and not i.dry_run
+    resume.set()
+    passing.join(5)
+    reloading.join(5)
+    assert Mockstodon.moderation_actions == [('1', 'disable', '1', None)]
+    assert len(i.report_judge.rules) == 1 and i.dry_run
+
+def test_periodic_pruning(generate_mockstodon, tmp_path, report, ivoryconfig):
+    import constants
+    from copy import deepcopy
+    generate_mockstodon(reports=[report()], accounts=[])
+    config = deepcopy(ivoryconfig)
+    config['ledgerPath'] = str(tmp_path / "ledger.db")
+    i = ivory.Ivory(config)
+    pruned = []
+    i.ledger.prune = pruned.append
+    # the ledger was pruned on startup, so passes leave it alone for a while
+    i.run()
+    assert pruned == []
+    # but long-running processes keep pruning it
+    i._pruned_at -= constants.LEDGER_PRUNE_INTERVAL
+    i.run()
+    i.run()
+    assert pruned == [constants.LEDGER_MAX_AGE]
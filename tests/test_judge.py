@@ -1,7 +1,7 @@
 import pytest
-from judge import ReportJudge, PendingAccountJudge
-from rules.message_content import Rule as MessageContentRule
-from rules.username_content import Rule as UsernameContentRule
+from judge import ReportJudge, PendingAccountJudge, Rule as JudgeRule
+from rules.message_content import MessageContentRule
+from rules.username_content import UsernameContentRule
 
 @pytest.fixture
 def pendingjudge():
@@ -162,3 +162,221 @@ def test_pending_multirule(pendingjudge, pending_account):
         assert rule.name in ["Rule 1", "Rule 2"]
         assert isinstance(rule, (MessageContentRule, UsernameContentRule))
     assert punishment.type == "suspend"
+
+def test_report_shared_field(report):
+    # rules searching the same field share one matcher but are still reported
+    # separately
+    judge = ReportJudge([
+      {
+        "name": "Rule 1",
+        "type": "message_content",
+        "blocked": ["heck"],
+        "severity": 1,
+        "punishment": {
+          "type": "silence"
+        }
+      },
+      {
+        "name": "Rule 2",
+        "type": "message_content",
+        "blocked": ["check", "slur[^p]"],
+        "severity": 2,
+        "punishment": {
+          "type": "suspend"
+        }
+      },
+      {
+        "name": "Rule 3",
+        "type": "message_content",
+        "blocked": ["nothing"],
+        "severity": 3,
+        "punishment": {
+          "type": "suspend"
+        }
+      }
+    ])
+    rpt = report(statuses=[{"content": "<p>check it out</p>"}])
+    (punishment, rules_broken) = judge.make_judgement(rpt)
+    assert {rule.name for rule in rules_broken} == {"Rule 1", "Rule 2"}
+    assert punishment.type == "suspend"
+    assert list(judge._matchers) == ["statuses"]
+    assert len(judge._matchers["statuses"]) == 4
+    # the rules' own matchers are only built for testing them on their own
+    assert all(rule._matcher is None for rule in judge.rules)
+    assert judge.rules[0].test_report(rpt)
+    assert judge.rules[0]._matcher is not None
+
+
+class CountingRule(JudgeRule):
+    """
+    A rule that counts how many times it's run and returns a fixed result.
+    """
+    def __init__(self, name, severity, broken, cost=1):
+        JudgeRule.__init__(self, name=name, severity=severity, punishment={"type": name})
+        self.broken = broken
+        self.cost = cost
+        self.runs = 0
+    def test_report(self, report, context=None):
+        self.runs += 1
+        return self.broken
+
+def test_short_circuit_skips_less_severe(report):
+    judge = ReportJudge(exhaustive=False)
+    network = CountingRule("network", 5, True, cost=100)
+    low = CountingRule("low", 1, True)
+    high = CountingRule("high", 5, True)
+    for rule in (network, low, high):
+        judge.add_rule(rule)
+    (punishment, rules_broken) = judge.make_judgement(report())
+    # the cheap rule in the top severity decides it, but the network rule
+    # comes first in the config so it still gets a say on ties
+    assert punishment.type == "network"
+    assert rules_broken == {network, high}
+    assert low.runs == 0
+    # exhaustive judgements run everything
+    (punishment, rules_broken) = judge.make_judgement(report(), exhaustive=True)
+    assert punishment.type == "network"
+    assert rules_broken == {network, low, high}
+
+def test_short_circuit_skips_expensive_ties(report):
+    judge = ReportJudge(exhaustive=False)
+    high = CountingRule("high", 5, True)
+    network = CountingRule("network", 5, True, cost=100)
+    low = CountingRule("low", 1, True)
+    for rule in (high, network, low):
+        judge.add_rule(rule)
+    (punishment, rules_broken) = judge.make_judgement(report())
+    assert punishment.type == "high"
+    assert rules_broken == {high}
+    assert network.runs == 0
+    assert low.runs == 0
+
+def test_short_circuit_matches_exhaustive(report):
+    judge = ReportJudge(exhaustive=False)
+    rules = [
+        CountingRule("a", 1, True),
+        CountingRule("b", 3, False, cost=100),
+        CountingRule("c", 2, True),
+        CountingRule("d", 2, True, cost=100),
+    ]
+    for rule in rules:
+        judge.add_rule(rule)
+    assert judge.make_judgement(report())[0].type == "c"
+    assert judge.make_judgement(report(), exhaustive=True)[0].type == "c"
+    assert rules[0].runs == 1
+    assert rules[3].runs == 1
+
+def test_adaptive_order(report):
+    judge = ReportJudge(exhaustive=False)
+    never = CountingRule("never", 1, False, cost=0.001)
+    always = CountingRule("always", 1, True, cost=0.001)
+    judge.add_rule(never)
+    judge.add_rule(always)
+    for _ in range(10):
+        judge.make_judgement(report())
+    # never is first in the config so it always has to run
+    assert never.runs == 10
+    assert judge.stats[always].hits == 10
+    assert judge.stats[never].hits == 0
+    assert judge.evaluation_order() == [never, always]
+    judge.update_order()
+    assert judge.evaluation_order() == [always, never]
+    summary = judge.stats_summary()
+    assert [stats["name"] for stats in summary] == ["always", "never"]
+    assert summary[0]["runs"] == 10
+    assert summary[0]["hit_rate"] > summary[1]["hit_rate"]
+
+def test_rule_stats_prefer_cheap():
+    from judge import RuleStats
+    cheap = RuleStats(0.5)
+    slow = RuleStats(0.001)
+    for _ in range(20):
+        cheap.record(0.001, False)
+        slow.record(0.5, False)
+    assert cheap.score < slow.score
+
+class BatchRule(JudgeRule):
+    """
+    A rule that implements the batch test method, recording each batch.
+    """
+    def __init__(self, name, severity, bad_ids):
+        JudgeRule.__init__(self, name=name, severity=severity, punishment={"type": name})
+        self.bad_ids = bad_ids
+        self.batches = []
+    def test_reports(self, reports, contexts=None):
+        self.batches.append([report['id'] for report in reports])
+        return [report['id'] in self.bad_ids for report in reports]
+
+def test_make_judgements(report):
+    judge = ReportJudge(exhaustive=False)
+    high = BatchRule("high", 5, {"2"})
+    low = BatchRule("low", 1, {"2", "3"})
+    single = CountingRule("single", 1, False)
+    for rule in (high, low, single):
+        judge.add_rule(rule)
+    reports = [report(report_id=str(i)) for i in range(1, 5)]
+    judgements = judge.make_judgements(reports)
+    assert [punishment.type if punishment else None for (punishment, _) in judgements] == [None, "high", "low", None]
+    assert judgements[1][1] == {high}
+    # each rule sees the whole batch at once, minus already decided items
+    assert high.batches == [["1", "2", "3", "4"]]
+    assert low.batches == [["1", "3", "4"]]
+    # rules without a batch method fall back to testing one at a time
+    assert single.runs == 2
+    assert judge.stats[low].runs == 3
+    assert judge.stats[low].hits == 1
+
+def test_io_bound_rules_use_executor(report):
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    class WaitingRule(JudgeRule):
+        io_bound = True
+        barrier = threading.Barrier(3, timeout=5)
+        def test_report(self, report, context=None):
+            self.barrier.wait()
+            return report['id'] == "2"
+    executor = ThreadPoolExecutor(max_workers=3)
+    judge = ReportJudge(executor=executor)
+    judge.add_rule(WaitingRule(name="waiting", severity=1, punishment={"type": "suspend"}))
+    judgements = judge.make_judgements([report(report_id=str(i)) for i in range(1, 4)])
+    assert [punishment is not None for (punishment, _) in judgements] == [False, True, False]
+    executor.shutdown()
+
+def test_update_rules(report):
+    configs = [
+      {
+        "name": "Rule 1",
+        "type": "username_content",
+        "blocked": ["evilusername"],
+        "severity": 1,
+        "punishment": {
+          "type": "silence"
+        }
+      },
+      {
+        "name": "Rule 2",
+        "type": "message_content",
+        "blocked": ["badword"],
+        "severity": 5,
+        "punishment": {
+          "type": "suspend"
+        }
+      }
+    ]
+    judge = ReportJudge(configs)
+    (rule1, rule2) = judge.rules
+    judge.make_judgement(report())
+    new_configs = [dict(configs[0]), dict(configs[1], blocked=["heck"])]
+    assert judge.update_rules(new_configs) == 1
+    assert judge.rules[0] is rule1
+    assert judge.rules[1] is not rule2
+    assert judge.rules[1].blocked == ["heck"]
+    # unchanged rules keep their statistics
+    assert judge.stats[rule1].runs == 1
+    rpt = report(statuses=[{"content": "heck"}])
+    assert judge.make_judgement(rpt)[0].type == "suspend"
+    # rules that fail to load leave the judge alone
+    with pytest.raises(ModuleNotFoundError):
+        judge.update_rules([dict(configs[0], type="nonexistent")])
+    assert judge.rules[0] is rule1
+    assert len(judge.rules) == 2
@@ -0,0 +1,53 @@
+import pytest
+from ledger import Ledger, fingerprint
+from judge import Punishment
+
+@pytest.fixture
+def ledger(tmp_path):
+    ledger = Ledger(str(tmp_path / "ledger.db"))
+    yield ledger
+    ledger.close()
+
+def test_fingerprint_ignores_volatile_fields(report):
+    rpt = report()
+    fp = fingerprint(rpt)
+    rpt['target_account']['account']['followers_count'] += 1
+    assert fingerprint(rpt) == fp
+    rpt['comment'] = "new comment"
+    assert fingerprint(rpt) != fp
+
+def test_fingerprint_matches_across_sources(pending_account):
+    from datetime import datetime, timezone
+    # a webhook payload...
+    webhook = pending_account()
+    # ...and the same account from Mastodon.py
+    api = dict(pending_account(), id=1,
+               created_at=datetime(2019, 1, 1, tzinfo=timezone.utc))
+    assert fingerprint(webhook) == fingerprint(api)
+    api['created_at'] = datetime(2019, 1, 2, tzinfo=timezone.utc)
+    assert fingerprint(webhook) != fingerprint(api)
+
+def test_unjudged(ledger, report):
+    rpts = [report(report_id="1"), report(report_id="2")]
+    assert ledger.unjudged("reports", rpts, "v1") == rpts
+    ledger.record("reports", rpts[0], "v1", Punishment(1, type="suspend"))
+    assert ledger.unjudged("reports", rpts, "v1") == [rpts[1]]
+    # other queues are separate
+    assert ledger.unjudged("pendingAccounts", rpts, "v1") == rpts
+    # new rules mean everything gets judged again
+    assert ledger.unjudged("reports", rpts, "v2") == rpts
+    # as do changed items
+    rpts[0]['comment'] = "updated"
+    assert ledger.unjudged("reports", rpts, "v1") == rpts
+
+def test_persists(tmp_path, report):
+    path = str(tmp_path / "ledger.db")
+    rpt = report()
+    ledger = Ledger(path)
+    ledger.record("reports", rpt, "v1")
+    ledger.close()
+    ledger = Ledger(path)
+    assert ledger.unjudged("reports", [rpt], "v1") == []
+    ledger.prune(-1)
+    assert ledger.unjudged("reports", [rpt], "v1") == [rpt]
+    ledger.close()
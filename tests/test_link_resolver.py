@@ -29,7 +29,7 @@ def head_mock(MockResponse, monkeypatch):
             "https://example.com/archive/actuallynotmalicious/": "https://example.com" # non-malicious site
         }
         return MockResponse(url=respmap[url])
-    monkeypatch.setattr(requests, "head", handler)
+    monkeypatch.setattr(requests.Session, "head", staticmethod(handler))
 
 
 def test_requires_blocked():
@@ -79,3 +79,126 @@ def test_good_report(head_mock, rule, report):
         ]
     )
     assert not rule.test_report(rpt)
+
+def test_batch_dedupes_links(monkeypatch, MockResponse, rule, report):
+    resolved = []
+    def handler(url, *args, **kwargs):
+        resolved.append(url)
+        return MockResponse(url=url.replace("example.com/archive", "evilsi.te"))
+    monkeypatch.setattr(requests.Session, "head", staticmethod(handler))
+    rpts = [
+        report(statuses=[{"content": '<a href="https://example.com/archive/1">link</a>'}]),
+        report(statuses=[{"content": '<a href="https://example.com/archive/1">link</a> <a href="https://example.com/">link</a>'}]),
+        report(statuses=[{"content": '<a href="https://example.com/">link</a>'}])
+    ]
+    assert rule.test_reports(rpts) == [True, True, False]
+    assert resolved == ["https://example.com/archive/1", "https://example.com/"]
+
+def test_resolves_concurrently(monkeypatch, MockResponse, rule, report):
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    # both links have to be in flight at once for either to resolve
+    barrier = threading.Barrier(2, timeout=5)
+    def handler(url, *args, **kwargs):
+        barrier.wait()
+        return MockResponse(url=url)
+    monkeypatch.setattr(requests.Session, "head", staticmethod(handler))
+    rule.executor = ThreadPoolExecutor(max_workers=2)
+    rpt = report(statuses=[{"content": '<a href="https://evilsi.te/">a</a> <a href="https://example.com/">b</a>'}])
+    assert rule.test_report(rpt)
+    rule.executor.shutdown()
+
+def test_caches_resolved_links(monkeypatch, MockResponse, rule, report):
+    resolved = []
+    def handler(url, *args, **kwargs):
+        resolved.append(url)
+        return MockResponse(url="https://evilsi.te")
+    monkeypatch.setattr(requests.Session, "head", staticmethod(handler))
+    evil = report(statuses=[{"content": '<a href="https://example.com/evil/">link</a>'}])
+    assert rule.test_report(evil)
+    assert rule.test_report(evil)
+    assert resolved == ["https://example.com/evil/"]
+    # rules sharing caches share resolved links
+    other = Rule(dict(ruleconfig, name="Another rule"))
+    caches = {}
+    rule.share_caches(caches)
+    other.share_caches(caches)
+    assert other.test_report(evil)
+    assert resolved == ["https://example.com/evil/"]
+    # connections and limits are only shared between rules with the same settings
+    assert other.limiter is rule.limiter and other.breaker is rule.breaker
+    strict = Rule(dict(ruleconfig, name="A strict rule", perHostConcurrency=1, breakerThreshold=1))
+    strict.share_caches(caches)
+    assert strict.resolved is rule.resolved
+    assert strict.limiter is not rule.limiter and strict.breaker is not rule.breaker
+
+def test_resolves_canonical_links(monkeypatch, MockResponse, rule, report):
+    resolved = []
+    def handler(url, *args, **kwargs):
+        resolved.append(url)
+        return MockResponse(url="https://EVILSI.TE/landing?utm_source=short#top")
+    monkeypatch.setattr(requests.Session, "head", staticmethod(handler))
+    rpt = report(statuses=[
+        {"content": '<a href="https://Short.example/x?utm_source=masto">one</a>'},
+        {"content": '<a href="https://short.example:443/x#again">two</a> https://short.example/x'},
+    ])
+    assert rule.test_report(rpt)
+    # the variants are all the same link, so it's only followed once
+    assert resolved == ["https://short.example/x"]
+
+def test_session_timeouts(monkeypatch, MockResponse, report):
+    calls = []
+    def handler(url, *args, **kwargs):
+        calls.append(kwargs["timeout"])
+        return MockResponse(url=url)
+    monkeypatch.setattr(requests.Session, "head", staticmethod(handler))
+    rule = Rule(dict(ruleconfig, connectTimeout=2, readTimeout=3.5))
+    assert not rule.test_report(report(statuses=[{"content": '<a href="https://example.com/">a</a>'}]))
+    assert calls == [(2, 3.5)]
+
+def test_per_host_concurrency(monkeypatch, MockResponse, report):
+    import threading
+    import time
+    in_flight = {}
+    most = {}
+    lock = threading.Lock()
+    def handler(url, *args, **kwargs):
+        host = url.split("/")[2]
+        with lock:
+            in_flight[host] = in_flight.get(host, 0) + 1
+            most[host] = max(most.get(host, 0), in_flight[host])
+        time.sleep(0.02)
+        with lock:
+            in_flight[host] -= 1
+        return MockResponse(url=url)
+    monkeypatch.setattr(requests.Session, "head", staticmethod(handler))
+    from concurrent.futures import ThreadPoolExecutor
+    rule = Rule(dict(ruleconfig, maxConcurrency=6, perHostConcurrency=2))
+    links = ['<a href="https://{}.example/{}">x</a>'.format(host, n) for host in ("a", "b") for n in range(5)]
+    # links are followed on the rule's own pool...
+    assert not rule.test_report(report(statuses=[{"content": " ".join(links)}]))
+    assert most == {"a.example": 2, "b.example": 2}
+    # ...or the judge's, if it has one
+    most.clear()
+    rule.executor = ThreadPoolExecutor(max_workers=6)
+    links = ['<a href="https://{}.example/{}">x</a>'.format(host, n) for host in ("a", "b") for n in range(5, 10)]
+    assert not rule.test_report(report(statuses=[{"content": " ".join(links)}]))
+    assert most == {"a.example": 2, "b.example": 2}
+    rule.executor.shutdown()
+
+def test_circuit_breaker(monkeypatch, MockResponse, report):
+    calls = []
+    def handler(url, *args, **kwargs):
+        calls.append(url)
+        if "slow.example" in url:
+            raise requests.Timeout("timed out")
+        return MockResponse(url="https://evilsi.te/")
+    monkeypatch.setattr(requests.Session, "head", staticmethod(handler))
+    rule = Rule(dict(ruleconfig, breakerThreshold=2, breakerCooldown=60))
+    for n in range(4):
+        # links that can't be followed are checked as they are
+        assert not rule.test_report(report(statuses=[
+            {"content": '<a href="https://slow.example/{}">x</a>'.format(n)}]))
+    assert rule.test_report(report(statuses=[{"content": '<a href="https://slow.evilsi.te/">x</a>'}]))
+    # the slow host was given up on after two timeouts; others carry on
+    assert calls == ["https://slow.example/0", "https://slow.example/1", "https://slow.evilsi.te/"]
@@ -0,0 +1,38 @@
+import pytest
+import re
+
+from matcher import PatternMatcher, AhoCorasick, required_literal
+
+def test_required_literal():
+    assert required_literal("badword") == "badword"
+    assert required_literal("slur[^p]") == "slur"
+    assert required_literal("evilsi\\.te") == "evilsi.te"
+    assert required_literal("<a href=\".*\">.*</a>") == "<a href=\""
+    # nothing we can safely require
+    assert required_literal("(foo|bar)") is None
+    assert required_literal("(?i)badword") is None
+    assert required_literal("[") is None
+
+def test_aho_corasick_overlapping():
+    automaton = AhoCorasick(["heck", "check", "he", "k"])
+    found = {automaton.words[i] for i in automaton.search("a check")}
+    assert found == {"heck", "check", "he", "k"}
+    assert automaton.search("nothing here") == {automaton.words.index("he")}
+
+def test_match_reports_tags():
+    matcher = PatternMatcher()
+    matcher.add("rule1", "heck")
+    matcher.add("rule2", "check")
+    matcher.add("rule2", "slur[^p]")
+    matcher.add("rule3", "(?i)LOUD")
+    matcher.add("rule4", "(x|y)z")
+    assert matcher.match(["check this out"]) == {"rule1", "rule2"}
+    assert matcher.match(["slurp"]) == set()
+    assert matcher.match(["slur!", "so loud"]) == {"rule2", "rule3"}
+    assert matcher.match([None, "yz"]) == {"rule4"}
+    assert matcher.match([]) == set()
+
+def test_add_invalid_pattern():
+    matcher = PatternMatcher()
+    with pytest.raises(re.error):
+        matcher.add("rule", "[")
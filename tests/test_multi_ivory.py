@@ -0,0 +1,68 @@
+import pytest
+from copy import deepcopy
+
+import multi_ivory
+
+
+@pytest.fixture
+def multiconfig(ivoryconfig):
+    """
+    Build a MultiIvory config with an instance for each dict of settings given.
+    """
+    def _multiconfig(*instances):
+        config = deepcopy(ivoryconfig)
+        shared = {key: config.pop(key) for key in ("token", "instanceURL", "logLevel")}
+        return dict(shared, instances=[dict(deepcopy(config), **instance) for instance in instances])
+    return _multiconfig
+
+
+def test_shared_rules(generate_mockstodon, multiconfig):
+    generate_mockstodon(reports=[], accounts=[])
+    config = multiconfig({}, {"waitTime": 60})
+    config['instances'][1]['reports']['rules'][1]['blocked'] = ["otherword"]
+    multi = multi_ivory.MultiIvory(config)
+    (first, second) = multi.instances
+    assert second.wait_time == 60
+    # identical rules are built once...
+    assert first.report_judge.rules[0] is second.report_judge.rules[0]
+    assert first.pending_account_judge.rules[0] is second.pending_account_judge.rules[0]
+    # ...but different ones aren't
+    assert first.report_judge.rules[1] is not second.report_judge.rules[1]
+
+
+def test_ledger_paths(generate_mockstodon, tmp_path, multiconfig):
+    generate_mockstodon(reports=[], accounts=[])
+    path = str(tmp_path / "ledger.db")
+    with pytest.raises(ValueError):
+        multi_ivory.MultiIvory(multiconfig({"ledgerPath": path}, {"ledgerPath": path}))
+
+
+def test_run(generate_mockstodon, report, multiconfig):
+    Mockstodon = generate_mockstodon(reports=[
+        report(statuses=[{"content": "badword"}])
+    ], accounts=[])
+    multi_ivory.MultiIvory(multiconfig({}, {})).run()
+    assert Mockstodon.moderation_actions == [('1', 'disable', '1', None)] * 2
+
+
+def test_fair_scheduling(generate_mockstodon, multiconfig):
+    generate_mockstodon(reports=[], accounts=[])
+    multi = multi_ivory.MultiIvory(dict(multiconfig({}, {}, {}), passWorkers=1))
+    passes = []
+
+    class Done(Exception):
+        pass
+
+    for index, ivory in enumerate(multi.instances):
+        def run_queue(queue, index=index):
+            passes.append((index, queue))
+            if len(passes) == 12:
+                raise Done()
+            # every queue is always ready for another pass
+            return 0
+        ivory.run_queue = run_queue
+    with pytest.raises(Done):
+        multi.watch()
+    # every queue of every instance gets its turn before any goes again
+    assert passes[:6] == [(index, queue) for index in range(3) for queue in ("reports", "pendingAccounts")]
+    assert passes[6:] == passes[:6]
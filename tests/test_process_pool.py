@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from judge import ReportJudge, PendingAccountJudge, Rule
+from process_pool import ProcessJudgePool
+from registry import RuleRegistry
+from test_judge import CountingRule
+
+rules = [
+    {
+        "name": "No bad usernames",
+        "type": "username_content",
+        "blocked": ["badword"],
+        "severity": 2,
+        "punishment": {"type": "suspend"}
+    },
+    {
+        "name": "No bad messages",
+        "type": "message_content",
+        "blocked": ["badword"],
+        "severity": 1,
+        "punishment": {"type": "disable"}
+    }
+]
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = ProcessJudgePool(2, chunk_size=2)
+    yield pool
+    pool.shutdown()
+
+
+def test_process_judgements(pool, report):
+    judge = ReportJudge(rules)
+    reports = [
+        report(),
+        report(statuses=[{"content": "badword"}]),
+        report(reported={"account": {"username": "badword"}}, statuses=[{"content": "badword"}]),
+        report(),
+        report(reported={"account": {"username": "badword"}}),
+    ]
+    judgements = pool.make_judgements(judge, reports)
+    # judgements come back in order, with the parent's own rules
+    assert judgements == judge.make_judgements(reports)
+    (suspend, disable) = judge.rules
+    assert judgements[2] == (suspend.punishment, {suspend, disable})
+
+
+def test_process_reload(pool, pending_account):
+    judge = PendingAccountJudge([dict(rules[1], punishment={"type": "reject"})])
+    account = pending_account(message="otherword")
+    assert pool.make_judgements(judge, [account]) == [(None, set())]
+    # workers pick up changed rules
+    judge.update_rules([dict(rules[1], blocked=["otherword"], punishment={"type": "reject"})])
+    assert pool.make_judgements(judge, [account])[0][0] is judge.rules[0].punishment
+
+
+def test_rules_without_configs(pool, report):
+    judge = ReportJudge()
+    rule = CountingRule("suspend", 1, True)
+    judge.add_rule(rule)
+    # can't be rebuilt in a worker, so they're judged here
+    assert judge.rule_configs() is None
+    assert pool.make_judgements(judge, [report()]) == [(rule.punishment, {rule})]
+    assert rule.runs == 1
+
+
+class NetworkRule(Rule):
+    """
+    An io_bound rule that notes which process it ran in, and for which reports.
+    """
+    io_bound = True
+    runs = []
+    def __init__(self, config):
+        Rule.__init__(self, **config)
+    def test_report(self, report, context=None):
+        NetworkRule.runs.append((os.getpid(), report['id']))
+        return report['id'] == "2"
+
+
+def test_io_bound_rules_stay_in_parent(pool, report):
+    registry = RuleRegistry()
+    registry.register("network", NetworkRule)
+    judge = ReportJudge(rules + [{"name": "Network", "type": "network", "severity": 1,
+                                  "punishment": {"type": "warn"}}],
+                        exhaustive=False, registry=registry)
+    reports = [
+        report(report_id="1"),
+        report(report_id="2"),
+        report(report_id="3", reported={"account": {"username": "badword"}}),
+    ]
+    judgements = pool.make_judgements(judge, reports)
+    # the network rule only ran here, on the reports it could still change
+    assert NetworkRule.runs == [(os.getpid(), "1"), (os.getpid(), "2")]
+    network = judge.rules[2]
+    assert judgements[1] == (network.punishment, {network})
+    assert judgements == judge.make_judgements(reports)
@@ -0,0 +1,112 @@
+import pytest
+import registry
+from registry import RuleRegistry
+from judge import Rule, ReportJudge
+from rules.username_content import rule as UsernameContentRule
+
+class CustomRule(Rule):
+    def __init__(self, raw_config):
+        Rule.__init__(self, **raw_config)
+    def test_report(self, report, context=None):
+        return True
+
+class FakeEntryPoint:
+    def __init__(self, name, loaded):
+        self.name = name
+        self.loaded = loaded
+        self.loads = 0
+    def load(self):
+        self.loads += 1
+        return self.loaded
+
+ruleconfig = {
+    "name": "Test rule",
+    "type": "custom",
+    "severity": 1,
+    "punishment": {
+        "type": "suspend"
+    }
+}
+
+@pytest.fixture
+def entry_points(monkeypatch):
+    """
+    Replace installed entry points with fake ones.
+    """
+    def _entry_points(*eps):
+        monkeypatch.setattr(registry, "_entry_points", lambda group: eps)
+    return _entry_points
+
+def test_builtin_rules_resolved_once(monkeypatch):
+    reg = RuleRegistry()
+    imports = []
+    import_module = registry.import_module
+    def _import_module(name):
+        imports.append(name)
+        return import_module(name)
+    monkeypatch.setattr(registry, "import_module", _import_module)
+    assert reg.get("username_content") is UsernameContentRule
+    assert reg.get("username_content") is UsernameContentRule
+    assert imports == ["rules.username_content"]
+
+def test_registered_rules():
+    reg = RuleRegistry()
+    reg.register("custom", CustomRule)
+    assert isinstance(reg.build(ruleconfig), CustomRule)
+
+def test_entry_point_rules(entry_points):
+    ep = FakeEntryPoint("custom", CustomRule)
+    entry_points(ep)
+    reg = RuleRegistry()
+    assert reg.get("custom") is CustomRule
+    assert reg.get("custom") is CustomRule
+    assert ep.loads == 1
+
+def test_entry_point_modules(entry_points):
+    class module:
+        rule = CustomRule
+    entry_points(FakeEntryPoint("custom", module))
+    assert RuleRegistry().get("custom") is CustomRule
+
+def test_unknown_rule(entry_points):
+    entry_points()
+    with pytest.raises(ModuleNotFoundError):
+        RuleRegistry().get("nonexistent")
+
+def test_judge_uses_registry(report):
+    reg = RuleRegistry()
+    reg.register("custom", CustomRule)
+    judge = ReportJudge([ruleconfig], registry=reg)
+    (punishment, _) = judge.make_judgement(report())
+    assert punishment.type == "suspend"
+
+def test_shared_rules():
+    from copy import deepcopy
+    reg = RuleRegistry(share_rules=True)
+    reg.register("custom", CustomRule)
+    rule = reg.build(ruleconfig)
+    # identical configs share a rule, different ones don't
+    assert reg.build(deepcopy(ruleconfig)) is rule
+    assert reg.build(dict(ruleconfig, name="Another rule")) is not rule
+    assert reg.build(ruleconfig, share=False) is not rule
+    # judges given the same rule twice still get two rules
+    judge = ReportJudge([ruleconfig, ruleconfig], registry=reg)
+    assert judge.rules[0] is not judge.rules[1]
+    # rules aren't shared unless the registry's asked to
+    unshared = RuleRegistry()
+    unshared.register("custom", CustomRule)
+    assert unshared.build(ruleconfig) is not unshared.build(ruleconfig)
+
+def test_shared_caches():
+    class CachingRule(CustomRule):
+        def __init__(self, raw_config):
+            CustomRule.__init__(self, raw_config)
+            self.cache = {}
+        def share_caches(self, caches):
+            self.cache = caches.setdefault("caching", self.cache)
+    reg = RuleRegistry(share_rules=True)
+    reg.register("custom", CachingRule)
+    first = reg.build(ruleconfig)
+    second = reg.build(dict(ruleconfig, name="Another rule"))
+    assert first is not second
+    assert first.cache is second.cache
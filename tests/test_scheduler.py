@@ -0,0 +1,60 @@
+from scheduler import PassBudget, Schedule
+
+
+def test_fixed_schedule():
+    schedule = Schedule(300)
+    # without bounds, the interval never changes
+    assert schedule.update(10, 60) == 240
+    assert schedule.update(0, 60) == 240
+    assert schedule.interval == 300
+
+
+def test_adaptive_schedule():
+    schedule = Schedule(60, 10, 600)
+    # busy queues get checked more often...
+    assert schedule.update(5, 1) == 29
+    assert schedule.update(5, 1) == 14
+    assert schedule.update(5, 1) == 9
+    assert schedule.interval == 10
+    # ...and quiet ones less
+    schedule.update(0, 1)
+    assert schedule.interval == 15
+    for _ in range(20):
+        schedule.update(0, 1)
+    assert schedule.interval == 600
+
+
+def test_slow_passes():
+    schedule = Schedule(60, 10, 600)
+    # passes don't get scheduled faster than they take to run
+    assert schedule.update(5, 45) == 0
+    assert schedule.interval == 45
+    # or longer than the longest wait
+    assert schedule.update(5, 900) == 0
+    assert schedule.interval == 600
+
+
+def test_reconfigure():
+    schedule = Schedule(60, 10, 600)
+    schedule.update(0, 1)
+    assert schedule.interval == 90
+    # the interval is kept if it's still in bounds
+    schedule.configure(60, 10, 120)
+    assert schedule.interval == 90
+    schedule.configure(30)
+    assert schedule.interval == 30
+
+
+def test_pass_budget():
+    budget = PassBudget()
+    assert not budget.limited
+    budget.spend(1000)
+    assert not budget.exhausted()
+    budget = PassBudget(calls=2)
+    assert budget.limited
+    budget.spend()
+    assert not budget.exhausted()
+    budget.spend()
+    assert budget.exhausted()
+    assert PassBudget(seconds=0).exhausted()
+    assert not PassBudget(seconds=60).exhausted()
@@ -102,3 +102,66 @@ def testgood_pending_account_string_confidence(rule, pending_account, sfs_mock):
     acct = pending_account()
     sfs_mock(ip=80, email="1.00")
     assert not rule.test_pending_account(acct)
+
+def test_batch_pending_accounts(rule, pending_account, monkeypatch, MockResponse):
+    queries = []
+    def handler(url, params=None, **kwargs):
+        queries.append(params)
+        return MockResponse(json={
+            "success": 1,
+            "email": [
+                {"value": "spammer@example.com", "frequency": 10, "appears": 1, "confidence": 99},
+                {"value": "testuser@example.com", "frequency": 0, "appears": 0}
+            ],
+            "ip": [
+                {"value": "127.0.0.1", "frequency": 0, "appears": 0},
+                {"value": "127.0.0.2", "frequency": 10, "appears": 1, "confidence": "95.5"}
+            ]
+        })
+    monkeypatch.setattr(requests, "get", handler)
+    accts = [
+        pending_account(),
+        pending_account(email="spammer@example.com"),
+        pending_account(ip="127.0.0.2"),
+        pending_account(email="spammer@example.com", ip="127.0.0.2"),
+    ]
+    assert rule.test_pending_accounts(accts) == [False, True, True, True]
+    assert len(queries) == 1
+    assert queries[0]["email[]"] == ["spammer@example.com", "testuser@example.com"]
+    assert queries[0]["ip[]"] == ["127.0.0.1", "127.0.0.2"]
+    # everything's cached now
+    assert rule.test_pending_accounts(accts) == [False, True, True, True]
+    assert len(queries) == 1
+
+def test_concurrent_lookups(rule, pending_account, monkeypatch, MockResponse, sfs_response):
+    import threading
+    queries = []
+    asked = threading.Event()
+    slow = threading.Event()
+    def handler(url, params=None, timeout=None, **kwargs):
+        assert timeout is not None
+        queries.append(params)
+        asked.set()
+        if params["email"] == ["slow@example.com"]:
+            slow.wait(5)
+        return MockResponse(json=sfs_response(email_conf=99))
+    monkeypatch.setattr(requests, "get", handler)
+    results = {}
+    def screen(name, email, ip):
+        results[name] = rule.test_pending_accounts([pending_account(email=email, ip=ip)])
+    first = threading.Thread(target=screen, args=("first", "slow@example.com", "127.0.0.1"))
+    first.start()
+    assert asked.wait(5)
+    # a batch needing the same lookup waits for it instead of repeating it...
+    second = threading.Thread(target=screen, args=("second", "slow@example.com", "127.0.0.1"))
+    second.start()
+    second.join(0.05)
+    assert second.is_alive()
+    # ...while other lookups aren't held up by it
+    screen("other", "other@example.com", "127.0.0.2")
+    assert results["other"] == [True]
+    slow.set()
+    first.join(5)
+    second.join(5)
+    assert results["first"] == results["second"] == [True]
+    assert len(queries) == 2
@@ -0,0 +1,110 @@
+import pytest
+
+import constants
+import util
+
+corpus = [
+    '<p>no links here</p>',
+    '<p>this post contains an <a href="https://heresa.porn.domain">bad link</a> ban me pls</p>',
+    '<p><a href="http://example.com/?a=1&amp;b=2">escaped</a> <A HREF="HTTP://SHOUTING.example">caps</A></p>',
+    '<a>no href</a><a href>empty href</a><a href="x"><a href="y">nested</a></a><a href="z"/>',
+    '<p><span class="h-card"><a href="https://example.com/@alice" class="u-url mention">@<span>alice</span></a>'
+    '</span> <a href="https://example.com/tags/spam" class="mention hashtag" rel="tag">#<span>spam</span></a></p>',
+    '<!-- <a href="https://commented.out"> --><p>unclosed <a href="https://unclosed.example">',
+]
+
+
+@pytest.mark.parametrize("text", corpus)
+def test_parse_links_matches_beautifulsoup(text):
+    bs4 = pytest.importorskip("bs4")
+    expected = [a.get('href') for a in bs4.BeautifulSoup(text, "html.parser").find_all('a')]
+    assert util.parse_links(text) == expected
+
+
+def test_link_kinds():
+    assert util.extract_links(corpus[4]) == [
+        util.Link("https://example.com/@alice", constants.LINK_MENTION),
+        util.Link("https://example.com/tags/spam", constants.LINK_HASHTAG),
+    ]
+    assert util.parse_links(corpus[4], kinds=(constants.LINK_EXTERNAL,)) == []
+    assert util.parse_links(corpus[1], kinds=(constants.LINK_EXTERNAL,)) == ["https://heresa.porn.domain"]
+
+
+def test_bare_urls():
+    text = ('<p>go to https://evil.example/deal?id=1. or (http://other.example/)</p>'
+            '<p><a href="https://linked.example/"><span>https://</span>linked.example/</a></p>')
+    # link text isn't counted twice
+    assert util.parse_links(text) == [
+        "https://evil.example/deal?id=1",
+        "http://other.example/",
+        "https://linked.example/",
+    ]
+    assert util.parse_links("plain text with https://bare.example in it") == ["https://bare.example"]
+    assert util.parse_links("") == []
+
+
+@pytest.mark.parametrize("url,canonical", [
+    ("HTTPS://Evil.Example:443/Path?utm_source=spam&id=1#comments", "https://evil.example/Path?id=1"),
+    ("http://evil.example:80", "http://evil.example/"),
+    ("https://evil.example:8443/a/", "https://evil.example:8443/a/"),
+    ("https://xn--bcher-kva.example/", "https://bücher.example/"),
+    ("https://evil.example/?fbclid=abc&UTM_MEDIUM=x", "https://evil.example/"),
+    ("https://evil.example/?q=a%20b", "https://evil.example/?q=a%20b"),
+    ("evilsi.te", "evilsi.te"),
+    ("https://[::1", None),
+])
+def test_canonicalize_url(url, canonical):
+    assert util.canonicalize_url(url) == canonical
+
+
+def test_canonical_links():
+    assert util.canonical_links([
+        "https://Evil.example",
+        None,
+        "https://evil.example/#top",
+        "https://evil.example/?utm_campaign=1",
+        "https://other.example/",
+        "",
+    ]) == ["https://evil.example/", "https://other.example/"]
+
+
+def test_circuit_breaker(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(util.time, "monotonic", lambda: now[0])
+    breaker = util.CircuitBreaker(2, 60)
+    breaker.failed("slow.example")
+    assert breaker.allow("slow.example")
+    breaker.failed("slow.example")
+    assert not breaker.allow("slow.example")
+    assert breaker.allow("fast.example")
+    # after the cooldown, one more try is let through...
+    now[0] = 60
+    assert breaker.allow("slow.example")
+    # ...and a failure shuts it out again
+    breaker.failed("slow.example")
+    assert not breaker.allow("slow.example")
+    now[0] = 120
+    breaker.succeeded("slow.example")
+    breaker.failed("slow.example")
+    assert breaker.allow("slow.example")
+
+
+def test_concurrency_limiter():
+    import threading
+    limiter = util.ConcurrencyLimiter(total=2, per_key=1)
+    with limiter.limit("a"):
+        # a key's slot is taken...
+        taken = threading.Event()
+        def take():
+            with limiter.limit("a"):
+                taken.set()
+        thread = threading.Thread(target=take)
+        thread.start()
+        assert not taken.wait(0.05)
+        # ...but other keys can still go
+        with limiter.limit("b"):
+            pass
+    thread.join()
+    assert taken.is_set()
+    # idle keys are forgotten
+    assert not limiter._keys
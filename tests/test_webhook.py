@@ -0,0 +1,140 @@
+import http.client
+import json
+import threading
+import urllib.error
+import urllib.request
+from copy import deepcopy
+
+import pytest
+
+import constants
+import ivory
+from webhook import SIGNATURE_HEADER, WebhookServer, sign, verify_signature
+
+SECRET = "hunter2"
+
+
+@pytest.fixture
+def webhook_server():
+    """
+    Start a webhook server for an Ivory instance on a free local port.
+    """
+    servers = []
+
+    def _webhook_server(target):
+        server = WebhookServer(target, SECRET, ("127.0.0.1", 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield _webhook_server
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def deliver(server, event, obj, secret=SECRET, body=None):
+    """
+    Send a webhook to a server like Mastodon would, returning the status code.
+    """
+    if body is None:
+        body = json.dumps({"event": event, "created_at": "2019-01-01T00:00:00.000Z", "object": obj}).encode()
+    request = urllib.request.Request(
+        "http://127.0.0.1:{}/".format(server.server_address[1]),
+        data=body,
+        headers={"Content-Type": "application/json", SIGNATURE_HEADER: sign(secret, body)},
+        method="POST"
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as err:
+        return err.code
+
+
+def test_verify_signature():
+    body = b'{"event": "report.created"}'
+    assert verify_signature(SECRET, body, sign(SECRET, body))
+    assert not verify_signature(SECRET, body, sign("wrong", body))
+    assert not verify_signature(SECRET, body + b" ", sign(SECRET, body))
+    assert not verify_signature(SECRET, body, None)
+
+
+def test_webhook_server(webhook_server):
+    class Receiver:
+        def __init__(self):
+            self.events = []
+
+        def handle_event(self, event, obj):
+            self.events.append((event, obj))
+    receiver = Receiver()
+    server = webhook_server(receiver)
+    assert deliver(server, "report.created", {"id": "1"}) == 202
+    # bad signatures and malformed events are turned away
+    assert deliver(server, "report.created", {"id": "2"}, secret="wrong") == 401
+    assert deliver(server, None, None, body=b"{") == 400
+    server.join()
+    assert receiver.events == [("report.created", {"id": "1"})]
+
+
+def test_webhook_content_length(webhook_server):
+    class Receiver:
+        def handle_event(self, event, obj):
+            pass
+    server = webhook_server(Receiver())
+
+    def post(length):
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        try:
+            connection.putrequest("POST", "/")
+            connection.putheader("Content-Length", length)
+            connection.endheaders()
+            return connection.getresponse().status
+        finally:
+            connection.close()
+    assert post("lots") == 400
+    assert post("-1") == 400
+    # oversized deliveries are turned away before their bodies are read
+    assert post(str(constants.WEBHOOK_MAX_BODY + 1)) == 413
+
+
+def test_webhook_events(generate_mockstodon, webhook_server, report, pending_account, ivoryconfig):
+    Mockstodon = generate_mockstodon(reports=[], accounts=[])
+    i = ivory.Ivory(deepcopy(ivoryconfig))
+    server = webhook_server(i)
+    assert deliver(server, "report.created", report(statuses=[{"content": "badword"}])) == 202
+    # approved accounts don't need screening
+    approved = dict(pending_account(account_id="2", username="badword"), approved=True)
+    assert deliver(server, "account.created", approved) == 202
+    assert deliver(server, "account.created", pending_account(account_id="3", username="badword")) == 202
+    assert deliver(server, "status.created", {"id": "4"}) == 202
+    server.join()
+    i.dispatcher.join()
+    assert Mockstodon.moderation_actions == [
+        ('1', 'disable', '1', None),
+        ('3', 'reject', None, None)
+    ]
+
+
+def test_webhook_items_skipped_by_polling(generate_mockstodon, webhook_server, tmp_path, pending_account, ivoryconfig):
+    from datetime import datetime, timezone
+    # the poll gets the same (clean) signup from Mastodon.py, with an integer
+    # id and parsed dates
+    polled = dict(pending_account(), id=1, created_at=datetime(2019, 1, 1, tzinfo=timezone.utc))
+    Mockstodon = generate_mockstodon(reports=[], accounts=[polled])
+    config = deepcopy(ivoryconfig)
+    config['ledgerPath'] = str(tmp_path / "ledger.db")
+    i = ivory.Ivory(config)
+    judged = []
+    make_judgements = i.pending_account_judge.make_judgements
+    def _make_judgements(items, *args, **kwargs):
+        judged.extend(item['id'] for item in items)
+        return make_judgements(items, *args, **kwargs)
+    i.pending_account_judge.make_judgements = _make_judgements
+    server = webhook_server(i)
+    assert deliver(server, "account.created", pending_account()) == 202
+    server.join()
+    assert judged == ["1"]
+    # so reconciliation doesn't judge it again
+    i.run()
+    assert judged == ["1"]
+    assert Mockstodon.moderation_actions == []
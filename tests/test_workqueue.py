@@ -0,0 +1,70 @@
+import pytest
+from workqueue import WorkQueue
+
+@pytest.fixture
+def work_queue(tmp_path):
+    work_queue = WorkQueue(str(tmp_path / "work.db"))
+    yield work_queue
+    work_queue.close()
+
+def test_enqueue(work_queue, report):
+    rpts = [report(report_id="1"), report(report_id="2")]
+    assert work_queue.enqueue("reports", rpts, "v1") == 2
+    # items already queued aren't queued again...
+    assert work_queue.enqueue("reports", rpts, "v1") == 0
+    # ...unless they've changed, or the rules have
+    rpts[0]['comment'] = "new info"
+    assert work_queue.enqueue("reports", rpts, "v1") == 1
+    assert work_queue.enqueue("reports", rpts, "v2") == 2
+    assert work_queue.counts("reports") == {"pending": 2}
+    assert work_queue.counts("pendingAccounts") == {}
+
+def test_leases(tmp_path, report):
+    path = str(tmp_path / "work.db")
+    # two workers in separate processes, as far as SQLite is concerned
+    first = WorkQueue(path)
+    second = WorkQueue(path)
+    rpts = [report(report_id=str(report_id)) for report_id in range(1, 6)]
+    first.enqueue("reports", rpts, "v1")
+    leased = first.lease("reports", "first", 3, 60)
+    assert [rpt['id'] for rpt in leased] == ["1", "2", "3"]
+    # nobody else gets leased items
+    assert [rpt['id'] for rpt in second.lease("reports", "second", 10, 60)] == ["4", "5"]
+    assert second.lease("reports", "second", 10, 60) == []
+    # only the worker holding an item can settle it
+    second.complete("reports", leased[0], "second")
+    first.complete("reports", leased[0], "first")
+    first.release("reports", leased[1], "first")
+    assert first.counts("reports") == {"done": 1, "pending": 1, "leased": 3}
+    assert [rpt['id'] for rpt in second.lease("reports", "second", 10, 60)] == ["2"]
+    first.close()
+    second.close()
+
+def test_expired_leases(work_queue, report):
+    work_queue.enqueue("reports", [report()], "v1")
+    (leased,) = work_queue.lease("reports", "first", 10, -1)
+    # the first worker's lease ran out, so it can't complete the item anymore
+    assert [rpt['id'] for rpt in work_queue.lease("reports", "second", 10, 60)] == ["1"]
+    work_queue.complete("reports", leased, "first")
+    assert work_queue.counts("reports") == {"leased": 1}
+    work_queue.complete("reports", leased, "second")
+    assert work_queue.counts("reports") == {"done": 1}
+    work_queue.prune(-1)
+    assert work_queue.counts("reports") == {}
+
+def test_claim_action(work_queue):
+    assert work_queue.claim_action("1", "suspend", "first", 60)
+    assert not work_queue.claim_action("1", "suspend", "second", 60)
+    # other accounts and actions are claimed separately
+    assert work_queue.claim_action("2", "suspend", "second", 60)
+    assert work_queue.claim_action("1", "warn", "second", 60)
+    # failed actions can be tried again right away...
+    work_queue.finish_action("2", "suspend", "second", False, 60)
+    assert work_queue.claim_action("2", "suspend", "first", 60)
+    # ...but ones that were carried out aren't repeated
+    work_queue.finish_action("1", "suspend", "first", True, 60)
+    assert not work_queue.claim_action("1", "suspend", "second", 60)
+    assert not work_queue.claim_action("1", "suspend", "first", 60)
+    # expired claims are up for grabs
+    assert work_queue.claim_action("3", "suspend", "first", -1)
+    assert work_queue.claim_action("3", "suspend", "second", 60)
@@ -1,20 +1,104 @@
 """
 Utilities for Ivory operations.
 """
-from bs4 import BeautifulSoup
-from typing import List
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from typing import List, NamedTuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
-def parse_links(text: str):
+import constants
+
+# BeautifulSoup is imported where it's used, so startup doesn't pay for it
+# unless some rule actually parses HTML
+
+# URLs in plain text, minus any punctuation the sentence ends with
+BARE_URL = re.compile(r"""https?://[^\s<>"']+""", re.IGNORECASE)
+BARE_URL_TRAILING = ".,;:!?)]}'\""
+
+
+class Link(NamedTuple):
+    """
+    A link found in some HTML, and what kind of link it is (one of the
+    constants.LINK_* kinds).
     """
-    Parse all links out of an HTML string.
-    Currently using BeautifulSoup for this.
+    url: str
+    kind: str
 
-    Used primarily when getting links out of a status or bio.
 
-    TODO: Make parsing read non-<a> links?
-    TODO: Exclude mentions? The "mention" class is not a good way to filter that...
+def link_kind(classes: str) -> str:
+    """
+    Work out what a link is from its class attribute, as Mastodon marks up
+    mentions ("u-url mention") and hashtags ("mention hashtag").
+    """
+    classes = (classes or "").split()
+    if "hashtag" in classes:
+        return constants.LINK_HASHTAG
+    if "mention" in classes:
+        return constants.LINK_MENTION
+    return constants.LINK_EXTERNAL
+
+
+class LinkParser(HTMLParser):
+    """
+    Collects the links in a piece of HTML as it's fed in: the href of every
+    <a> tag (None if it doesn't have one), and URLs written out in the text
+    outside them.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.links = []
+        self._anchors = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        self._anchors += 1
+        # valueless attributes come through as None; BeautifulSoup made them ""
+        attrs = {name: value or "" for (name, value) in attrs}
+        self.links.append(Link(attrs.get("href"), link_kind(attrs.get("class"))))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag == "a" and self._anchors:
+            self._anchors -= 1
+
+    def handle_data(self, data):
+        # the text of a link is usually the link itself, already counted
+        if self._anchors or "://" not in data:
+            return
+        for match in BARE_URL.finditer(data):
+            self.links.append(Link(match.group().rstrip(BARE_URL_TRAILING), constants.LINK_EXTERNAL))
+
+
+def extract_links(text: str) -> List[Link]:
+    """
+    Get every link out of an HTML string, in the order they appear.
+    """
+    if not text or ("<a" not in text and "<A" not in text and "://" not in text):
+        return []
+    parser = LinkParser()
+    parser.feed(text)
+    parser.close()
+    return parser.links
+
+
+def parse_links(text: str, kinds: tuple = None):
     """
-    return [a.get('href') for a in BeautifulSoup(text, "html.parser").find_all('a')]
+    Parse all links out of an HTML string: every <a> tag's href, along with
+    any bare URLs in the text. Mentions and hashtags are included unless kinds
+    (a tuple of constants.LINK_* kinds) leaves them out.
+
+    Used primarily when getting links out of a status or bio.
+    """
+    return [link.url for link in extract_links(text) if kinds is None or link.kind in kinds]
 
 def parse_links_from_statuses(statuses: List[dict]):
     """
@@ -25,3 +109,198 @@ def parse_links_from_statuses(statuses: List[dict]):
         for link in parse_links(status['content']):
             links.append(link)
     return links
+
+# Ports canonicalize_url leaves out, by scheme
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def is_tracking_param(name: str) -> bool:
+    name = name.lower()
+    return name in constants.TRACKING_PARAMS or name.startswith(constants.TRACKING_PARAM_PREFIXES)
+
+
+def normalize_hostname(hostname: str) -> str:
+    """
+    Put a hostname in the form canonicalize_url uses: lowercased, without a
+    trailing dot, and decoded from punycode.
+    """
+    hostname = hostname.strip().rstrip(".").lower()
+    if "xn--" in hostname:
+        try:
+            hostname = hostname.encode("ascii").decode("idna")
+        except UnicodeError:
+            pass
+    return hostname
+
+
+def canonicalize_url(url: str):
+    """
+    Put a URL in a canonical form, so links that only differ in ways that
+    don't change where they go compare equal: the scheme and host are
+    lowercased, internationalized hosts are decoded from punycode, default
+    ports, fragments and tracking parameters are dropped, and an empty path
+    becomes "/". Other paths are left alone, as servers can treat them
+    differently with or without a trailing slash. Links without a host
+    (like "example.com/page", which has no scheme) are left as they are.
+
+    Returns None if the URL can't be parsed.
+    """
+    try:
+        url = url.strip()
+        parts = urlsplit(url)
+        hostname = parts.hostname
+        port = parts.port
+    except (AttributeError, ValueError):
+        return None
+    if not hostname:
+        return url
+    scheme = parts.scheme.lower()
+    hostname = normalize_hostname(hostname)
+    netloc = "[{}]".format(hostname) if ":" in hostname else hostname
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc += ":{}".format(port)
+    if parts.username is not None:
+        userinfo = parts.username if parts.password is None else "{}:{}".format(parts.username, parts.password)
+        netloc = "{}@{}".format(userinfo, netloc)
+    query = parts.query
+    if query:
+        params = parse_qsl(query, keep_blank_values=True)
+        kept = [(name, value) for (name, value) in params if not is_tracking_param(name)]
+        if len(kept) < len(params):
+            query = urlencode(kept)
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+def canonical_links(links: List[str]) -> List[str]:
+    """
+    Canonicalize a list of links (see canonicalize_url), dropping duplicates,
+    blanks and anything that can't be parsed. The links stay in the order they first
+    appear.
+    """
+    canonical = {}
+    for link in links:
+        if link:
+            url = canonicalize_url(link)
+            if url:
+                canonical[url] = None
+    return list(canonical)
+
+
+def html_to_text(text: str):
+    """
+    Strip the markup out of an HTML string, leaving the plain text with its
+    whitespace collapsed.
+    """
+    from bs4 import BeautifulSoup
+    return " ".join(BeautifulSoup(text, "html.parser").get_text(" ").split())
+
+
+class TTLCache:
+    """
+    A thread-safe cache whose entries expire ttl seconds after they're set,
+    holding at most maxsize entries (dropping the oldest first).
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            (expires, value) = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CircuitBreaker:
+    """
+    Tracks failures per key (such as a host), and stops calls to keys that
+    keep failing: after threshold failures in a row, a key's circuit opens,
+    and calls to it are refused for cooldown seconds. After that, calls are
+    let through again, and the first failure reopens the circuit.
+
+    Thread-safe.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        # failures in a row, and when the circuit opened, by key
+        self._failures = {}
+        self._opened = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key) -> bool:
+        """
+        Check whether a call to a key should go ahead.
+        """
+        with self._lock:
+            opened = self._opened.get(key)
+            return opened is None or time.monotonic() - opened >= self.cooldown
+
+    def succeeded(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+            self._opened.pop(key, None)
+
+    def failed(self, key):
+        with self._lock:
+            failures = self._failures.get(key, 0) + 1
+            self._failures[key] = failures
+            if failures >= self.threshold:
+                self._opened[key] = time.monotonic()
+
+
+class ConcurrencyLimiter:
+    """
+    Caps how many calls run at once, both in total and per key (such as a
+    host).
+
+        with limiter.limit(host):
+            ...
+
+    Thread-safe. Keys are only tracked while calls for them are running or
+    waiting, so limiting by an endless stream of hosts doesn't leak memory.
+    """
+
+    def __init__(self, total: int, per_key: int):
+        self.per_key = per_key
+        self._total = threading.BoundedSemaphore(total)
+        # each key's [semaphore, calls running or waiting]
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def limit(self, key):
+        with self._lock:
+            entry = self._keys.get(key)
+            if entry is None:
+                entry = self._keys[key] = [threading.BoundedSemaphore(self.per_key), 0]
+            entry[1] += 1
+        try:
+            # take the key's slot first, so calls waiting on a busy key don't
+            # hold up calls to other keys
+            with entry[0], self._total:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._keys[key]
@@ -0,0 +1,115 @@
+"""
+Webhook receiver for Ivory's serve mode.
+
+Instead of waiting for the next poll, Mastodon can push new reports and signups
+to Ivory as admin webhooks (set one up under Administration > Webhooks, with
+the report.created and account.created events). WebhookServer is a small
+embedded HTTP server that checks each delivery's signature and hands the event
+to Ivory.handle_event on a background thread, so Mastodon gets its response
+right away.
+"""
+import hashlib
+import hmac
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import constants
+
+# Header Mastodon signs webhook deliveries with
+SIGNATURE_HEADER = "X-Hub-Signature"
+
+
+def sign(secret: str, body: bytes) -> str:
+    """
+    Get the signature header value Mastodon would send with a body.
+    """
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(secret: str, body: bytes, signature: str) -> bool:
+    """
+    Check a delivery's signature header against its body.
+    """
+    if not signature:
+        return False
+    return hmac.compare_digest(sign(secret, body), signature)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Accepts signed webhook deliveries, on any path.
+    """
+    server_version = "Ivory/" + constants.VERSION
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400, "Bad Content-Length")
+            return
+        if length > constants.WEBHOOK_MAX_BODY:
+            self.send_error(413, "Delivery too large")
+            return
+        body = self.rfile.read(length)
+        if not verify_signature(self.server.secret, body, self.headers.get(SIGNATURE_HEADER)):
+            self.server.logger.warning("rejected a webhook delivery with a bad signature")
+            self.send_error(401, "Bad signature")
+            return
+        try:
+            payload = json.loads(body)
+            event = payload['event']
+            obj = payload['object']
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400, "Malformed event")
+            return
+        self.server.submit(event, obj)
+        self.send_response(202)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        self.server.logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    An HTTP server feeding webhook events to an Ivory instance.
+
+    Events are handled one at a time, in the order they arrive.
+    """
+    daemon_threads = True
+
+    def __init__(self, ivory, secret: str, address: tuple):
+        self.ivory = ivory
+        self.secret = secret
+        self.logger = logging.getLogger(__name__)
+        self._events = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ivory-webhook")
+        ThreadingHTTPServer.__init__(self, address, WebhookHandler)
+
+    def submit(self, event: str, obj: dict):
+        """
+        Queue an event up to be handled.
+        """
+        self.logger.debug("received %s webhook", event)
+        self._events.submit(self._handle, event, obj)
+
+    def _handle(self, event: str, obj: dict):
+        try:
+            self.ivory.handle_event(event, obj)
+        except Exception:
+            self.logger.exception("failed to handle %s webhook", event)
+
+    def join(self):
+        """
+        Wait for the events received so far to be handled.
+        """
+        # events are handled in order, so once this is done, so are they
+        self._events.submit(lambda: None).result()
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        self._events.shutdown()
@@ -0,0 +1,194 @@
+"""
+The work queue, for splitting Ivory into a fetcher and any number of workers.
+
+The fetcher (python . fetch) walks the moderation queues and adds what it
+finds to the work queue, a SQLite database in WAL mode; workers (python .
+work) lease items from it, judge them and carry out the punishments. A lease
+expires if its worker dies, so another worker can pick the item up.
+
+Punishments are claimed per account and action too, so even if two workers end
+up with reports against the same account (or an item is picked up again after
+a worker died mid-punishment), the account is only punished once.
+"""
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import List
+
+from ledger import fingerprint
+
+# Work item states
+STATE_PENDING = "pending"
+STATE_LEASED = "leased"
+STATE_DONE = "done"
+
+
+class WorkQueue:
+    """
+    A durable queue of items to judge, shared between processes.
+
+    Safe to share between threads, too.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # autocommit mode, so transactions can be started with BEGIN IMMEDIATE
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS work (
+                    queue TEXT NOT NULL,
+                    item_id TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    owner TEXT,
+                    expires REAL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (queue, item_id)
+                )
+            """)
+            self._db.execute("CREATE INDEX IF NOT EXISTS work_state ON work (queue, state, expires)")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS actions (
+                    account_id TEXT NOT NULL,
+                    action TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    expires REAL NOT NULL,
+                    PRIMARY KEY (account_id, action)
+                )
+            """)
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run a write transaction, holding SQLite's write lock from the start so
+        other processes can't claim the same rows in the meantime.
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def enqueue(self, queue: str, items: List[dict], version: str) -> int:
+        """
+        Add items to the queue for the given version of a judge's rules.
+        Items already queued are left alone unless they or the rules have
+        changed since, in which case they're queued up again.
+
+        Returns the number of items that were (re)queued.
+        """
+        queued = 0
+        now = time.time()
+        with self._transaction() as db:
+            for item in items:
+                item_id = str(item['id'])
+                item_fingerprint = fingerprint(item)
+                row = db.execute("SELECT fingerprint, version FROM work WHERE queue = ? AND item_id = ?",
+                                 (queue, item_id)).fetchone()
+                if row == (item_fingerprint, version):
+                    continue
+                db.execute("INSERT OR REPLACE INTO work VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?)",
+                           (queue, item_id, json.dumps(item, default=str), item_fingerprint, version,
+                            STATE_PENDING, now))
+                queued += 1
+        return queued
+
+    def lease(self, queue: str, owner: str, limit: int, lease_time: float) -> List[dict]:
+        """
+        Lease up to limit pending items (or ones whose lease has expired) for
+        lease_time seconds.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            rows = db.execute(
+                "SELECT item_id, item FROM work WHERE queue = ? AND "
+                "(state = ? OR (state = ? AND expires < ?)) ORDER BY updated_at LIMIT ?",
+                (queue, STATE_PENDING, STATE_LEASED, now, limit)
+            ).fetchall()
+            db.executemany(
+                "UPDATE work SET state = ?, owner = ?, expires = ?, updated_at = ? WHERE queue = ? AND item_id = ?",
+                [(STATE_LEASED, owner, now + lease_time, now, queue, item_id) for (item_id, _) in rows]
+            )
+        return [json.loads(item) for (_, item) in rows]
+
+    def _settle(self, queue: str, item: dict, owner: str, state: str):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE work SET state = ?, owner = NULL, expires = NULL, updated_at = ? "
+                "WHERE queue = ? AND item_id = ? AND state = ? AND owner = ? AND fingerprint = ?",
+                (state, time.time(), queue, str(item['id']), STATE_LEASED, owner, fingerprint(item))
+            )
+
+    def complete(self, queue: str, item: dict, owner: str):
+        """
+        Mark a leased item as done. Does nothing if the lease was lost (or
+        the item changed) in the meantime.
+        """
+        self._settle(queue, item, owner, STATE_DONE)
+
+    def release(self, queue: str, item: dict, owner: str):
+        """
+        Give a leased item back, to be tried again.
+        """
+        self._settle(queue, item, owner, STATE_PENDING)
+
+    def claim_action(self, account_id, action: str, owner: str, lease_time: float) -> bool:
+        """
+        Claim the right to carry out an action on an account for lease_time
+        seconds. Fails if another worker holds the claim, or the action has
+        already been carried out (by any worker, this one included).
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("SELECT state, owner, expires FROM actions WHERE account_id = ? AND action = ?",
+                             (str(account_id), action)).fetchone()
+            if row is not None and row[2] >= now and (row[0] == STATE_DONE or row[1] != owner):
+                return False
+            db.execute("INSERT OR REPLACE INTO actions VALUES (?, ?, ?, ?, ?)",
+                       (str(account_id), action, STATE_LEASED, owner, now + lease_time))
+            return True
+
+    def finish_action(self, account_id, action: str, owner: str, succeeded: bool, memory: float):
+        """
+        Settle a claimed action. Actions that were carried out block other
+        claims for memory seconds; ones that failed are freed up right away.
+        """
+        with self._transaction() as db:
+            if succeeded:
+                db.execute("UPDATE actions SET state = ?, expires = ? WHERE account_id = ? AND action = ? AND owner = ?",
+                           (STATE_DONE, time.time() + memory, str(account_id), action, owner))
+            else:
+                db.execute("DELETE FROM actions WHERE account_id = ? AND action = ? AND owner = ?",
+                           (str(account_id), action, owner))
+
+    def counts(self, queue: str) -> dict:
+        """
+        Get how many of a queue's items are in each state.
+        """
+        with self._lock:
+            return dict(self._db.execute("SELECT state, COUNT(*) FROM work WHERE queue = ? GROUP BY state",
+                                         (queue,)).fetchall())
+
+    def prune(self, max_age: float):
+        """
+        Forget finished items and actions older than max_age seconds.
+        """
+        cutoff = time.time() - max_age
+        with self._transaction() as db:
+            db.execute("DELETE FROM work WHERE state = ? AND updated_at < ?", (STATE_DONE, cutoff))
+            db.execute("DELETE FROM actions WHERE expires < ?", (cutoff,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()